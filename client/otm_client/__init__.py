@@ -0,0 +1,3 @@
+from .client import OtmClient, UploadError
+
+__all__ = ['OtmClient', 'UploadError']
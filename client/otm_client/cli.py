@@ -0,0 +1,46 @@
+from pathlib import Path
+
+import click
+
+from .client import OtmClient
+
+
+@click.group()
+@click.option(
+    '--api-url',
+    envvar='OTM_API_URL',
+    default='http://localhost:8000/api/v1',
+    show_default=True,
+    help='The API root of the server.',
+)
+@click.option('--token', envvar='OTM_TOKEN', help='An OAuth2 access token.')
+@click.pass_context
+def cli(ctx: click.Context, api_url: str, token: str) -> None:
+    ctx.obj = OtmClient(api_url, token=token)
+
+
+@cli.command()
+@click.argument('batch_id', type=int)
+@click.argument(
+    'directory', type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=Path)
+)
+@click.option('--concurrency', default=8, show_default=True, help='The number of parallel parts.')
+@click.pass_obj
+def upload(client: OtmClient, batch_id: int, directory: Path, concurrency: int) -> None:
+    """
+    Upload the images in DIRECTORY to the pending uploads of an upload batch.
+
+    Files are matched to pending uploads by name. If an upload is interrupted, run this again
+    to resume it.
+    """
+    files = [path for path in directory.iterdir() if path.is_file()]
+    paths = client.match_files(batch_id, files)
+    total = sum(path.stat().st_size for path in paths.values())
+    with click.progressbar(length=total, label='Uploading') as bar:
+        images = client.upload_files(batch_id, paths, concurrency=concurrency, progress=bar.update)
+
+    click.echo(f'Created {len(images)} images')
+
+
+if __name__ == '__main__':
+    cli()
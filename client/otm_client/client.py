@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import base64
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass
+import hashlib
+from pathlib import Path
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, TypeVar
+
+import requests
+
+T = TypeVar('T')
+
+# The number of pending uploads initialized and completed per request
+GROUP_SIZE = 100
+
+# The server's limit on the number of parts presigned per request
+PRESIGN_SIZE = 10_000
+
+
+class UploadError(Exception):
+    pass
+
+
+@dataclass
+class _Part:
+    pending_upload: int
+    path: Path
+    part_number: int
+    offset: int
+    size: int
+    md5: str = ''
+
+    def read(self) -> bytes:
+        with open(self.path, 'rb') as fd:
+            fd.seek(self.offset)
+            return fd.read(self.size)
+
+    def compute_md5(self) -> _Part:
+        self.md5 = base64.b64encode(hashlib.md5(self.read()).digest()).decode()
+        return self
+
+    @property
+    def md5_hex(self) -> str:
+        return base64.b64decode(self.md5).hex()
+
+
+def _chunks(items: List[T], size: int) -> Iterator[List[T]]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+class OtmClient:
+    """
+    A client for bulk uploads of images to the pending uploads of an upload batch.
+
+    Files are uploaded directly to storage, in parts, with many parts in flight at once. Each part
+    is verified by the server before an upload is completed. Any upload which is interrupted can
+    be resumed by uploading the batch again, and only missing or corrupt parts will be re-sent.
+    """
+
+    def __init__(
+        self,
+        api_url: str = 'http://localhost:8000/api/v1',
+        token: Optional[str] = None,
+        retries: int = 5,
+        session: Optional[requests.Session] = None,
+    ):
+        self.api_url = api_url.rstrip('/')
+        self.retries = retries
+        self.session = session or requests.Session()
+        if token:
+            self.session.headers['Authorization'] = f'Bearer {token}'
+
+    def _request(self, method: str, path: str, **kwargs) -> Any:
+        response = self.session.request(method, f'{self.api_url}/{path}', **kwargs)
+        if not response.ok:
+            raise UploadError(f'{method} {path} failed ({response.status_code}): {response.text}')
+
+        return response.json() if response.content else None
+
+    def pending_uploads(self, batch_id: int) -> Dict[str, int]:
+        """Return the ID of each pending upload in a batch, keyed by name."""
+        uploads = {}
+        while True:
+            page = self._request(
+                'GET',
+                f'upload/batches/{batch_id}/pending',
+                params={'limit': 1000, 'offset': len(uploads)},
+            )
+            uploads.update({upload['name']: upload['id'] for upload in page['results']})
+            if not page['next'] or not page['results']:
+                return uploads
+
+    def match_files(self, batch_id: int, files: Iterable[Path]) -> Dict[int, Path]:
+        """
+        Return each file whose name matches a pending upload in the batch, keyed by its ID.
+
+        Files which don't match any pending upload (e.g. those already uploaded) are skipped.
+        """
+        pending = self.pending_uploads(batch_id)
+        return {pending[path.name]: path for path in files if path.name in pending}
+
+    def upload_batch(
+        self,
+        batch_id: int,
+        files: Iterable[Path],
+        concurrency: int = 8,
+        progress: Optional[Callable[[int], None]] = None,
+    ) -> List[dict]:
+        """
+        Upload each file whose name matches a pending upload in the batch, returning the images.
+
+        Files which don't match any pending upload (e.g. those already uploaded) are skipped.
+        `progress` is called with the number of bytes in each part, as it is uploaded.
+        """
+        return self.upload_files(
+            batch_id, self.match_files(batch_id, files), concurrency=concurrency, progress=progress
+        )
+
+    def upload_files(
+        self,
+        batch_id: int,
+        paths: Dict[int, Path],
+        concurrency: int = 8,
+        progress: Optional[Callable[[int], None]] = None,
+    ) -> List[dict]:
+        """Upload the file of each pending upload, keyed by its ID, returning the images."""
+        images = []
+        with ThreadPoolExecutor(concurrency) as executor:
+            for group in _chunks(sorted(paths), GROUP_SIZE):
+                images.extend(
+                    self._upload_group(
+                        batch_id, {pk: paths[pk] for pk in group}, executor, progress
+                    )
+                )
+
+        return images
+
+    def _upload_group(
+        self,
+        batch_id: int,
+        paths: Dict[int, Path],
+        executor: Executor,
+        progress: Optional[Callable[[int], None]],
+    ) -> List[dict]:
+        transfers = self._request(
+            'POST',
+            f'upload/batches/{batch_id}/multipart_initialize',
+            json={
+                'uploads': [
+                    {'pending_upload': pk, 'size': path.stat().st_size}
+                    for pk, path in paths.items()
+                ]
+            },
+        )
+
+        # Lay out every part, and hash them in parallel
+        parts: List[_Part] = []
+        uploaded: Dict[tuple, str] = {}
+        for transfer in transfers:
+            pk = transfer['pending_upload']
+            offset = 0
+            for part in transfer['parts']:
+                parts.append(_Part(pk, paths[pk], part['part_number'], offset, part['size']))
+                offset += part['size']
+            for part in transfer['uploaded_parts']:
+                uploaded[(pk, part['part_number'])] = part['etag']
+        parts = list(executor.map(_Part.compute_md5, parts))
+
+        # Only upload parts which are missing, or don't match
+        remaining = [
+            part
+            for part in parts
+            if uploaded.get((part.pending_upload, part.part_number)) != part.md5_hex
+        ]
+        for chunk in _chunks(remaining, PRESIGN_SIZE):
+            presigned = self._request(
+                'POST',
+                f'upload/batches/{batch_id}/multipart_presign',
+                json={
+                    'parts': [
+                        {
+                            'pending_upload': part.pending_upload,
+                            'part_number': part.part_number,
+                            'md5': part.md5,
+                        }
+                        for part in chunk
+                    ]
+                },
+            )
+            urls = [part['upload_url'] for part in presigned]
+            for part in executor.map(self._put_part, chunk, urls):
+                if progress is not None:
+                    progress(part.size)
+
+        return self._request(
+            'POST',
+            f'upload/batches/{batch_id}/multipart_complete',
+            json={
+                'uploads': [
+                    {
+                        'pending_upload': pk,
+                        'parts': [
+                            {'part_number': part.part_number, 'md5': part.md5}
+                            for part in parts
+                            if part.pending_upload == pk
+                        ],
+                    }
+                    for pk in paths
+                ]
+            },
+        )
+
+    def _put_part(self, part: _Part, url: str) -> _Part:
+        """Upload a part, retrying with exponential backoff on network and server errors."""
+        for attempt in range(self.retries + 1):
+            try:
+                response = requests.put(url, data=part.read(), headers={'Content-MD5': part.md5})
+            except requests.RequestException:
+                if attempt == self.retries:
+                    raise
+            else:
+                if response.ok:
+                    return part
+                if response.status_code < 500 or attempt == self.retries:
+                    raise UploadError(
+                        f'Part {part.part_number} of {part.path} failed '
+                        f'({response.status_code}): {response.text}'
+                    )
+
+            time.sleep(2**attempt)
+
+        raise AssertionError('unreachable')
@@ -0,0 +1,21 @@
+from setuptools import find_packages, setup
+
+setup(
+    name='otm-client',
+    version='0.1.0',
+    description='A client for bulk uploads to Optimal Transport Morphometry.',
+    license='Apache 2.0',
+    author='Kitware, Inc.',
+    author_email='kitware@kitware.com',
+    classifiers=[
+        'Development Status :: 3 - Alpha',
+        'License :: OSI Approved :: Apache Software License',
+        'Operating System :: OS Independent',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python',
+    ],
+    python_requires='>=3.8',
+    packages=find_packages(),
+    install_requires=['click', 'requests'],
+    entry_points={'console_scripts': ['otm=otm_client.cli:cli']},
+)
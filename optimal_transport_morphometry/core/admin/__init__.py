@@ -1,6 +1,7 @@
 from .analysis import AnalysisResultAdmin
 from .atlas import AtlasAdmin
-from .dataset import DatasetAdmin
+from .blob import BlobAdmin
+from .dataset import CovariateAdmin, DatasetAdmin
 from .image import ImageAdmin
 from .preprocess import (
     FeatureImageAdmin,
@@ -13,6 +14,8 @@ from .upload import PendingUpload, UploadBatch
 __all__ = [
     'AnalysisResultAdmin',
     'AtlasAdmin',
+    'BlobAdmin',
+    'CovariateAdmin',
     'DatasetAdmin',
     'ImageAdmin',
     'FeatureImageAdmin',
@@ -5,12 +5,14 @@ from optimal_transport_morphometry.core.models import AnalysisResult
 
 @admin.register(AnalysisResult)
 class AnalysisResultAdmin(admin.ModelAdmin):
-    list_display = ['id', 'created', 'preprocessing_batch', 'status']
+    list_display = ['id', 'created', 'preprocessing_batch', 'backend', 'status']
     list_display_links = ['id']
     list_select_related = True
 
     fields = [
         'preprocessing_batch',
+        'backend',
+        'fingerprint',
         'status',
         'error_message',
         'zip_file',
@@ -0,0 +1,13 @@
+from django.contrib import admin
+
+from optimal_transport_morphometry.core.models import Blob
+
+
+@admin.register(Blob)
+class BlobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'checksum', 'key', 'size', 'ref_count']
+    list_display_links = ['id', 'checksum']
+
+    search_fields = ['checksum', 'key']
+
+    readonly_fields = ['checksum', 'key', 'size', 'ref_count']
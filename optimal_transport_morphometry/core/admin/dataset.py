@@ -1,7 +1,7 @@
 from django.contrib import admin
 from guardian.admin import GuardedModelAdmin
 
-from optimal_transport_morphometry.core.models import Dataset
+from optimal_transport_morphometry.core.models import Covariate, Dataset
 
 
 @admin.register(Dataset)
@@ -12,6 +12,8 @@ class DatasetAdmin(GuardedModelAdmin):
         'owner',
         'public',
         'current_preprocessing_batch',
+        'image_count',
+        'uploads_active',
     ]
     list_display_links = ['id', 'name']
     list_filter = ['name']
@@ -26,3 +28,13 @@ class DatasetAdmin(GuardedModelAdmin):
         'public',
         'current_preprocessing_batch',
     ]
+
+
+@admin.register(Covariate)
+class CovariateAdmin(admin.ModelAdmin):
+    list_display = ['id', 'name', 'type', 'dataset']
+    list_display_links = ['id', 'name']
+    list_filter = ['type']
+    list_select_related = True
+
+    search_fields = ['name']
@@ -5,5 +5,6 @@ from optimal_transport_morphometry.core.models import Image
 
 @admin.register(Image)
 class ImageAdmin(admin.ModelAdmin):
-    list_display = ['id', 'name', 'type', 'blob', 'dataset', 'size']
+    list_display = ['id', 'name', 'type', 'blob', 'dataset', 'size', 'validation_status']
+    list_filter = ['validation_status']
     list_display_links = ['id', 'name']
@@ -2,6 +2,7 @@ from django.contrib import admin
 
 from optimal_transport_morphometry.core.models import (
     FeatureImage,
+    FeatureMask,
     JacobianImage,
     PreprocessingBatch,
     RegisteredImage,
@@ -11,7 +12,15 @@ from optimal_transport_morphometry.core.models import (
 
 @admin.register(PreprocessingBatch)
 class PreprocessingBatchAdmin(admin.ModelAdmin):
-    list_display = ['id', 'atlas', 'created', 'status', 'dataset', 'error_message']
+    list_display = [
+        'id',
+        'atlas',
+        'registration_profile',
+        'created',
+        'status',
+        'dataset',
+        'error_message',
+    ]
     list_display_links = ['id']
 
 
@@ -32,9 +41,15 @@ class SegmentedImageAdmin(CommonAdmin):
 
 @admin.register(FeatureImage)
 class FeatureImageAdmin(CommonAdmin):
-    list_display = CommonAdmin.list_display + ['downsample_factor']
+    list_display = CommonAdmin.list_display + ['tissue', 'downsample_factor']
+
+
+@admin.register(FeatureMask)
+class FeatureMaskAdmin(admin.ModelAdmin):
+    list_display = ['id', 'blob', 'preprocessing_batch', 'kind', 'tissue', 'downsample_factor']
+    list_display_links = ['id']
 
 
 @admin.register(RegisteredImage)
-class RegisteredImageAdmin(admin.ModelAdmin):
-    list_display = CommonAdmin.list_display + ['registration_type']
+class RegisteredImageAdmin(CommonAdmin):
+    list_display = CommonAdmin.list_display + ['registration_type', 'registration_runtime']
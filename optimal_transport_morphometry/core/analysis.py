@@ -0,0 +1,303 @@
+"""
+Analysis backends, which compute the statistical maps of a preprocessing batch.
+
+Every backend writes the maps of each variable to
+`Analysis/Images/<variable>/<feature>/{correlation,pvalue}.nii.gz` in its output folder, which
+are uploaded along with a zip of the whole folder.
+"""
+
+import csv
+import functools
+import hashlib
+import itertools
+import json
+import pathlib
+import shutil
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Optional, TextIO, Tuple
+
+from optimal_transport_morphometry.core.encoding import nifti_suffix
+from optimal_transport_morphometry.core.models import AnalysisResult, FeatureImage, FeatureMask
+from optimal_transport_morphometry.core.rworker import run_r_script
+from optimal_transport_morphometry.core.sparse import mask_values, rehydrate
+from optimal_transport_morphometry.core.transfers import (
+    download_feature_image,
+    iter_feature_images,
+    load_mask,
+)
+from optimal_transport_morphometry.core.vbm import correlation_maps
+
+UTM_FOLDER = '/opt/UTM'
+
+
+class AnalysisError(Exception):
+    """An analysis couldn't be computed."""
+
+
+class AnalysisBackend:
+    """Computes the maps of an analysis, from the feature images of a batch and their metadata."""
+
+    # The features which every variable has maps of
+    features: Tuple[str, ...] = ()
+
+    def version(self) -> str:
+        """Return the version of the backend, which changes whenever its results may change."""
+        raise NotImplementedError
+
+    def run(
+        self,
+        feature_images: List[FeatureImage],
+        columns: List[str],
+        rows: Dict[int, dict],
+        output_folder: str,
+    ) -> None:
+        """Write the maps of an analysis to a folder, raising AnalysisError if it fails."""
+        raise NotImplementedError
+
+
+class UTMBackend(AnalysisBackend):
+    """The full UTM pipeline (optimal transport, and VBM), run by its R scripts."""
+
+    features = ('allocation', 'transport', 'vbm')
+
+    def version(self) -> str:
+        return _utm_version()
+
+    def run(self, feature_images, columns, rows, output_folder):
+        # The inputs are staged in a temporary folder, which is removed after the analysis
+        with TemporaryDirectory() as input_folder:
+            # Iterate over every feature image
+            variables = []
+            mask_img = None
+            for feature_image in feature_images:
+                image = feature_image.source_image
+                meta = rows[image.id]
+                meta.setdefault('name', image.name)
+
+                # Ensure file has the extension of its encoding (.nii or .nii.gz)
+                # Ants will produce a segmentation fault if it tries to read a
+                # compressed image with an uncompressed file extension, and visa versa
+                # Sparse feature images are rehydrated, and written compressed
+                suffix = nifti_suffix(feature_image.blob.name) if feature_image.blob else '.nii.gz'
+                meta['name'] = pathlib.Path(meta['name']).with_suffix(suffix)
+
+                # Add meta to variables
+                variables.append(meta)
+
+                # Write feature image to file
+                filename = f'{input_folder}/{meta["name"]}'
+                if mask_img is None and not feature_image.blob:
+                    # Every sparse feature image shares the same mask, so it's only downloaded once
+                    mask_img = load_mask(feature_image.mask())
+                download_feature_image(feature_image, filename, mask_img)
+
+            # Write variables to a csv file, leaving missing values empty
+            variables_filename = f'{input_folder}/variables.csv'
+            headers = ['name'] + [column for column in columns if column != 'name']
+            with open(variables_filename, 'w') as csvfile:
+                _write_csv(csvfile, headers, variables)
+
+            # copy necessary R shiny files
+            shutil.copyfile(f'{UTM_FOLDER}/Scripts/Shiny/app.R', f'{output_folder}/app.R')
+            shutil.copyfile(
+                f'{UTM_FOLDER}/Scripts/Shiny/shiny-help.md', f'{output_folder}/shiny-help.md'
+            )
+            shutil.copyfile(
+                f'{UTM_FOLDER}/Scripts/ShinyVtkScripts/render.js', f'{output_folder}/render.js'
+            )
+
+            status = run_r_script(
+                f'{UTM_FOLDER}/Scripts/run.utm.barycenter.R',
+                [input_folder, variables_filename, '--working.folder', output_folder],
+            )
+            if status != 0:
+                raise AnalysisError(f'UTM exited with status {status}.')
+
+
+class VBMBackend(AnalysisBackend):
+    """
+    The voxel-wise correlation of feature images with each numeric variable, in NumPy.
+
+    Feature images are streamed (each downloaded while the last is processed), and reduced to
+    their values within the batch's union mask, where any of them are non-zero.
+    """
+
+    features = ('vbm',)
+
+    def version(self) -> str:
+        # Increment whenever the engine's results change
+        return '2'
+
+    def run(self, feature_images, columns, rows, output_folder):
+        import numpy as np
+
+        if not feature_images:
+            raise AnalysisError('The batch has no feature images.')
+
+        subject_rows = [rows[feature_image.source_image_id] for feature_image in feature_images]
+        variables = numeric_variables(columns, subject_rows)
+        if not variables:
+            raise AnalysisError('No numeric variables to correlate feature images with.')
+        design = [[_number(row.get(variable)) for variable in variables] for row in subject_rows]
+
+        support_img, analysis_mask = _analysis_masks(feature_images[0])
+        images = iter_feature_images(feature_images, support_img)
+        if analysis_mask is None:
+            # Without a mask (e.g. a dense batch from before they existed), use every voxel
+            first_img = next(images)
+            images = itertools.chain([first_img], images)
+            mask_img = first_img.new_image_like(np.ones(first_img.shape, dtype=np.float32))
+        elif analysis_mask.kind == FeatureMask.Kind.SUPPORT:
+            mask_img = support_img
+        else:
+            mask_img = load_mask(analysis_mask)
+
+        correlation, pvalue = correlation_maps(
+            (mask_values(img, mask_img) for img in images),
+            design,
+            int(np.count_nonzero(mask_img.numpy())),
+        )
+        write_vbm_maps(output_folder, variables, correlation, pvalue, mask_img)
+
+
+def write_vbm_maps(output_folder: str, variables: List[str], correlation, pvalue, mask_img) -> None:
+    """
+    Write the correlation and p-value maps of each variable, from their values within a mask.
+
+    Voxels outside of the mask aren't tested, so have a correlation of 0 and a p-value of 1, as
+    untestable voxels within it do.
+    """
+    import ants
+    import numpy as np
+
+    image_dir = pathlib.Path(output_folder) / 'Analysis' / 'Images'
+    for i, variable in enumerate(variables):
+        variable_dir = image_dir / variable / 'vbm'
+        variable_dir.mkdir(parents=True)
+        for name, maps, fill in [('correlation', correlation, 0), ('pvalue', pvalue, 1)]:
+            img = rehydrate(maps[i].astype(np.float32), mask_img, fill=fill)
+            ants.image_write(img, str(variable_dir / f'{name}.nii.gz'))
+
+
+def analysis_fingerprint(
+    backend_name: str,
+    feature_images: List[FeatureImage],
+    columns: List[str],
+    rows: Dict[int, dict],
+) -> str:
+    """
+    Return a hash of everything the results of an analysis depend on.
+
+    That's the content of each feature image (its checksum, or the key of its values if it's
+    sparse, since objects are never overwritten), the metadata of each source image, the mask the
+    analysis is restricted to, and the backend and its version. Analyses with the same fingerprint
+    have the same results.
+    """
+    backend = ANALYSIS_BACKENDS[backend_name]
+    subjects = sorted(
+        [
+            feature_image.source_image_id,
+            feature_image.source_image.name,
+            feature_image.checksum or feature_image.blob.name or feature_image.values.name,
+            rows[feature_image.source_image_id],
+        ]
+        for feature_image in feature_images
+    )
+    # The union mask is stored once a batch is finalized, after which analyses are restricted to it
+    analysis_mask = _analysis_mask(_feature_masks(feature_images[0])) if feature_images else None
+    content = [
+        backend_name,
+        backend.version(),
+        columns,
+        subjects,
+        analysis_mask.blob.name if analysis_mask is not None else None,
+    ]
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def numeric_variables(columns: List[str], rows: List[dict]) -> List[str]:
+    """Return the columns which have a numeric value for some row, and no other values."""
+    variables = []
+    for column in columns:
+        values = [row[column] for row in rows if row.get(column) not in (None, '')]
+        if column != 'name' and values and all(_is_number(value) for value in values):
+            variables.append(column)
+
+    return variables
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _number(value) -> float:
+    # Missing values are NaN, which the VBM engine leaves out of each variable's correlations
+    return float('nan') if value is None or value == '' else float(value)
+
+
+def _analysis_masks(feature_image: FeatureImage):
+    """
+    Return the support mask image of a feature image, and the mask to restrict its analysis to.
+
+    The analysis mask is the union mask, if it's been computed, or else the support mask. The
+    support mask is only loaded if sparse feature images need it to be rehydrated, or it's the
+    analysis mask. Either may be None, for batches from before masks were stored.
+    """
+    masks = _feature_masks(feature_image)
+    support = masks.get(FeatureMask.Kind.SUPPORT)
+    analysis_mask = _analysis_mask(masks)
+
+    sparse = FeatureImage.objects.filter(
+        preprocessing_batch_id=feature_image.preprocessing_batch_id,
+        tissue=feature_image.tissue,
+        downsample_factor=feature_image.downsample_factor,
+        blob='',
+    ).exists()
+    support_img = None
+    if support is not None and (sparse or analysis_mask is support):
+        support_img = load_mask(support)
+
+    return support_img, analysis_mask
+
+
+def _feature_masks(feature_image: FeatureImage) -> Dict[str, FeatureMask]:
+    """Return the support and union masks of the feature images like a feature image, by kind."""
+    return {
+        mask.kind: mask
+        for mask in FeatureMask.objects.filter(
+            preprocessing_batch_id=feature_image.preprocessing_batch_id,
+            tissue=feature_image.tissue,
+            downsample_factor=feature_image.downsample_factor,
+            kind__in=[FeatureMask.Kind.SUPPORT, FeatureMask.Kind.UNION],
+        )
+    }
+
+
+def _analysis_mask(masks: Dict[str, FeatureMask]) -> Optional[FeatureMask]:
+    return masks.get(FeatureMask.Kind.UNION, masks.get(FeatureMask.Kind.SUPPORT))
+
+
+@functools.lru_cache(maxsize=None)
+def _utm_version() -> str:
+    # The UTM repository is cloned when the worker is built, so isn't versioned. Its scripts and
+    # top level configuration (e.g. default_configuration.yml) are hashed instead, once a process.
+    digest = hashlib.sha256()
+    root = pathlib.Path(UTM_FOLDER)
+    paths = [*root.glob('*'), *root.glob('Scripts/**/*')]
+    for path in sorted(path for path in paths if path.is_file()):
+        digest.update(str(path.relative_to(root)).encode())
+        digest.update(hashlib.sha256(path.read_bytes()).digest())
+
+    return digest.hexdigest()
+
+
+def _write_csv(csvfile: TextIO, headers: List[str], rows: List[dict]):
+    writer = csv.DictWriter(csvfile, fieldnames=headers)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+ANALYSIS_BACKENDS: Dict[str, AnalysisBackend] = {
+    AnalysisResult.Backend.UTM: UTMBackend(),
+    AnalysisResult.Backend.VBM: VBMBackend(),
+}
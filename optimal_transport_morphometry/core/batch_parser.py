@@ -1,33 +1,230 @@
 import csv
-from typing import TextIO
+from itertools import islice
+import json
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
 
-from django.db import IntegrityError, transaction
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, transaction
+from django.db.models.fields.json import KeyTransform
 
 from optimal_transport_morphometry.core import models
+from optimal_transport_morphometry.core.models.metadata import parse_metadata_value
+
+# The number of CSV rows read and inserted at a time
+CHUNK_SIZE = 5000
+
+# Only the first row errors are recorded on a batch, to bound its size. The rest are counted.
+MAX_RECORDED_ERRORS = 1000
+
+
+def infer_covariate_type(values: Iterable) -> models.Covariate.Type:
+    """Return the narrowest covariate type that can represent all of the given values."""
+    values = [val for val in values if val not in (None, '')]
+    if all(isinstance(val, int) and not isinstance(val, bool) for val in values):
+        return models.Covariate.Type.INTEGER
+    if all(isinstance(val, (int, float)) and not isinstance(val, bool) for val in values):
+        return models.Covariate.Type.FLOAT
+
+    return models.Covariate.Type.CATEGORY
+
+
+def update_covariates(
+    dataset: models.Dataset,
+    rows: List[dict],
+    covariates: Optional[Dict[str, models.Covariate]] = None,
+) -> Dict[str, models.Covariate]:
+    """Create or widen the dataset's covariates, so that they can represent the given rows."""
+    if covariates is None:
+        covariates = models.covariate.dataset_covariates(dataset)
+
+    # Gather values by column, ignoring columns that are entirely empty
+    columns: Dict[str, list] = {}
+    for row in rows:
+        for key, val in row.items():
+            if val not in (None, ''):
+                columns.setdefault(key, []).append(val)
+
+    for name, values in columns.items():
+        inferred = infer_covariate_type(values)
+        covariate = covariates.get(name)
+        changed = covariate is None
+        if covariate is None:
+            covariate = models.Covariate(dataset=dataset, name=name, type=inferred)
+            covariates[name] = covariate
+        elif covariate.numeric and inferred == models.Covariate.Type.CATEGORY:
+            raise ValidationError(f'Column "{name}" must only contain numbers in this dataset.')
+        elif covariate.type == models.Covariate.Type.INTEGER and inferred != covariate.type:
+            covariate.type = inferred
+            changed = True
+
+        # Append any new categories, in the order they're first seen
+        if covariate.type == models.Covariate.Type.CATEGORY:
+            codes = covariate.category_codes()
+            for label in map(str, values):
+                if label not in codes:
+                    codes[label] = len(covariate.categories)
+                    covariate.categories.append(label)
+                    changed = True
+
+        if changed:
+            covariate.save()
+
+    return covariates
+
+
+def _widen_to_category(covariate: models.Covariate, batch: models.UploadBatch) -> None:
+    """
+    Change a numeric covariate to a category, of the values in the batch's pending uploads so far.
+
+    Only covariates created by the batch are widened, since no image has values of them yet.
+    """
+    covariate.type = models.Covariate.Type.CATEGORY
+    covariate.categories = []
+    codes = covariate.category_codes()
+    values = (
+        batch.pending_uploads.order_by('pk')
+        .annotate(value=KeyTransform(covariate.name, 'metadata'))
+        .values_list('value', flat=True)
+    )
+    for label in (str(val) for val in values.iterator() if val not in (None, '')):
+        if label not in codes:
+            codes[label] = len(covariate.categories)
+            covariate.categories.append(label)
+
+    covariate.save()
+
+
+def _row_error(
+    name: Optional[str], metadata: dict, covariates: Dict[str, models.Covariate]
+) -> Optional[str]:
+    if None in metadata:
+        return 'Row has more fields than the header.'
+    if any(val is None for val in metadata.values()):
+        return 'Row has fewer fields than the header.'
+    if not name:
+        return 'Missing image name.'
+
+    max_length = models.PendingUpload._meta.get_field('name').max_length
+    if len(name) > max_length:
+        return f'Image name is longer than {max_length} characters.'
+
+    for key, val in metadata.items():
+        covariate = covariates.get(key)
+        if covariate is not None and covariate.numeric and val != '':
+            if not isinstance(val, (int, float)):
+                return f'Column "{key}" must be a number, not "{val}".'
+
+    return None
+
+
+def _insert_pending_uploads(batch: models.UploadBatch, rows: List[Tuple[str, dict]]) -> int:
+    """
+    Insert pending uploads in a single statement, returning how many were created.
+
+    Rows are staged as arrays, and anti-joined against the dataset's images in SQL, so names
+    which already exist as images are skipped without being loaded into Python. Names which are
+    repeated within the batch are skipped by the unique constraint.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {models.PendingUpload._meta.db_table} '
+            '(batch_id, name, metadata, object_key, upload_id) '
+            "SELECT %s, staged.name, staged.metadata, '', '' "
+            'FROM unnest(%s::text[], %s::jsonb[]) AS staged(name, metadata) '
+            'WHERE NOT EXISTS ('
+            f'  SELECT 1 FROM {models.Image._meta.db_table} image '
+            '   WHERE image.dataset_id = %s AND image.name = staged.name'
+            ') '
+            'ON CONFLICT DO NOTHING',
+            [
+                batch.id,
+                [name for name, _ in rows],
+                [json.dumps(metadata) for _, metadata in rows],
+                batch.dataset_id,
+            ],
+        )
+        return cursor.rowcount
+
+
+def _chunks(iterator: Iterator, size: int) -> Iterator[list]:
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 @transaction.atomic
-def load_batch_from_csv(csvfile: TextIO, dataset: models.Dataset) -> models.UploadBatch:
+def load_batch_from_csv(
+    csvfile: TextIO, dataset: models.Dataset, chunk_size: int = CHUNK_SIZE
+) -> models.UploadBatch:
+    """
+    Create an upload batch from a CSV file, with a `name` column and any number of metadata columns.
+
+    The CSV is read incrementally, so its size is not bounded by memory. Invalid rows are skipped,
+    and recorded in the batch's `errors`, up to `MAX_RECORDED_ERRORS` of them, after which they're
+    only counted in `unrecorded_errors`. If no pending uploads are created, the batch is rolled
+    back, and an `IntegrityError` (all images already exist) or `ValidationError` (all rows are
+    invalid) is raised.
+    """
     reader = csv.DictReader(csvfile)
+    if 'name' not in (reader.fieldnames or []):
+        raise ValidationError('CSV must contain a "name" column.')
+
     batch = models.UploadBatch.objects.create(dataset=dataset)
+    covariates = models.covariate.dataset_covariates(dataset)
 
-    # Fetch existing image names
-    existing_image_names = set(
-        models.Image.objects.filter(dataset=dataset).values_list('name', flat=True)
-    )
+    # Only covariates which existed before this batch may reject values. Any it creates are typed
+    # by all of its rows, regardless of how they're chunked.
+    existing_covariates = dict(covariates)
 
-    # Collect uploads
-    uploads = []
-    for row in reader:
-        expected_name = row.pop('name')
-        if expected_name not in existing_image_names:
-            uploads.append(models.PendingUpload(batch=batch, name=expected_name, metadata=row))
+    def parsed_rows() -> Iterator[Tuple[int, Optional[str], dict]]:
+        for row in reader:
+            name = row.pop('name')
+            metadata = {key: parse_metadata_value(val) for key, val in row.items()}
+            yield reader.line_num, name, metadata
 
-    # Bulk create pending uploads, ignoring any duplicates
-    created = models.PendingUpload.objects.bulk_create(uploads, ignore_conflicts=True)
+    created = 0
+    errors = []
+    unrecorded_errors = 0
+    for chunk in _chunks(parsed_rows(), chunk_size):
+        rows = []
+        for line, name, metadata in chunk:
+            error = _row_error(name, metadata, existing_covariates)
+            if error is None:
+                rows.append((name, metadata))
+            elif len(errors) < MAX_RECORDED_ERRORS:
+                errors.append({'line': line, 'error': error})
+            else:
+                unrecorded_errors += 1
+
+        if not rows:
+            continue
+
+        # A covariate created by an earlier chunk may have non-numeric values in this one
+        for covariate_name, covariate in covariates.items():
+            if covariate_name in existing_covariates or not covariate.numeric:
+                continue
+            values = (metadata.get(covariate_name) for _, metadata in rows)
+            if infer_covariate_type(values) == models.Covariate.Type.CATEGORY:
+                _widen_to_category(covariate, batch)
+
+        # Metadata is stored as typed covariates once each upload becomes an image
+        update_covariates(dataset, [metadata for _, metadata in rows], covariates)
+        created += _insert_pending_uploads(batch, rows)
 
     # Roll back transaction if none were actually created, so empty batch doesn't still exist
     if not created:
+        if errors:
+            raise ValidationError(
+                [f'Line {error["line"]}: {error["error"]}' for error in errors[:10]]
+            )
         raise IntegrityError()
 
+    # Uploads are inserted in bulk, so they aren't counted by signals
+    batch.remaining_uploads = created
+    batch.errors = errors
+    batch.unrecorded_errors = unrecorded_errors
+    batch.save(update_fields=['remaining_uploads', 'errors', 'unrecorded_errors'])
+
     return batch
@@ -0,0 +1,116 @@
+from dataclasses import dataclass
+import gzip
+import os
+import pathlib
+import shutil
+import subprocess
+
+# The ANTs pixel type each output dtype is written with
+PIXEL_TYPES = {'float32': 'float', 'float64': 'double'}
+
+# Segmentations only hold tissue labels, so are always written as bytes
+LABEL_PIXEL_TYPE = 'unsigned char'
+
+# The buffer size used when compressing in process
+COPY_BUFFER_SIZE = 1024**2
+
+
+@dataclass(frozen=True)
+class OutputEncoding:
+    """How the preprocessed volumes of a batch are written to storage."""
+
+    # The dtype of every output but segmentations, e.g. 'float32'
+    dtype: str = 'float32'
+
+    # One of 'raw' (an uncompressed .nii file), 'gzip', or 'pigz' (multi-threaded gzip)
+    codec: str = 'gzip'
+    compression_level: int = 6
+
+    @property
+    def suffix(self) -> str:
+        return '.nii' if self.codec == 'raw' else '.nii.gz'
+
+
+def nifti_suffix(name: str) -> str:
+    """Return the extension of a NIfTI file, which ANTs needs to read it."""
+    return '.nii.gz' if name.endswith('.gz') else '.nii'
+
+
+def compress(path: str, encoding: OutputEncoding) -> str:
+    """Gzip a file, replacing it with the compressed file, and return its path."""
+    compressed_path = f'{path}.gz'
+
+    # Only use pigz if it's installed, since it's an optional system dependency
+    pigz = shutil.which('pigz') if encoding.codec == 'pigz' else None
+    if pigz is not None:
+        # Without the name and modification time, the same volume always has the same checksum
+        subprocess.run(
+            [
+                pigz,
+                f'-{encoding.compression_level}',
+                '--no-name',
+                '--processes',
+                str(os.cpu_count() or 1),
+                path,
+            ],
+            check=True,
+        )
+        return compressed_path
+
+    with open(path, 'rb') as src, open(compressed_path, 'wb') as dst:
+        with gzip.GzipFile(
+            filename='', mode='wb', fileobj=dst, compresslevel=encoding.compression_level, mtime=0
+        ) as gz:
+            shutil.copyfileobj(src, gz, COPY_BUFFER_SIZE)
+    pathlib.Path(path).unlink()
+
+    return compressed_path
+
+
+def write_image(img, path: str, encoding: OutputEncoding, labels: bool = False) -> str:
+    """
+    Write an image, without its extension, to a local file, and return the path written.
+
+    The image is cast to the dtype of the encoding (or bytes, if it's a label image). ANTs only
+    writes gzip at its default level, so it's compressed afterwards.
+    """
+    import ants
+
+    pixeltype = LABEL_PIXEL_TYPE if labels else PIXEL_TYPES[encoding.dtype]
+    if img.pixeltype != pixeltype:
+        img = img.clone(pixeltype)
+
+    path = f'{path}.nii'
+    ants.image_write(img, path)
+    if encoding.codec == 'raw':
+        return path
+
+    return compress(path, encoding)
+
+
+def write_values(values, path: str, encoding: OutputEncoding) -> str:
+    """
+    Write an array, without its extension, to a local .npy file, and return the path written.
+
+    Floating point arrays are cast to the dtype of the encoding, and others are written as is.
+    """
+    import numpy as np
+
+    if np.issubdtype(values.dtype, np.floating):
+        values = values.astype(encoding.dtype)
+
+    path = f'{path}.npy'
+    np.save(path, values, allow_pickle=False)
+    if encoding.codec == 'raw':
+        return path
+
+    return compress(path, encoding)
+
+
+def read_values(path: str):
+    """Read an array from a local .npy file, which may be compressed."""
+    import numpy as np
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as values_file:
+        return np.load(values_file, allow_pickle=False)
@@ -0,0 +1,252 @@
+from dataclasses import dataclass
+import datetime
+from typing import Iterator, List, Set
+from urllib.parse import urlparse
+
+from django.db import models
+from django.db.models import Count, Exists, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from optimal_transport_morphometry.core import multipart
+from optimal_transport_morphometry.core.models import (
+    AnalysisResult,
+    Atlas,
+    Blob,
+    Dataset,
+    FeatureMask,
+    Image,
+    PendingUpload,
+    PreprocessedImage,
+    PreprocessingBatch,
+)
+from optimal_transport_morphometry.core.storage import (
+    DELETE_BATCH_SIZE,
+    delete_objects,
+    get_boto_client,
+    get_bucket_name,
+)
+
+# The number of preprocessed images deleted per statement, to keep each transaction short
+PRUNE_CHUNK_SIZE = 1000
+
+# The columns of a preprocessed image which hold an object key
+PREPROCESSED_KEY_FIELDS = [
+    'blob',
+    'values',
+    'affine_transform',
+    'warp_transform',
+    'inverse_warp_transform',
+]
+
+# Objects newer than this may still be in the process of being referenced, e.g. by an upload
+DEFAULT_GRACE_PERIOD = datetime.timedelta(days=1)
+
+# Every column which holds an object key
+KEY_FIELDS = [
+    (Image, 'blob'),
+    *[(PreprocessedImage, field) for field in PREPROCESSED_KEY_FIELDS],
+    (FeatureMask, 'blob'),
+    (FeatureMask, 'voxel_index'),
+    (Atlas, 'blob'),
+    (AnalysisResult, 'zip_file'),
+    (Blob, 'key'),
+    (PendingUpload, 'object_key'),
+]
+
+
+@dataclass
+class GarbageCollection:
+    scanned: int = 0
+    deleted: int = 0
+    deleted_bytes: int = 0
+    aborted_uploads: int = 0
+
+
+def _analysis_data_keys() -> Set[str]:
+    """
+    Return the keys of every analysis image, which are only stored as URLs in their data.
+
+    They can't be matched against a page of keys in the database, since URLs vary by host and may
+    be signed, so they're all loaded at once. There are only two for each variable of an analysis.
+    """
+    bucket_name = get_bucket_name()
+    keys: Set[str] = set()
+
+    def walk(value):
+        if isinstance(value, dict):
+            for child in value.values():
+                walk(child)
+        elif isinstance(value, str):
+            # URLs may either be path style (with the bucket) or virtual host style (without)
+            path = urlparse(value).path.lstrip('/')
+            keys.add(path)
+            if path.startswith(f'{bucket_name}/'):
+                keys.add(path[len(bucket_name) + 1 :])
+
+    for data in AnalysisResult.objects.exclude(data={}).values_list('data', flat=True).iterator():
+        walk(data)
+
+    return keys
+
+
+def referenced_keys(keys: List[str]) -> Set[str]:
+    """Return which of the given keys are referenced by any row, in a single query."""
+    querysets = [
+        model.objects.filter(**{f'{field}__in': keys}).values_list(field, flat=True).order_by()
+        for model, field in KEY_FIELDS
+    ]
+    union: models.QuerySet = querysets[0].union(*querysets[1:])
+    return set(union)
+
+
+def _list_objects(prefix: str = '') -> Iterator[List[dict]]:
+    """Yield the bucket listing a page (of up to 1000 objects) at a time."""
+    paginator = get_boto_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=get_bucket_name(), Prefix=prefix):
+        yield page.get('Contents', [])
+
+
+def abort_abandoned_uploads(cutoff: datetime.datetime, dry_run: bool = False) -> int:
+    """
+    Abort multipart uploads started before a cutoff, which no pending upload refers to.
+
+    Their parts are stored (and billed) until they're aborted, but never listed as objects.
+    Returns the number of uploads aborted.
+    """
+    aborted = 0
+    for page in multipart.list_uploads():
+        candidates = [upload for upload in page if upload['Initiated'] < cutoff]
+        if not candidates:
+            continue
+
+        referenced = set(
+            PendingUpload.objects.filter(
+                upload_id__in=[upload['UploadId'] for upload in candidates]
+            ).values_list('upload_id', flat=True)
+        )
+        for upload in candidates:
+            if upload['UploadId'] not in referenced:
+                if not dry_run:
+                    multipart.abort_upload(upload['Key'], upload['UploadId'])
+                aborted += 1
+
+    return aborted
+
+
+def collect_garbage(
+    grace_period: datetime.timedelta = DEFAULT_GRACE_PERIOD, dry_run: bool = False
+) -> GarbageCollection:
+    """
+    Delete every object in storage which isn't referenced by the database.
+
+    The bucket listing is streamed, and each page is checked against the database at once, so
+    neither all keys nor all references to them are ever held in memory. The exception is the
+    keys of analysis images, which are few, and only referenced by URL. Objects modified within
+    the grace period are never deleted, since they may belong to an upload that hasn't been
+    finalized yet. Abandoned multipart uploads are aborted too.
+    """
+    cutoff = timezone.now() - grace_period
+    analysis_keys = _analysis_data_keys()
+    result = GarbageCollection()
+    result.aborted_uploads = abort_abandoned_uploads(cutoff, dry_run=dry_run)
+    orphans: List[str] = []
+    for page in _list_objects():
+        result.scanned += len(page)
+        candidates = {
+            obj['Key']: obj['Size']
+            for obj in page
+            if obj['LastModified'] < cutoff and obj['Key'] not in analysis_keys
+        }
+        if not candidates:
+            continue
+
+        referenced = referenced_keys(list(candidates))
+        for key, size in candidates.items():
+            if key not in referenced:
+                orphans.append(key)
+                result.deleted += 1
+                result.deleted_bytes += size
+
+        # Delete each full batch as soon as it's available, so orphans don't accumulate in memory
+        while len(orphans) >= DELETE_BATCH_SIZE:
+            if not dry_run:
+                delete_objects(orphans[:DELETE_BATCH_SIZE])
+            orphans = orphans[DELETE_BATCH_SIZE:]
+
+    if orphans and not dry_run:
+        delete_objects(orphans)
+
+    return result
+
+
+def prunable_batches(retained: int) -> models.QuerySet[PreprocessingBatch]:
+    """
+    Return the preprocessing batches which are superseded, and beyond the retention policy.
+
+    The current batch of each dataset, the `retained` batches before it, any batch which is still
+    in progress, and any batch which has been analyzed are always kept.
+    """
+    newer_count = Coalesce(
+        Subquery(
+            PreprocessingBatch.objects.filter(
+                dataset_id=OuterRef('dataset_id'), created__gt=OuterRef('created')
+            )
+            .order_by()
+            .values('dataset_id')
+            .annotate(count=Count('pk'))
+            .values('count')
+        ),
+        0,
+    )
+    return (
+        PreprocessingBatch.objects.annotate(newer_count=newer_count)
+        .filter(
+            newer_count__gt=retained,
+            status__in=[PreprocessingBatch.Status.FINISHED, PreprocessingBatch.Status.FAILED],
+        )
+        .exclude(Exists(Dataset.objects.filter(current_preprocessing_batch=OuterRef('pk'))))
+        .exclude(Exists(AnalysisResult.objects.filter(preprocessing_batch=OuterRef('pk'))))
+    )
+
+
+def _delete_unreferenced_objects(keys: List[str]) -> None:
+    # Outputs may be shared by batches which reused them, so only delete unreferenced objects
+    unreferenced = set(keys) - referenced_keys(keys)
+    if unreferenced:
+        delete_objects(sorted(unreferenced))
+
+
+def prune_preprocessing_batches(retained: int, chunk_size: int = PRUNE_CHUNK_SIZE) -> int:
+    """
+    Delete superseded preprocessing batches, their images and their objects in storage.
+
+    Images are deleted in chunks, each in its own short transaction, so the image tables are
+    never locked for long. Returns the number of batches deleted.
+    """
+    batch_ids = list(prunable_batches(retained).values_list('pk', flat=True))
+    for batch_id in batch_ids:
+        while True:
+            rows = list(
+                PreprocessedImage.objects.filter(preprocessing_batch_id=batch_id).values_list(
+                    'pk', *PREPROCESSED_KEY_FIELDS
+                )[:chunk_size]
+            )
+            if not rows:
+                break
+
+            PreprocessedImage.objects.filter(pk__in=[pk for pk, *_ in rows]).delete()
+            _delete_unreferenced_objects([key for _, *keys in rows for key in keys if key])
+
+        # Masks may also be shared by batches which reused outputs
+        masks = FeatureMask.objects.filter(preprocessing_batch_id=batch_id)
+        mask_keys = [
+            key for keys in masks.values_list('blob', 'voxel_index') for key in keys if key
+        ]
+        masks.delete()
+        if mask_keys:
+            _delete_unreferenced_objects(mask_keys)
+
+        PreprocessingBatch.objects.filter(pk=batch_id).delete()
+
+    return len(batch_ids)
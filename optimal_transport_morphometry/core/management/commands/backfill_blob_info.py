@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Type, Union
+
+from botocore.exceptions import ClientError
+from django.db import models, transaction
+import djclick as click
+
+from optimal_transport_morphometry.core.models import Image, PreprocessedImage
+from optimal_transport_morphometry.core.models.blob import reference_blobs
+from optimal_transport_morphometry.core.nifti import NiftiError, read_header
+from optimal_transport_morphometry.core.storage import head_object
+
+BlobModel = Union[Image, PreprocessedImage]
+
+
+def _fill(obj: BlobModel) -> Optional[BlobModel]:
+    """Read the blob info of a single object, returning None if its blob can't be read."""
+    try:
+        header = read_header(obj.blob.name)
+    except NiftiError:
+        # Not a valid volume (those images are flagged by validation), but its size is still known
+        try:
+            obj.size, obj.checksum = head_object(obj.blob.name)
+        except ClientError:
+            return None
+    else:
+        obj.size, obj.checksum = header.file_size, header.etag
+        obj.dimensions, obj.voxel_size = header.dimensions, header.voxel_size
+
+    return obj
+
+
+@click.command()
+@click.option('--concurrency', default=16, show_default=True, help='The number of parallel reads.')
+@click.option(
+    '--chunk-size', default=1000, show_default=True, help='The number of rows per update.'
+)
+def command(concurrency: int, chunk_size: int) -> None:
+    """Record the size, checksum, shape and spacing of every blob which is missing them."""
+    model: Type[models.Model]
+    with ThreadPoolExecutor(concurrency) as executor:
+        for model in [Image, PreprocessedImage]:
+            # Sparse feature images may have no blob
+            queryset = model.objects.filter(size__isnull=True).exclude(blob='').order_by('pk')
+            updated = missing = 0
+            last_pk = 0
+            while True:
+                # Page by primary key, since rows which can't be read are never updated
+                chunk: List[BlobModel] = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+                if not chunk:
+                    break
+                last_pk = chunk[-1].pk
+
+                filled = [obj for obj in executor.map(_fill, chunk) if obj is not None]
+                with transaction.atomic():
+                    model.objects.bulk_update(
+                        filled, ['size', 'checksum', 'dimensions', 'voxel_size']
+                    )
+                    if model is Image:
+                        reference_blobs(filled)
+                updated += len(filled)
+                missing += len(chunk) - len(filled)
+
+            click.echo(f'{model.__name__}: updated {updated}, {missing} blob(s) not found')
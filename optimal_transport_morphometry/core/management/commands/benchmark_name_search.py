@@ -0,0 +1,70 @@
+import statistics
+import time
+from typing import List
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+import djclick as click
+
+from optimal_transport_morphometry.core.models import Dataset, PendingUpload, UploadBatch
+from optimal_transport_morphometry.core.search import search_by_name, trigram_search_available
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _time_query(queryset, repeat: int) -> List[float]:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        list(queryset[:100])
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return timings
+
+
+@click.command()
+@click.option('--count', default=1_000_000, help='The number of pending uploads to generate.')
+@click.option('--repeat', default=20, help='The number of times to run each query.')
+@click.option('--explain', is_flag=True, help='Print the query plan of each search.')
+def command(count: int, repeat: int, explain: bool) -> None:
+    """Time pending upload name searches against a large, temporary upload batch."""
+    click.echo(f'pg_trgm available: {trigram_search_available()}')
+
+    # All generated data is rolled back once the benchmark completes
+    try:
+        with transaction.atomic():
+            owner = User.objects.create(username='benchmark_name_search')
+            dataset = Dataset.objects.create(name='benchmark_name_search', owner=owner)
+            batch = UploadBatch.objects.create(dataset=dataset)
+
+            click.echo(f'Generating {count} pending uploads...')
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {PendingUpload._meta.db_table} (batch_id, name, metadata) '
+                    "SELECT %s, 'OAS1_' || lpad(n::text, 7, '0') || '_MR1_mpr-1_anon.nii', '{}' "
+                    'FROM generate_series(1, %s) AS n',
+                    [batch.id, count],
+                )
+                cursor.execute(f'ANALYZE {PendingUpload._meta.db_table}')
+
+            # A selective match, a broad match, and a misspelled name
+            queries = [str(count // 2).zfill(7), '_MR1_', 'OAS1_00012345_MR1']
+            for ranked in [False, True]:
+                for query in queries:
+                    queryset = search_by_name(
+                        PendingUpload.objects.filter(batch_id=batch.id), query, ranked=ranked
+                    )
+                    if explain:
+                        click.echo(queryset[:100].explain(analyze=True))
+
+                    timings = _time_query(queryset, repeat)
+                    click.echo(
+                        f'ranked={ranked!s:<5} query={query!r:<22} '
+                        f'median={statistics.median(timings):.2f}ms max={max(timings):.2f}ms'
+                    )
+
+            raise _Rollback()
+    except _Rollback:
+        pass
@@ -0,0 +1,25 @@
+import datetime
+
+import djclick as click
+
+from optimal_transport_morphometry.core.garbage import DEFAULT_GRACE_PERIOD, collect_garbage
+
+
+@click.command()
+@click.option('--dry-run', is_flag=True, help='Only report objects that would be deleted.')
+@click.option(
+    '--grace-period',
+    type=float,
+    default=DEFAULT_GRACE_PERIOD.total_seconds() / 3600,
+    show_default=True,
+    help='Hours during which new objects are never deleted.',
+)
+def command(dry_run: bool, grace_period: float) -> None:
+    """Delete objects and uploads in storage which aren't referenced by the database."""
+    result = collect_garbage(datetime.timedelta(hours=grace_period), dry_run=dry_run)
+    action = 'Would delete' if dry_run else 'Deleted'
+    click.echo(
+        f'Scanned {result.scanned} object(s). '
+        f'{action} {result.deleted} orphan(s), totalling {result.deleted_bytes} bytes, '
+        f'and {result.aborted_uploads} abandoned upload(s).'
+    )
@@ -42,7 +42,7 @@ def command(zip_filename: click.Path, email: str, dataset_name: str) -> None:
     # Set current preprocessing batch and analysis result
     dataset.current_preprocessing_batch = batch
     dataset.current_analysis_result = analysis
-    dataset.save()
+    dataset.save(update_fields=['current_preprocessing_batch', 'current_analysis_result'])
 
     # Zip file
     with open(zip_filename, 'rb') as f:
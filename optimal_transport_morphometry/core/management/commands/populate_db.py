@@ -5,16 +5,22 @@ from click import ClickException
 from django.contrib.auth.models import User
 from django.core.files import File
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db.models import F
 import djclick as click
 
 from optimal_transport_morphometry.core.batch_parser import load_batch_from_csv
 from optimal_transport_morphometry.core.models import (
     Atlas,
+    CovariateValue,
     Dataset,
     Image,
     PendingUpload,
     UploadBatch,
 )
+from optimal_transport_morphometry.core.models.covariate import (
+    dataset_covariates,
+    image_covariate_values,
+)
 
 root_dir = Path(__file__).parents[4]
 images_dir = root_dir / 'sample_data' / 'images'
@@ -50,17 +56,20 @@ def command(csv: TextIO, email: str, dataset_name: str, clear: bool, include_ima
     if include_images:
         print('Uploading corresponding images...')
         uploads: List[PendingUpload] = list(batch.pending_uploads.all())
+        covariates = dataset_covariates(dataset)
         images: List[Image] = []
+        covariate_values: List[CovariateValue] = []
         for upload in uploads:
             with open(images_dir / upload.name, 'rb') as file_contents:
-                images.append(
-                    Image(
-                        name=upload.name,
-                        dataset=batch.dataset,
-                        metadata=upload.metadata,
-                        blob=SimpleUploadedFile(name=upload.name, content=file_contents.read()),
-                    )
+                image = Image(
+                    name=upload.name,
+                    dataset=batch.dataset,
+                    blob=SimpleUploadedFile(name=upload.name, content=file_contents.read()),
                 )
+                covariate_values.extend(image_covariate_values(image, upload.metadata, covariates))
+                images.append(image)
 
-        # Create all at once
+        # Create all at once, and update the count since bulk_create bypasses signals
         Image.objects.bulk_create(images)
+        CovariateValue.objects.bulk_create(covariate_values)
+        Dataset.objects.filter(pk=dataset.pk).update(image_count=F('image_count') + len(images))
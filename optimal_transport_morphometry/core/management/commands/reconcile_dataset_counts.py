@@ -0,0 +1,59 @@
+from django.db.models import Count, Exists, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import djclick as click
+
+from optimal_transport_morphometry.core.models import Dataset, Image, UploadBatch
+
+
+@click.command()
+@click.option('--dry-run', is_flag=True, help='Only report datasets that have drifted.')
+def command(dry_run: bool) -> None:
+    # Compute the true values in the database, rather than iterating over datasets
+    image_count = Coalesce(
+        Subquery(
+            Image.objects.filter(dataset_id=OuterRef('pk'))
+            .order_by()
+            .values('dataset_id')
+            .annotate(count=Count('pk'))
+            .values('count')
+        ),
+        0,
+    )
+    uploads_active = Exists(UploadBatch.objects.filter(dataset_id=OuterRef('pk')))
+
+    # Find any datasets whose stored values don't match
+    drifted = list(
+        Dataset.objects.annotate(
+            actual_image_count=image_count, actual_uploads_active=uploads_active
+        )
+        .exclude(
+            image_count=F('actual_image_count'),
+            uploads_active=F('actual_uploads_active'),
+        )
+        .values_list(
+            'id',
+            'name',
+            'image_count',
+            'actual_image_count',
+            'uploads_active',
+            'actual_uploads_active',
+        )
+    )
+    for dataset_id, name, *counts in drifted:
+        stored_images, actual_images, stored_uploads, actual_uploads = counts
+        changes = []
+        if stored_images != actual_images:
+            changes.append(f'image_count {stored_images} -> {actual_images}')
+        if stored_uploads != actual_uploads:
+            changes.append(f'uploads_active {stored_uploads} -> {actual_uploads}')
+        click.echo(f'Dataset {dataset_id} ({name}): {", ".join(changes)}')
+
+    if dry_run or not drifted:
+        click.echo(f'{len(drifted)} dataset(s) drifted')
+        return
+
+    # Fix all drifted datasets in a single statement
+    updated = Dataset.objects.filter(id__in=[row[0] for row in drifted]).update(
+        image_count=image_count, uploads_active=uploads_active
+    )
+    click.echo(f'Reconciled {updated} dataset(s)')
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-19 12:55
+
+from django.db import migrations, models
+from django.db.models import Count, Exists, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_dataset_counts(apps, schema_editor):
+    Dataset = apps.get_model('core', 'Dataset')
+    Image = apps.get_model('core', 'Image')
+    UploadBatch = apps.get_model('core', 'UploadBatch')
+
+    image_count = (
+        Image.objects.filter(dataset_id=OuterRef('pk'))
+        .order_by()
+        .values('dataset_id')
+        .annotate(count=Count('pk'))
+        .values('count')
+    )
+    Dataset.objects.update(
+        image_count=Coalesce(Subquery(image_count), 0),
+        uploads_active=Exists(UploadBatch.objects.filter(dataset_id=OuterRef('pk'))),
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0021_auto_20220926_1930'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='image_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='dataset',
+            name='uploads_active',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(populate_dataset_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+from django.db import DatabaseError, migrations, transaction
+
+# These match the expression Django generates for `name__icontains` (UPPER("name"::text) LIKE ...),
+# so both substring and trigram similarity searches can be served by them
+TRIGRAM_INDEXES = {
+    'core_dataset_name_trgm': 'core_dataset',
+    'core_pendingupload_name_trgm': 'core_pendingupload',
+}
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # The pg_trgm extension may not be available (or creatable) in every deployment.
+    # In that case, skip creating the indexes, and name searches will fall back to a scan.
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT EXISTS(SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm')"
+        )
+        if not cursor.fetchone()[0]:
+            return
+
+        try:
+            with transaction.atomic(using=schema_editor.connection.alias):
+                cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        except DatabaseError:
+            return
+
+        for index_name, table in TRIGRAM_INDEXES.items():
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {index_name} '
+                f'ON {table} USING gin (UPPER(name::text) gin_trgm_ops)'
+            )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for index_name in TRIGRAM_INDEXES:
+            cursor.execute(f'DROP INDEX IF EXISTS {index_name}')
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0022_dataset_image_count_uploads_active'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
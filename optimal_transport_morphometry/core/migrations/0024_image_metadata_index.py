@@ -0,0 +1,53 @@
+# Generated by Django 3.2.25 on 2026-10-19 12:58
+
+import re
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+INTEGER_RE = re.compile(r'-?(0|[1-9]\d*)')
+FLOAT_RE = re.compile(r'-?(\d+\.\d*|\.\d+)([eE][-+]?\d+)?|-?\d+[eE][-+]?\d+')
+
+
+def parse_value(val):
+    if not isinstance(val, str):
+        return val
+
+    stripped = val.strip()
+    if INTEGER_RE.fullmatch(stripped):
+        return int(stripped)
+    if FLOAT_RE.fullmatch(stripped):
+        return float(stripped)
+
+    return val
+
+
+def type_metadata_values(apps, schema_editor):
+    # Previously, all CSV values were stored as strings
+    for model_name in ['Image', 'PendingUpload']:
+        Model = apps.get_model('core', model_name)
+
+        changed = []
+        for obj in Model.objects.only('id', 'metadata').iterator(chunk_size=1000):
+            metadata = {key: parse_value(val) for key, val in obj.metadata.items()}
+            if metadata != obj.metadata:
+                obj.metadata = metadata
+                changed.append(obj)
+
+        Model.objects.bulk_update(changed, ['metadata'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0023_name_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(type_metadata_values, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='image',
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=['metadata'], name='core_image_metadata_gin', opclasses=['jsonb_path_ops']
+            ),
+        ),
+    ]
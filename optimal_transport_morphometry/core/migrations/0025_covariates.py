@@ -0,0 +1,183 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:04
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def _is_number(val):
+    return isinstance(val, (int, float)) and not isinstance(val, bool)
+
+
+def _is_value(val):
+    return val not in (None, '') and not isinstance(val, (bool, dict, list))
+
+
+def _infer_type(values):
+    if all(isinstance(val, int) and _is_number(val) for val in values):
+        return 'int'
+    if all(_is_number(val) for val in values):
+        return 'float'
+
+    return 'category'
+
+
+def move_metadata_to_covariates(apps, schema_editor):
+    Covariate = apps.get_model('core', 'Covariate')
+    CovariateValue = apps.get_model('core', 'CovariateValue')
+    Dataset = apps.get_model('core', 'Dataset')
+    Image = apps.get_model('core', 'Image')
+
+    for dataset in Dataset.objects.iterator():
+        images = list(Image.objects.filter(dataset=dataset).only('id', 'metadata'))
+
+        # Gather non-empty values by column
+        columns = {}
+        for image in images:
+            for key, val in image.metadata.items():
+                if _is_value(val):
+                    columns.setdefault(key, []).append(val)
+
+        covariates = {}
+        for name, values in columns.items():
+            type = _infer_type(values)
+            categories = list(dict.fromkeys(map(str, values))) if type == 'category' else []
+            covariates[name] = Covariate.objects.create(
+                dataset=dataset, name=name, type=type, categories=categories
+            )
+
+        covariate_values = []
+        for image in images:
+            remaining = {}
+            for key, val in image.metadata.items():
+                covariate = covariates.get(key)
+                if covariate is None or not _is_value(val):
+                    if covariate is None or val not in (None, ''):
+                        remaining[key] = val
+                    continue
+
+                if covariate.type == 'category':
+                    encoded = float(covariate.categories.index(str(val)))
+                else:
+                    encoded = float(val)
+                covariate_values.append(
+                    CovariateValue(image=image, covariate=covariate, value=encoded)
+                )
+
+            image.metadata = remaining
+
+        Image.objects.bulk_update(images, ['metadata'], batch_size=1000)
+        CovariateValue.objects.bulk_create(covariate_values, batch_size=1000)
+
+
+def move_covariates_to_metadata(apps, schema_editor):
+    CovariateValue = apps.get_model('core', 'CovariateValue')
+    Image = apps.get_model('core', 'Image')
+
+    images = {}
+    for value in CovariateValue.objects.select_related('image', 'covariate').iterator():
+        image = images.setdefault(value.image_id, value.image)
+        covariate = value.covariate
+        if covariate.type == 'category':
+            image.metadata[covariate.name] = covariate.categories[int(value.value)]
+        elif covariate.type == 'int':
+            image.metadata[covariate.name] = int(value.value)
+        else:
+            image.metadata[covariate.name] = value.value
+
+    Image.objects.bulk_update(images.values(), ['metadata'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0024_image_metadata_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Covariate',
+            fields=[
+                (
+                    'id',
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name='ID'
+                    ),
+                ),
+                ('name', models.CharField(max_length=255)),
+                (
+                    'type',
+                    models.CharField(
+                        choices=[('int', 'Integer'), ('float', 'Float'), ('category', 'Category')],
+                        max_length=16,
+                    ),
+                ),
+                (
+                    'categories',
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.CharField(max_length=255),
+                        blank=True,
+                        default=list,
+                        size=None,
+                    ),
+                ),
+                (
+                    'dataset',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='covariates',
+                        to='core.dataset',
+                    ),
+                ),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='CovariateValue',
+            fields=[
+                (
+                    'id',
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name='ID'
+                    ),
+                ),
+                ('value', models.FloatField()),
+                (
+                    'covariate',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='values',
+                        to='core.covariate',
+                    ),
+                ),
+                (
+                    'image',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='covariate_values',
+                        to='core.image',
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='covariatevalue',
+            index=models.Index(
+                fields=['covariate', 'value'], name='core_covari_covaria_b58f36_idx'
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name='covariatevalue',
+            constraint=models.UniqueConstraint(
+                fields=('image', 'covariate'), name='unique_image_covariate'
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name='covariate',
+            constraint=models.UniqueConstraint(
+                fields=('dataset', 'name'), name='unique_dataset_covariate_name'
+            ),
+        ),
+        migrations.RunPython(move_metadata_to_covariates, move_covariates_to_metadata),
+    ]
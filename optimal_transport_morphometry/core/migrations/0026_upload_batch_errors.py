@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0025_covariates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadbatch',
+            name='errors',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
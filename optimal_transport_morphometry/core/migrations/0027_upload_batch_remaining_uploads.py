@@ -0,0 +1,34 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:11
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_remaining_uploads(apps, schema_editor):
+    PendingUpload = apps.get_model('core', 'PendingUpload')
+    UploadBatch = apps.get_model('core', 'UploadBatch')
+
+    remaining_uploads = (
+        PendingUpload.objects.filter(batch_id=OuterRef('pk'))
+        .order_by()
+        .values('batch_id')
+        .annotate(count=Count('pk'))
+        .values('count')
+    )
+    UploadBatch.objects.update(remaining_uploads=Coalesce(Subquery(remaining_uploads), 0))
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0026_upload_batch_errors'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadbatch',
+            name='remaining_uploads',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_remaining_uploads, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0027_upload_batch_remaining_uploads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pendingupload',
+            name='object_key',
+            field=models.CharField(blank=True, max_length=2000),
+        ),
+        migrations.AddField(
+            model_name='pendingupload',
+            name='size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='pendingupload',
+            name='upload_id',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
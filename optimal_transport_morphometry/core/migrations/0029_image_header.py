@@ -0,0 +1,51 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:22
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0028_pending_upload_multipart'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='datatype',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='dimensions',
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.PositiveIntegerField(), blank=True, null=True, size=3
+            ),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='orientation',
+            field=models.CharField(blank=True, default='', max_length=3),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='validation_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='validation_status',
+            field=models.CharField(
+                choices=[('Pending', 'Pending'), ('Valid', 'Valid'), ('Invalid', 'Invalid')],
+                default='Pending',
+                max_length=32,
+            ),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='voxel_size',
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.FloatField(), blank=True, null=True, size=3
+            ),
+        ),
+    ]
@@ -0,0 +1,119 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:25
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0029_image_header'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='featureimage',
+            name='checksum',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='featureimage',
+            name='dimensions',
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.PositiveIntegerField(), blank=True, null=True, size=3
+            ),
+        ),
+        migrations.AddField(
+            model_name='featureimage',
+            name='size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='featureimage',
+            name='voxel_size',
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.FloatField(), blank=True, null=True, size=3
+            ),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='checksum',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='jacobianimage',
+            name='checksum',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='jacobianimage',
+            name='dimensions',
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.PositiveIntegerField(), blank=True, null=True, size=3
+            ),
+        ),
+        migrations.AddField(
+            model_name='jacobianimage',
+            name='size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='jacobianimage',
+            name='voxel_size',
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.FloatField(), blank=True, null=True, size=3
+            ),
+        ),
+        migrations.AddField(
+            model_name='registeredimage',
+            name='checksum',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='registeredimage',
+            name='dimensions',
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.PositiveIntegerField(), blank=True, null=True, size=3
+            ),
+        ),
+        migrations.AddField(
+            model_name='registeredimage',
+            name='size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='registeredimage',
+            name='voxel_size',
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.FloatField(), blank=True, null=True, size=3
+            ),
+        ),
+        migrations.AddField(
+            model_name='segmentedimage',
+            name='checksum',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='segmentedimage',
+            name='dimensions',
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.PositiveIntegerField(), blank=True, null=True, size=3
+            ),
+        ),
+        migrations.AddField(
+            model_name='segmentedimage',
+            name='size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='segmentedimage',
+            name='voxel_size',
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.FloatField(), blank=True, null=True, size=3
+            ),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0030_blob_info'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                (
+                    'id',
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name='ID'
+                    ),
+                ),
+                ('checksum', models.CharField(max_length=64, unique=True)),
+                ('key', models.CharField(max_length=2000, unique=True)),
+                ('size', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,97 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:35
+
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef
+import django.db.models.deletion
+
+PREPROCESSED_MODELS = ['FeatureImage', 'JacobianImage', 'RegisteredImage', 'SegmentedImage']
+
+
+def delete_duplicates(apps, schema_editor):
+    # Retried tasks may have saved an output more than once, so keep only the newest of each
+    for model_name in PREPROCESSED_MODELS:
+        Model = apps.get_model('core', model_name)
+        newer = Model.objects.filter(
+            preprocessing_batch_id=OuterRef('preprocessing_batch_id'),
+            source_image_id=OuterRef('source_image_id'),
+            pk__gt=OuterRef('pk'),
+        )
+        Model.objects.filter(Exists(newer)).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0031_blob'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='featureimage',
+            name='preprocessing_batch',
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='core_featureimage',
+                to='core.preprocessingbatch',
+            ),
+        ),
+        migrations.AlterField(
+            model_name='jacobianimage',
+            name='preprocessing_batch',
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='core_jacobianimage',
+                to='core.preprocessingbatch',
+            ),
+        ),
+        migrations.AlterField(
+            model_name='registeredimage',
+            name='preprocessing_batch',
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='core_registeredimage',
+                to='core.preprocessingbatch',
+            ),
+        ),
+        migrations.AlterField(
+            model_name='segmentedimage',
+            name='preprocessing_batch',
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='core_segmentedimage',
+                to='core.preprocessingbatch',
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name='featureimage',
+            constraint=models.UniqueConstraint(
+                fields=('preprocessing_batch', 'source_image'),
+                name='core_featureimage_unique_batch_source',
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name='jacobianimage',
+            constraint=models.UniqueConstraint(
+                fields=('preprocessing_batch', 'source_image'),
+                name='core_jacobianimage_unique_batch_source',
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name='registeredimage',
+            constraint=models.UniqueConstraint(
+                fields=('preprocessing_batch', 'source_image'),
+                name='core_registeredimage_unique_batch_source',
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name='segmentedimage',
+            constraint=models.UniqueConstraint(
+                fields=('preprocessing_batch', 'source_image'),
+                name='core_segmentedimage_unique_batch_source',
+            ),
+        ),
+    ]
@@ -0,0 +1,194 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:38
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+import s3_file_field.fields
+
+COLUMNS = (
+    'created, modified, blob, source_image_id, preprocessing_batch_id, size, checksum, '
+    'dimensions, voxel_size'
+)
+
+# The values of per-kind attributes, for the kinds without them
+ATTRIBUTE_DEFAULTS = {'downsample_factor': 'NULL', 'registration_type': "''"}
+
+# The values of per-kind attributes when they're restored, for rows where they're blank, as the
+# defaults of the old tables
+RESTORED_DEFAULTS = {'registration_type': "'affine'"}
+
+# The kind of each old table's images, and its own attributes
+TABLES = [
+    ('core_featureimage', 'feature', ['downsample_factor']),
+    ('core_jacobianimage', 'jacobian', []),
+    ('core_registeredimage', 'registered', ['registration_type']),
+    ('core_segmentedimage', 'segmented', []),
+]
+
+
+def copy_images_sql(table: str, kind: str, attributes: list) -> str:
+    values = [
+        attribute if attribute in attributes else default
+        for attribute, default in ATTRIBUTE_DEFAULTS.items()
+    ]
+    return (
+        f'INSERT INTO core_preprocessedimage ({COLUMNS}, kind, {", ".join(ATTRIBUTE_DEFAULTS)}) '
+        f"SELECT {COLUMNS}, '{kind}', {', '.join(values)} FROM {table}"
+    )
+
+
+def restore_images_sql(table: str, kind: str, attributes: list) -> str:
+    values = [
+        (
+            f"COALESCE(NULLIF({attribute}, ''), {RESTORED_DEFAULTS[attribute]})"
+            if attribute in RESTORED_DEFAULTS
+            else attribute
+        )
+        for attribute in attributes
+    ]
+    return (
+        f'INSERT INTO {table} ({", ".join([COLUMNS] + attributes)}) '
+        f"SELECT {', '.join([COLUMNS] + values)} FROM core_preprocessedimage WHERE kind = '{kind}'"
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0032_preprocessed_batch_source'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PreprocessedImage',
+            fields=[
+                (
+                    'id',
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name='ID'
+                    ),
+                ),
+                (
+                    'created',
+                    django_extensions.db.fields.CreationDateTimeField(
+                        auto_now_add=True, verbose_name='created'
+                    ),
+                ),
+                (
+                    'modified',
+                    django_extensions.db.fields.ModificationDateTimeField(
+                        auto_now=True, verbose_name='modified'
+                    ),
+                ),
+                (
+                    'kind',
+                    models.CharField(
+                        choices=[
+                            ('registered', 'Registered'),
+                            ('jacobian', 'Jacobian'),
+                            ('segmented', 'Segmented'),
+                            ('feature', 'Feature'),
+                        ],
+                        max_length=32,
+                    ),
+                ),
+                ('blob', s3_file_field.fields.S3FileField()),
+                ('size', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('checksum', models.CharField(blank=True, default='', max_length=64)),
+                (
+                    'dimensions',
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.PositiveIntegerField(), blank=True, null=True, size=3
+                    ),
+                ),
+                (
+                    'voxel_size',
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.FloatField(), blank=True, null=True, size=3
+                    ),
+                ),
+                ('downsample_factor', models.FloatField(blank=True, null=True)),
+                ('registration_type', models.CharField(blank=True, default='', max_length=100)),
+                (
+                    'preprocessing_batch',
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='preprocessed_images',
+                        to='core.preprocessingbatch',
+                    ),
+                ),
+                (
+                    'source_image',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='preprocessed_images',
+                        to='core.image',
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunSQL(
+            [copy_images_sql(*table) for table in TABLES],
+            [restore_images_sql(*table) for table in TABLES],
+        ),
+        migrations.DeleteModel(
+            name='FeatureImage',
+        ),
+        migrations.DeleteModel(
+            name='JacobianImage',
+        ),
+        migrations.DeleteModel(
+            name='RegisteredImage',
+        ),
+        migrations.DeleteModel(
+            name='SegmentedImage',
+        ),
+        migrations.AddConstraint(
+            model_name='preprocessedimage',
+            constraint=models.UniqueConstraint(
+                fields=('preprocessing_batch', 'source_image', 'kind'),
+                name='unique_preprocessed_image',
+            ),
+        ),
+        migrations.CreateModel(
+            name='FeatureImage',
+            fields=[],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('core.preprocessedimage',),
+        ),
+        migrations.CreateModel(
+            name='JacobianImage',
+            fields=[],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('core.preprocessedimage',),
+        ),
+        migrations.CreateModel(
+            name='RegisteredImage',
+            fields=[],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('core.preprocessedimage',),
+        ),
+        migrations.CreateModel(
+            name='SegmentedImage',
+            fields=[],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('core.preprocessedimage',),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0033_preprocessed_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='preprocessedimage',
+            name='registration_parameters',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='preprocessedimage',
+            name='registration_runtime',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='preprocessingbatch',
+            name='registration_profile',
+            field=models.CharField(
+                choices=[
+                    ('fast_affine', 'Fast affine'),
+                    ('rigid_affine', 'Rigid and affine'),
+                    ('syn', 'Full SyN'),
+                ],
+                default='syn',
+                max_length=32,
+            ),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+import s3_file_field.fields
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0034_registration_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='preprocessedimage',
+            name='affine_transform',
+            field=s3_file_field.fields.S3FileField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='preprocessedimage',
+            name='inverse_warp_transform',
+            field=s3_file_field.fields.S3FileField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='preprocessedimage',
+            name='warp_transform',
+            field=s3_file_field.fields.S3FileField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='preprocessingbatch',
+            name='derived_from',
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name='derived_batches',
+                to='core.preprocessingbatch',
+            ),
+        ),
+        migrations.AddField(
+            model_name='preprocessingbatch',
+            name='downsample_factor',
+            field=models.FloatField(default=3.0),
+        ),
+    ]
@@ -0,0 +1,98 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:48
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+from optimal_transport_morphometry.core.models.preprocessing import (
+    default_downsample_factors,
+    default_feature_tissues,
+)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0035_registration_transforms'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='preprocessedimage',
+            name='unique_preprocessed_image',
+        ),
+        migrations.AddField(
+            model_name='preprocessedimage',
+            name='tissue',
+            field=models.CharField(
+                blank=True,
+                choices=[('csf', 'CSF'), ('grey', 'Grey matter'), ('white', 'White matter')],
+                default='',
+                max_length=16,
+            ),
+        ),
+        migrations.AddField(
+            model_name='preprocessingbatch',
+            name='downsample_factors',
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.FloatField(),
+                default=default_downsample_factors,
+                size=None,
+            ),
+        ),
+        migrations.AddField(
+            model_name='preprocessingbatch',
+            name='feature_tissues',
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.CharField(
+                    choices=[('csf', 'CSF'), ('grey', 'Grey matter'), ('white', 'White matter')],
+                    max_length=16,
+                ),
+                default=default_feature_tissues,
+                size=None,
+            ),
+        ),
+        migrations.AddField(
+            model_name='preprocessingbatch',
+            name='modulated',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.RunSQL(
+            [
+                'UPDATE core_preprocessingbatch SET downsample_factors = ARRAY[downsample_factor]',
+                "UPDATE core_preprocessedimage SET tissue = 'grey' WHERE kind = 'feature'",
+                'UPDATE core_preprocessedimage SET downsample_factor = 1.0'
+                ' WHERE downsample_factor IS NULL',
+            ],
+            [
+                'UPDATE core_preprocessingbatch SET downsample_factor = downsample_factors[1]',
+                # Only the feature images of the first tissue and downsample factor are kept
+                'DELETE FROM core_preprocessedimage AS image USING core_preprocessingbatch AS batch'
+                " WHERE image.preprocessing_batch_id = batch.id AND image.kind = 'feature'"
+                ' AND (image.tissue != batch.feature_tissues[1]'
+                ' OR image.downsample_factor != batch.downsample_factors[1])',
+                'UPDATE core_preprocessedimage SET downsample_factor = NULL'
+                " WHERE kind != 'feature'",
+            ],
+        ),
+        migrations.RemoveField(
+            model_name='preprocessingbatch',
+            name='downsample_factor',
+        ),
+        migrations.AlterField(
+            model_name='preprocessedimage',
+            name='downsample_factor',
+            field=models.FloatField(default=1.0),
+        ),
+        migrations.AddConstraint(
+            model_name='preprocessedimage',
+            constraint=models.UniqueConstraint(
+                fields=(
+                    'preprocessing_batch',
+                    'source_image',
+                    'kind',
+                    'tissue',
+                    'downsample_factor',
+                ),
+                name='unique_preprocessed_image',
+            ),
+        ),
+    ]
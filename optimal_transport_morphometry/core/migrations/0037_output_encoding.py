@@ -0,0 +1,46 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:53
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0036_feature_tissues'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='preprocessingbatch',
+            name='compression_level',
+            field=models.PositiveSmallIntegerField(
+                default=6,
+                validators=[
+                    django.core.validators.MinValueValidator(1),
+                    django.core.validators.MaxValueValidator(9),
+                ],
+            ),
+        ),
+        migrations.AddField(
+            model_name='preprocessingbatch',
+            name='output_codec',
+            field=models.CharField(
+                choices=[
+                    ('raw', 'Uncompressed'),
+                    ('gzip', 'Gzip'),
+                    ('pigz', 'Multi-threaded gzip'),
+                ],
+                default='gzip',
+                max_length=16,
+            ),
+        ),
+        migrations.AddField(
+            model_name='preprocessingbatch',
+            name='output_dtype',
+            field=models.CharField(
+                choices=[('float32', 'Float32'), ('float64', 'Float64')],
+                default='float32',
+                max_length=16,
+            ),
+        ),
+    ]
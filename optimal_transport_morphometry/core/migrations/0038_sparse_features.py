@@ -0,0 +1,91 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+import s3_file_field.fields
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0037_output_encoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='preprocessedimage',
+            name='values',
+            field=s3_file_field.fields.S3FileField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='preprocessingbatch',
+            name='feature_storage',
+            field=models.CharField(
+                choices=[
+                    ('dense', 'Dense volumes'),
+                    ('sparse', 'In-mask values'),
+                    ('both', 'Dense volumes and in-mask values'),
+                ],
+                default='dense',
+                max_length=16,
+            ),
+        ),
+        migrations.AlterField(
+            model_name='preprocessedimage',
+            name='blob',
+            field=s3_file_field.fields.S3FileField(blank=True),
+        ),
+        migrations.CreateModel(
+            name='FeatureMask',
+            fields=[
+                (
+                    'id',
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name='ID'
+                    ),
+                ),
+                (
+                    'created',
+                    django_extensions.db.fields.CreationDateTimeField(
+                        auto_now_add=True, verbose_name='created'
+                    ),
+                ),
+                (
+                    'modified',
+                    django_extensions.db.fields.ModificationDateTimeField(
+                        auto_now=True, verbose_name='modified'
+                    ),
+                ),
+                (
+                    'tissue',
+                    models.CharField(
+                        choices=[
+                            ('csf', 'CSF'),
+                            ('grey', 'Grey matter'),
+                            ('white', 'White matter'),
+                        ],
+                        max_length=16,
+                    ),
+                ),
+                ('downsample_factor', models.FloatField()),
+                ('blob', s3_file_field.fields.S3FileField()),
+                ('voxel_count', models.PositiveIntegerField()),
+                (
+                    'preprocessing_batch',
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='feature_masks',
+                        to='core.preprocessingbatch',
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='featuremask',
+            constraint=models.UniqueConstraint(
+                fields=('preprocessing_batch', 'tissue', 'downsample_factor'),
+                name='unique_feature_mask',
+            ),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:59
+
+from django.db import migrations, models
+import s3_file_field.fields
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0038_sparse_features'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='featuremask',
+            name='unique_feature_mask',
+        ),
+        migrations.AddField(
+            model_name='featuremask',
+            name='kind',
+            field=models.CharField(
+                choices=[
+                    ('support', 'Support'),
+                    ('union', 'Union'),
+                    ('intersection', 'Intersection'),
+                ],
+                default='support',
+                max_length=16,
+            ),
+        ),
+        migrations.AddField(
+            model_name='featuremask',
+            name='voxel_index',
+            field=s3_file_field.fields.S3FileField(blank=True),
+        ),
+        migrations.AddConstraint(
+            model_name='featuremask',
+            constraint=models.UniqueConstraint(
+                fields=('preprocessing_batch', 'kind', 'tissue', 'downsample_factor'),
+                name='unique_feature_mask',
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-19 14:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0039_feature_mask_kinds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisresult',
+            name='backend',
+            field=models.CharField(
+                choices=[
+                    ('utm', 'UTM (optimal transport, in R)'),
+                    ('vbm', 'Voxel-based morphometry only (in NumPy)'),
+                ],
+                default='utm',
+                max_length=16,
+            ),
+        ),
+    ]
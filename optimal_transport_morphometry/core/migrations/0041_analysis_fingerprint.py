@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-19 14:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0040_analysis_backend'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisresult',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+    ]
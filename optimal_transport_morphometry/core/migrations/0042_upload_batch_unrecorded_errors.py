@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 14:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0041_analysis_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadbatch',
+            name='unrecorded_errors',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
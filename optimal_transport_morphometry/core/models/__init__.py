@@ -1,12 +1,16 @@
 from .analysis import AnalysisResult
 from .atlas import Atlas
+from .blob import Blob
+from .covariate import Covariate, CovariateValue
 from .dataset import Dataset
 from .image import Image
 from .patient import Patient
 from .pending_upload import PendingUpload
 from .preprocessing import (
     FeatureImage,
+    FeatureMask,
     JacobianImage,
+    PreprocessedImage,
     PreprocessingBatch,
     RegisteredImage,
     SegmentedImage,
@@ -16,12 +20,17 @@ from .upload_batch import UploadBatch
 __all__ = [
     'AnalysisResult',
     'Atlas',
+    'Blob',
+    'Covariate',
+    'CovariateValue',
     'Dataset',
     'FeatureImage',
+    'FeatureMask',
     'JacobianImage',
     'Image',
     'Patient',
     'PendingUpload',
+    'PreprocessedImage',
     'PreprocessingBatch',
     'SegmentedImage',
     'RegisteredImage',
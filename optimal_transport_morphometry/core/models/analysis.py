@@ -12,11 +12,21 @@ class AnalysisResult(TimeStampedModel):
         FINISHED = 'Finished'
         FAILED = 'Failed'
 
+    class Backend(models.TextChoices):
+        UTM = 'utm', 'UTM (optimal transport, in R)'
+        VBM = 'vbm', 'Voxel-based morphometry only (in NumPy)'
+
     # The preprocessed images that this analysis was run on
     preprocessing_batch = models.ForeignKey(
         PreprocessingBatch, related_name='analysis_results', on_delete=models.CASCADE
     )
 
+    # What computes the analysis
+    backend = models.CharField(max_length=16, choices=Backend.choices, default=Backend.UTM)
+
+    # A hash of the inputs, and the version of the backend, which identical analyses share
+    fingerprint = models.CharField(max_length=64, blank=True, default='', db_index=True)
+
     # Resulting data
     zip_file = S3FileField(null=True, blank=True, default=None)
     data = models.JSONField(default=dict)
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+from collections import Counter
+from typing import TYPE_CHECKING, Dict, List
+
+from django.db import models, transaction
+from django.db.models.functions import Greatest
+
+from optimal_transport_morphometry.core.storage import delete_objects
+
+if TYPE_CHECKING:
+    from .image import Image
+
+
+class Blob(models.Model):
+    """
+    An object in storage, shared by every image with the same content.
+
+    Images are content-addressed by checksum, so the same scan uploaded to several datasets is
+    only stored once. The object is deleted once no image references it.
+    """
+
+    checksum = models.CharField(max_length=64, unique=True)
+    key = models.CharField(max_length=2000, unique=True)
+    size = models.PositiveBigIntegerField(null=True, blank=True)
+
+    # The number of images whose blob is this object
+    ref_count = models.PositiveIntegerField(default=0)
+
+
+def _count_expression(counts: Dict[str, int], field: str) -> models.Case:
+    return models.Case(
+        *[
+            models.When(**{field: value}, then=models.Value(count))
+            for value, count in counts.items()
+        ],
+        default=models.Value(0),
+    )
+
+
+@transaction.atomic
+def reference_blobs(images: List[Image]) -> None:
+    """
+    Point saved images at the existing object with the same checksum, if there is one.
+
+    Images which are the first with their checksum register their own object. Objects which are
+    duplicates of an existing one are deleted from storage once this is committed. Images without
+    a checksum are ignored, and remain the only reference to their object.
+    """
+    from .image import Image
+
+    images = [image for image in images if image.checksum]
+    if not images:
+        return
+
+    Blob.objects.bulk_create(
+        [Blob(checksum=image.checksum, key=image.blob.name, size=image.size) for image in images],
+        ignore_conflicts=True,
+    )
+
+    # Lock the blobs, so they can't be released while they're being referenced
+    checksums = {image.checksum for image in images}
+    blobs: Dict[str, Blob] = {
+        blob.checksum: blob
+        for blob in Blob.objects.select_for_update().filter(checksum__in=checksums).order_by('pk')
+    }
+
+    duplicate_keys = []
+    referenced: List[Image] = []
+    for image in images:
+        blob = blobs.get(image.checksum)
+        if blob is None:
+            # Released concurrently, so this image keeps its own object
+            continue
+        if image.blob.name != blob.key:
+            duplicate_keys.append(image.blob.name)
+            image.blob.name = blob.key
+        referenced.append(image)
+
+    counts = Counter(image.checksum for image in referenced)
+    Blob.objects.filter(checksum__in=counts).update(
+        ref_count=models.F('ref_count') + _count_expression(counts, 'checksum')
+    )
+    Image.objects.bulk_update(referenced, ['blob'])
+
+    if duplicate_keys:
+        transaction.on_commit(lambda: delete_objects(duplicate_keys))
+
+
+@transaction.atomic
+def release_blobs(keys: List[str]) -> None:
+    """
+    Release one reference to the object of each key, deleting objects which are unreferenced.
+
+    Keys which aren't a registered blob were only ever referenced once, so are always deleted.
+    Objects are deleted from storage once this is committed.
+    """
+    counts = Counter(key for key in keys if key)
+    if not counts:
+        return
+
+    registered = set(
+        Blob.objects.select_for_update().filter(key__in=counts).values_list('key', flat=True)
+    )
+    Blob.objects.filter(key__in=registered).update(
+        ref_count=Greatest(models.F('ref_count') - _count_expression(counts, 'key'), 0)
+    )
+
+    unreferenced_blobs = Blob.objects.filter(key__in=registered, ref_count=0)
+    unreferenced = [key for key in counts if key not in registered]
+    unreferenced += list(unreferenced_blobs.values_list('key', flat=True))
+    unreferenced_blobs.delete()
+
+    if unreferenced:
+        transaction.on_commit(lambda: delete_objects(unreferenced))
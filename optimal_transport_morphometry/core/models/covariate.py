@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.contrib.postgres.fields import ArrayField
+from django.db import models
+
+from .dataset import Dataset
+from .image import Image
+
+
+class Covariate(models.Model):
+    """A typed column of image metadata, shared by all images in a dataset."""
+
+    class Meta:
+        ordering = ['id']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['dataset', 'name'], name='unique_dataset_covariate_name'
+            )
+        ]
+
+    class Type(models.TextChoices):
+        INTEGER = 'int'
+        FLOAT = 'float'
+        CATEGORY = 'category'
+
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE, related_name='covariates')
+    name = models.CharField(max_length=255)
+    type = models.CharField(max_length=16, choices=Type.choices)
+
+    # Category values are stored as their index into this list
+    categories = ArrayField(models.CharField(max_length=255), default=list, blank=True)
+
+    @property
+    def numeric(self) -> bool:
+        return self.type != self.Type.CATEGORY
+
+    def category_codes(self) -> Dict[str, int]:
+        # Categories are only ever appended to, so a length check is enough to detect changes
+        codes = getattr(self, '_category_codes', None)
+        if codes is None or len(codes) != len(self.categories):
+            codes = self._category_codes = {label: i for i, label in enumerate(self.categories)}
+
+        return codes
+
+    def encode(self, value) -> Optional[float]:
+        """Return the stored representation of a value, or None if it can't be represented."""
+        if isinstance(value, bool) or value is None or value == '':
+            return None
+
+        if self.type == self.Type.CATEGORY:
+            code = self.category_codes().get(str(value))
+            return float(code) if code is not None else None
+
+        if not isinstance(value, (int, float)):
+            return None
+
+        return float(value)
+
+    def decode(self, value: float):
+        if self.type == self.Type.CATEGORY:
+            return self.categories[int(value)]
+        if self.type == self.Type.INTEGER:
+            return int(value)
+
+        return value
+
+
+class CovariateValue(models.Model):
+    """The value of a single covariate for a single image. Missing values have no row."""
+
+    class Meta:
+        indexes = [models.Index(fields=['covariate', 'value'])]
+        constraints = [
+            models.UniqueConstraint(fields=['image', 'covariate'], name='unique_image_covariate')
+        ]
+
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='covariate_values')
+    covariate = models.ForeignKey(Covariate, on_delete=models.CASCADE, related_name='values')
+    value = models.FloatField()
+
+
+def split_metadata(
+    metadata: dict, covariates: Dict[str, Covariate]
+) -> Tuple[List[Tuple[Covariate, float]], dict]:
+    """Split metadata into encoded covariate values, and any metadata that isn't a covariate."""
+    values = []
+    remaining = {}
+    for key, value in metadata.items():
+        covariate = covariates.get(key)
+        encoded = covariate.encode(value) if covariate is not None else None
+        if encoded is not None:
+            values.append((covariate, encoded))
+        elif covariate is None or value not in (None, ''):
+            remaining[key] = value
+
+    return values, remaining
+
+
+def dataset_covariates(dataset: Dataset) -> Dict[str, Covariate]:
+    return {covariate.name: covariate for covariate in dataset.covariates.all()}
+
+
+def image_covariate_values(
+    image: Image, metadata: dict, covariates: Dict[str, Covariate]
+) -> List[CovariateValue]:
+    """
+    Set an image's metadata to anything that isn't a covariate, returning its covariate values.
+
+    The returned values are unsaved, and should be created once the image itself is saved.
+    """
+    values, image.metadata = split_metadata(metadata, covariates)
+    return [
+        CovariateValue(image=image, covariate=covariate, value=val) for covariate, val in values
+    ]
+
+
+def design_matrix(dataset: Dataset, images: Iterable[Image]) -> Tuple[List[str], Dict[int, dict]]:
+    """
+    Return the columns and rows of metadata for the given images, keyed by image ID.
+
+    Covariate columns come first, in the order they were created, followed by any other
+    metadata keys. All covariate values are fetched in a single query.
+    """
+    covariates: Dict[int, Covariate] = {c.id: c for c in dataset.covariates.all()}
+    images = list(images)
+    rows = {image.id: dict(image.metadata) for image in images}
+
+    queryset = CovariateValue.objects.filter(image__in=images, covariate__in=list(covariates))
+    for image_id, covariate_id, value in queryset.values_list('image_id', 'covariate_id', 'value'):
+        covariate = covariates[covariate_id]
+        rows[image_id][covariate.name] = covariate.decode(value)
+
+    columns = [c.name for c in covariates.values()]
+    for row in rows.values():
+        columns.extend(key for key in row if key not in columns)
+
+    return columns, rows
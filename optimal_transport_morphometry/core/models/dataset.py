@@ -22,6 +22,11 @@ class Dataset(TimeStampedModel, models.Model):
         'AnalysisResult', on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
     )
 
+    # Denormalized from images and upload batches, kept up to date by signals.
+    # Use the `reconcile_dataset_counts` management command to correct any drift.
+    image_count = models.PositiveIntegerField(default=0)
+    uploads_active = models.BooleanField(default=False)
+
     class Meta:
         permissions = (('collaborator', 'Collaborator'),)
         constraints = [
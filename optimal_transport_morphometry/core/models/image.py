@@ -1,11 +1,14 @@
 from enum import Enum
 from typing import Type
 
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
 from django.dispatch import receiver
 from django_extensions.db.models import TimeStampedModel
 from s3_file_field import S3FileField
 
+from .blob import release_blobs
 from .dataset import Dataset
 from .metadata import MetadataField
 
@@ -16,24 +19,69 @@ class ImageType(Enum):
 
 class Image(TimeStampedModel, models.Model):
     class Meta:
-        indexes = [models.Index(fields=['dataset'])]
+        indexes = [
+            models.Index(fields=['dataset']),
+            # Serves metadata equality and IN filters, which are jsonpath predicates (@@). The
+            # jsonb_path_ops opclass supports @@, but only extracts keys from equality checks, so
+            # range filters scan the whole index.
+            GinIndex(
+                fields=['metadata'], opclasses=['jsonb_path_ops'], name='core_image_metadata_gin'
+            ),
+        ]
         ordering = ['name']
         constraints = [
             models.UniqueConstraint(fields=['dataset', 'name'], name='unique_dataset_image_name'),
         ]
 
+    class ValidationStatus(models.TextChoices):
+        PENDING = 'Pending'
+        VALID = 'Valid'
+        INVALID = 'Invalid'
+
     name = models.CharField(max_length=255)
     type = models.CharField(max_length=100, default=ImageType.structural_mri)
     blob = S3FileField()
     dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE, related_name='images')
     metadata = MetadataField()
 
+    # The size and ETag of the blob, recorded once it's written, so storage isn't queried for them
+    size = models.PositiveBigIntegerField(null=True, blank=True)
+    checksum = models.CharField(max_length=64, blank=True, default='')
+
+    # Set from the NIfTI header once uploaded. Invalid images are excluded from preprocessing.
+    validation_status = models.CharField(
+        max_length=32, choices=ValidationStatus.choices, default=ValidationStatus.PENDING
+    )
+    validation_error = models.TextField(blank=True, default='')
+    dimensions = ArrayField(models.PositiveIntegerField(), size=3, null=True, blank=True)
+    voxel_size = ArrayField(models.FloatField(), size=3, null=True, blank=True)
+    datatype = models.CharField(max_length=32, blank=True, default='')
+    orientation = models.CharField(max_length=3, blank=True, default='')
+
     @property
-    def size(self) -> int:
-        return self.blob.size
+    def all_metadata(self) -> dict:
+        """Return this image's metadata, including its covariate values."""
+        covariate_values = {
+            value.covariate.name: value.covariate.decode(value.value)
+            for value in self.covariate_values.all()
+        }
+        return {**self.metadata, **covariate_values}
+
+
+@receiver(models.signals.post_save, sender=Image)
+def _image_save(sender: Type[Image], instance: Image, created: bool, **kwargs):
+    if created:
+        Dataset.objects.filter(pk=instance.dataset_id).update(
+            image_count=models.F('image_count') + 1
+        )
 
 
 @receiver(models.signals.post_delete, sender=Image)
 def _image_delete(sender: Type[Image], instance: Image, *args, **kwargs):
-    # TODO delete blob from storage, or write a need-to-delete record to DB
-    pass
+    # Guard against going negative if the count has drifted
+    Dataset.objects.filter(pk=instance.dataset_id, image_count__gt=0).update(
+        image_count=models.F('image_count') - 1
+    )
+
+    # Objects are shared by every image with the same content, so are only deleted once unreferenced
+    release_blobs([instance.blob.name])
@@ -1,12 +1,40 @@
+import math
+import re
+
 from django.core.exceptions import ValidationError
 from django.db import models
 
+# Values with leading zeros (e.g. subject IDs) are intentionally left as strings
+_INTEGER_RE = re.compile(r'-?(0|[1-9]\d*)')
+_FLOAT_RE = re.compile(r'-?(\d+\.\d*|\.\d+)([eE][-+]?\d+)?|-?\d+[eE][-+]?\d+')
+
 
 def validate_metadata(val) -> None:
     if not isinstance(val, dict):
         raise ValidationError('Must be a JSON Object.')
 
 
+def parse_metadata_value(val):
+    """
+    Return a raw (e.g. CSV) metadata value as an int or float, if it represents one.
+
+    Values which overflow a float (e.g. `1e400`) are left as strings, since infinity can't be
+    stored in JSON.
+    """
+    if not isinstance(val, str):
+        return val
+
+    stripped = val.strip()
+    if _INTEGER_RE.fullmatch(stripped):
+        return int(stripped)
+    if _FLOAT_RE.fullmatch(stripped):
+        number = float(stripped)
+        if math.isfinite(number):
+            return number
+
+    return val
+
+
 class MetadataField(models.JSONField):
     empty_values = [{}]
 
@@ -15,3 +43,25 @@ class MetadataField(models.JSONField):
         kwargs['blank'] = True
         super().__init__(*args, **kwargs)
         self.validators.append(validate_metadata)
+
+
+@MetadataField.register_lookup
+class MatchesJSONPath(models.Lookup):
+    """
+    Match against a jsonpath predicate, e.g. `metadata__matches_jsonpath='$."Age" >= 60'`.
+
+    Comparisons in jsonpath are strictly typed, so a numeric range never matches a string value.
+    Equality predicates can be served by a `jsonb_path_ops` GIN index.
+    """
+
+    lookup_name = 'matches_jsonpath'
+    prepare_rhs = False
+
+    def get_db_prep_lookup(self, value, connection):
+        # The predicate is passed through as is, rather than being encoded as JSON
+        return ('%s', [value])
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} @@ {rhs}::jsonpath', lhs_params + rhs_params
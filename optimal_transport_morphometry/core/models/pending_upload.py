@@ -1,10 +1,35 @@
-from typing import Type
+from collections import Counter
+from typing import Dict, Type
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Greatest
 from django.dispatch import receiver
 
 from .metadata import MetadataField
-from .upload_batch import UploadBatch
+from .upload_batch import UploadBatch, delete_completed_batches
+
+
+def _uploads_removed(counts: Dict[int, int]) -> None:
+    """Decrement the remaining uploads of each batch, and schedule cleanup of completed batches."""
+    for batch_id, count in counts.items():
+        UploadBatch.objects.filter(pk=batch_id).update(
+            remaining_uploads=Greatest(models.F('remaining_uploads') - count, 0)
+        )
+
+    batch_ids = list(counts)
+    transaction.on_commit(lambda: delete_completed_batches(batch_ids))
+
+
+class PendingUploadQuerySet(models.QuerySet):
+    @transaction.atomic
+    def delete(self):
+        # Lock the rows being deleted, so concurrent deletes can't decrement a batch twice
+        rows = list(self.order_by().select_for_update().values_list('pk', 'batch_id'))
+        locked = self.model.objects.using(self.db).filter(pk__in=[pk for pk, _ in rows])
+        result = super(PendingUploadQuerySet, locked).delete()
+
+        _uploads_removed(Counter(batch_id for _, batch_id in rows))
+        return result
 
 
 class PendingUpload(models.Model):
@@ -16,11 +41,26 @@ class PendingUpload(models.Model):
     name = models.CharField(max_length=255)
     metadata = MetadataField()
 
+    # The state of a multipart upload in progress, if any
+    object_key = models.CharField(max_length=2000, blank=True)
+    upload_id = models.CharField(max_length=255, blank=True)
+    size = models.PositiveBigIntegerField(null=True, blank=True)
+
+    objects = PendingUploadQuerySet.as_manager()
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        if result[0]:
+            _uploads_removed({self.batch_id: 1})
+
+        return result
+
 
-@receiver(models.signals.post_delete, sender=PendingUpload)
-def _on_delete(sender: Type[PendingUpload], instance: PendingUpload, **kwargs):
-    try:
-        if instance.batch.pending_uploads.count() == 0:
-            instance.batch.delete()
-    except UploadBatch.DoesNotExist:
-        pass
+@receiver(models.signals.post_save, sender=PendingUpload)
+def _on_save(sender: Type[PendingUpload], instance: PendingUpload, created: bool, **kwargs):
+    # Uploads which are bulk inserted must be counted by their creator
+    if created:
+        UploadBatch.objects.filter(pk=instance.batch_id).update(
+            remaining_uploads=models.F('remaining_uploads') + 1
+        )
@@ -1,14 +1,54 @@
-from typing import Optional
+from typing import List, Optional
 
+from django.contrib.postgres.fields import ArrayField
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.db.models import OuterRef
 from django_extensions.db.models import TimeStampedModel
 from s3_file_field import S3FileField
 
+from optimal_transport_morphometry.core.encoding import OutputEncoding
+from optimal_transport_morphometry.core.registration import (
+    DEFAULT_REGISTRATION_PROFILE,
+    REGISTRATION_PROFILES,
+)
+
 from .atlas import Atlas
 from .dataset import Dataset
 from .image import Image
 
 
+class Tissue(models.TextChoices):
+    CSF = 'csf', 'CSF'
+    GREY = 'grey', 'Grey matter'
+    WHITE = 'white', 'White matter'
+
+
+class OutputDtype(models.TextChoices):
+    FLOAT32 = 'float32'
+    FLOAT64 = 'float64'
+
+
+class OutputCodec(models.TextChoices):
+    RAW = 'raw', 'Uncompressed'
+    GZIP = 'gzip', 'Gzip'
+    PIGZ = 'pigz', 'Multi-threaded gzip'
+
+
+class FeatureStorage(models.TextChoices):
+    DENSE = 'dense', 'Dense volumes'
+    SPARSE = 'sparse', 'In-mask values'
+    BOTH = 'both', 'Dense volumes and in-mask values'
+
+
+def default_feature_tissues() -> List[str]:
+    return [Tissue.GREY]
+
+
+def default_downsample_factors() -> List[float]:
+    return [3.0]
+
+
 class PreprocessingBatch(TimeStampedModel):
     class Status(models.TextChoices):
         PENDING = 'Pending'
@@ -28,38 +68,96 @@ class PreprocessingBatch(TimeStampedModel):
     # The atlas used
     atlas = models.ForeignKey(Atlas, on_delete=models.PROTECT, related_name='preprocessing_batches')
 
+    # The parameters used to register every image to the atlas
+    registration_profile = models.CharField(
+        max_length=32,
+        choices=[(name, profile.description) for name, profile in REGISTRATION_PROFILES.items()],
+        default=DEFAULT_REGISTRATION_PROFILE,
+    )
+
+    # The feature images created for every image: the tissues (segmentation classes) to extract,
+    # whether they're modulated by the Jacobian, and each factor they're downsampled by
+    feature_tissues = ArrayField(
+        models.CharField(max_length=16, choices=Tissue.choices), default=default_feature_tissues
+    )
+    modulated = models.BooleanField(default=True)
+    downsample_factors = ArrayField(models.FloatField(), default=default_downsample_factors)
+
+    # How preprocessed volumes are written. Segmentations are always written as bytes.
+    output_dtype = models.CharField(
+        max_length=16, choices=OutputDtype.choices, default=OutputDtype.FLOAT32
+    )
+    output_codec = models.CharField(
+        max_length=16, choices=OutputCodec.choices, default=OutputCodec.GZIP
+    )
+    compression_level = models.PositiveSmallIntegerField(
+        default=6, validators=[MinValueValidator(1), MaxValueValidator(9)]
+    )
+
+    # Whether feature images are stored as dense volumes, as the values within their feature mask,
+    # or both
+    feature_storage = models.CharField(
+        max_length=16, choices=FeatureStorage.choices, default=FeatureStorage.DENSE
+    )
+
+    # A derive-only batch reuses the registrations and segmentations of this batch, only
+    # recomputing the outputs derived from them (Jacobians and feature images)
+    derived_from = models.ForeignKey(
+        'self',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='derived_batches',
+    )
+
     # The total number of preprocessed images that should be expected in this batch
     # expected_total = models.PositiveIntegerField()
 
+    @property
+    def output_encoding(self) -> OutputEncoding:
+        return OutputEncoding(self.output_dtype, self.output_codec, self.compression_level)
+
+    @property
+    def outputs_per_image(self) -> int:
+        """Return the number of preprocessed images created for every source image."""
+        non_feature_kinds = len(PreprocessedImage.Kind) - 1
+        return non_feature_kinds + len(self.feature_tissues) * len(self.downsample_factors)
+
+    def completed_image_ids(self) -> models.QuerySet:
+        """Return the IDs of the source images which have all of their preprocessed images."""
+        return (
+            self.preprocessed_images.order_by()
+            .values('source_image')
+            .annotate(count=models.Count('pk'))
+            .filter(count__gte=self.outputs_per_image)
+            .values('source_image')
+        )
+
+    def primary_feature_images(self) -> models.QuerySet['FeatureImage']:
+        """Return the feature images of the first tissue and downsample factor, one per image."""
+        return FeatureImage.objects.filter(
+            preprocessing_batch=self,
+            tissue=self.feature_tissues[0],
+            downsample_factor=self.downsample_factors[0],
+        )
+
     def source_images(self) -> models.QuerySet[Image]:
         """Return all images that are sources to preprocessed images in this batch."""
         return Image.objects.filter(
-            models.Q(core_featureimages__preprocessing_batch=self)
-            | models.Q(core_registeredimages__preprocessing_batch=self)
-            | models.Q(core_segmentedimages__preprocessing_batch=self)
-            | models.Q(core_jacobianimages__preprocessing_batch=self)
-        ).distinct()
+            models.Exists(
+                PreprocessedImage.objects.filter(
+                    preprocessing_batch=self, source_image=OuterRef('pk')
+                )
+            )
+        )
 
     def current_image(self) -> Optional[Image]:
         """Return the source image currently being processed, or None."""
-        return (
-            self.dataset.images.order_by('name')
-            .exclude(
-                models.Q(
-                    name__in=self.core_featureimage.values_list('source_image__name', flat=True)
-                )
-                & models.Q(
-                    name__in=self.core_jacobianimage.values_list('source_image__name', flat=True)
-                )
-                & models.Q(
-                    name__in=self.core_registeredimage.values_list('source_image__name', flat=True)
-                )
-                & models.Q(
-                    name__in=self.core_segmentedimage.values_list('source_image__name', flat=True)
-                )
-            )
-            .first()
+        # Only valid images are preprocessed
+        images = Image.objects.filter(
+            dataset_id=self.dataset_id, validation_status=Image.ValidationStatus.VALID
         )
+        return images.order_by('name').exclude(pk__in=self.completed_image_ids()).first()
 
     # def save(self, **kwargs):
     #     if not self.expected_total:
@@ -68,39 +166,178 @@ class PreprocessingBatch(TimeStampedModel):
     #     return super().save(**kwargs)
 
 
-class AbstractPreprocessedImage(TimeStampedModel):
-    """Base class that preprocessed images inherit from."""
+class PreprocessedImage(TimeStampedModel):
+    """
+    An output of preprocessing a source image.
 
-    blob = S3FileField()
+    Every kind of output shares this table, so queries over all the outputs of a batch or image
+    are a single indexed query. Each kind also has a proxy model, e.g. FeatureImage.
+    """
+
+    class Kind(models.TextChoices):
+        REGISTERED = 'registered'
+        JACOBIAN = 'jacobian'
+        SEGMENTED = 'segmented'
+        FEATURE = 'feature'
+
+    class Meta:
+        constraints = [
+            # A batch has at most one of each output per image (and feature image per tissue and
+            # downsample factor), so retried tasks can't duplicate them. This also indexes every
+            # lookup by batch, or by batch and image together.
+            models.UniqueConstraint(
+                fields=[
+                    'preprocessing_batch',
+                    'source_image',
+                    'kind',
+                    'tissue',
+                    'downsample_factor',
+                ],
+                name='unique_preprocessed_image',
+            )
+        ]
+
+    kind = models.CharField(max_length=32, choices=Kind.choices)
+
+    # Only blank for feature images which are only stored sparsely
+    blob = S3FileField(blank=True)
     source_image = models.ForeignKey(
         Image,
         on_delete=models.CASCADE,
-        related_name='%(app_label)s_%(class)ss',
+        related_name='preprocessed_images',
         db_index=True,
     )
 
-    # The preprocessing batch this preprocessed image belongs to
+    # The preprocessing batch this preprocessed image belongs to. Not indexed on its own, since
+    # it's the leading column of the unique index.
     preprocessing_batch = models.ForeignKey(
         PreprocessingBatch,
         on_delete=models.CASCADE,
-        related_name='%(app_label)s_%(class)s',
+        related_name='preprocessed_images',
+        db_index=False,
     )
 
+    # Recorded when the blob is written, so storage isn't queried for them
+    size = models.PositiveBigIntegerField(null=True, blank=True)
+    checksum = models.CharField(max_length=64, blank=True, default='')
+    dimensions = ArrayField(models.PositiveIntegerField(), size=3, null=True, blank=True)
+    voxel_size = ArrayField(models.FloatField(), size=3, null=True, blank=True)
+
+    # Feature images are keyed by tissue and downsample factor. Other kinds have no tissue, and
+    # are at the resolution of the atlas.
+    tissue = models.CharField(max_length=16, choices=Tissue.choices, blank=True, default='')
+    downsample_factor = models.FloatField(default=1.0)
+
+    # The values of a sparse feature image within its feature mask, in the order of the mask's
+    # voxel index
+    values = S3FileField(blank=True)
+
+    # Attributes of a single kind, which are blank for the others
+    registration_type = models.CharField(max_length=100, blank=True, default='')
+
+    # The arguments of ants.registration, and how long it took, in seconds
+    registration_parameters = models.JSONField(default=dict, blank=True)
+    registration_runtime = models.FloatField(null=True, blank=True)
+
+    # The transforms found by registration, so outputs can be derived again without repeating it.
+    # The forward transforms are [warp, affine], and the inverse transforms are the inverse of the
+    # affine then the inverse warp. Linear registrations have no warps.
+    affine_transform = S3FileField(blank=True)
+    warp_transform = S3FileField(blank=True)
+    inverse_warp_transform = S3FileField(blank=True)
+
+    # The kind of every instance of a proxy model
+    KIND: Optional[str] = None
+
+    def save(self, *args, **kwargs):
+        if self.KIND is not None:
+            self.kind = self.KIND
+        super().save(*args, **kwargs)
+
+
+class PreprocessedImageKindManager(models.Manager):
+    def get_queryset(self):
+        return super().get_queryset().filter(kind=self.model.KIND)
+
+
+class FeatureImage(PreprocessedImage):
+    KIND = PreprocessedImage.Kind.FEATURE
+    objects = PreprocessedImageKindManager()
+
     class Meta:
-        abstract = True
+        proxy = True
 
+    def mask(self) -> 'FeatureMask':
+        """Return the feature mask the values of this feature image are within."""
+        return FeatureMask.objects.get(
+            preprocessing_batch_id=self.preprocessing_batch_id,
+            kind=FeatureMask.Kind.SUPPORT,
+            tissue=self.tissue,
+            downsample_factor=self.downsample_factor,
+        )
 
-class FeatureImage(AbstractPreprocessedImage):
-    downsample_factor = models.FloatField()
 
+class JacobianImage(PreprocessedImage):
+    KIND = PreprocessedImage.Kind.JACOBIAN
+    objects = PreprocessedImageKindManager()
 
-class JacobianImage(AbstractPreprocessedImage):
-    pass
+    class Meta:
+        proxy = True
 
 
-class RegisteredImage(AbstractPreprocessedImage):
-    registration_type = models.CharField(max_length=100, default='affine')
+class RegisteredImage(PreprocessedImage):
+    KIND = PreprocessedImage.Kind.REGISTERED
+    objects = PreprocessedImageKindManager()
 
+    class Meta:
+        proxy = True
+
+
+class SegmentedImage(PreprocessedImage):
+    KIND = PreprocessedImage.Kind.SEGMENTED
+    objects = PreprocessedImageKindManager()
+
+    class Meta:
+        proxy = True
+
+
+class FeatureMask(TimeStampedModel):
+    """
+    A mask of the voxels of a batch's feature images, of a single tissue and downsample factor.
+
+    The support of a batch is where its feature images may be non-zero. Every image is segmented
+    within the brain mask of the atlas, so it's the same for every image, and sparse feature images
+    only store their values within it. Once a batch is finished, the union and intersection of
+    where its feature images are non-zero are also computed, for analysis to be restricted to.
+    """
+
+    class Kind(models.TextChoices):
+        SUPPORT = 'support'
+        UNION = 'union'
+        INTERSECTION = 'intersection'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['preprocessing_batch', 'kind', 'tissue', 'downsample_factor'],
+                name='unique_feature_mask',
+            )
+        ]
+
+    preprocessing_batch = models.ForeignKey(
+        PreprocessingBatch,
+        on_delete=models.CASCADE,
+        related_name='feature_masks',
+        db_index=False,
+    )
+    kind = models.CharField(max_length=16, choices=Kind.choices, default=Kind.SUPPORT)
+    tissue = models.CharField(max_length=16, choices=Tissue.choices)
+    downsample_factor = models.FloatField()
+
+    # A NIfTI volume of bytes, in the space of the feature images
+    blob = S3FileField()
+    voxel_count = models.PositiveIntegerField()
 
-class SegmentedImage(AbstractPreprocessedImage):
-    pass
+    # The voxel index, i.e. the indices of the mask's non-zero voxels when flattened in C order, as
+    # a .npy file. Not stored for masks from before it was.
+    voxel_index = S3FileField(blank=True)
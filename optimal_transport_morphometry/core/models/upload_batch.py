@@ -1,4 +1,7 @@
+from typing import Iterable, Type
+
 from django.db import models
+from django.dispatch import receiver
 from django_extensions.db.models import CreationDateTimeField
 
 from .dataset import Dataset
@@ -12,6 +15,38 @@ class UploadBatch(models.Model):
     dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE, related_name='upload_batches')
     created = CreationDateTimeField()
 
+    # Rows of the uploaded CSV which were skipped, as {'line': int, 'error': str}
+    errors = models.JSONField(default=list, blank=True)
+
+    # Skipped rows beyond the first MAX_RECORDED_ERRORS, which are only counted
+    unrecorded_errors = models.PositiveIntegerField(default=0)
+
+    # Denormalized from pending uploads, so completion can be checked without a COUNT
+    remaining_uploads = models.PositiveIntegerField(default=0)
+
     @property
     def is_complete(self) -> bool:
-        return self.pending_uploads.count() == 0
+        return self.remaining_uploads == 0
+
+
+def delete_completed_batches(batch_ids: Iterable[int]) -> None:
+    """Delete any of the given batches which have no remaining uploads."""
+    # The existence check guards against a drifted count deleting uploads along with the batch
+    UploadBatch.objects.filter(
+        pk__in=batch_ids, remaining_uploads=0, pending_uploads__isnull=True
+    ).delete()
+
+
+@receiver(models.signals.post_save, sender=UploadBatch)
+def _on_save(sender: Type[UploadBatch], instance: UploadBatch, created: bool, **kwargs):
+    if created:
+        Dataset.objects.filter(pk=instance.dataset_id).update(uploads_active=True)
+
+
+@receiver(models.signals.post_delete, sender=UploadBatch)
+def _on_delete(sender: Type[UploadBatch], instance: UploadBatch, **kwargs):
+    Dataset.objects.filter(pk=instance.dataset_id).update(
+        uploads_active=models.Exists(
+            UploadBatch.objects.filter(dataset_id=models.OuterRef('pk')),
+        )
+    )
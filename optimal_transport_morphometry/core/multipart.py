@@ -0,0 +1,162 @@
+import base64
+import binascii
+import hashlib
+import math
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from botocore.client import Config
+from botocore.exceptions import ClientError
+
+from optimal_transport_morphometry.core.storage import get_boto_client, get_bucket_name, head_object
+
+# S3 multipart limits: https://docs.aws.amazon.com/AmazonS3/latest/userguide/qfacts.html
+MIN_PART_SIZE = 5 * 1024**2
+MAX_PART_SIZE = 5 * 1024**3
+MAX_PARTS = 10_000
+DEFAULT_PART_SIZE = 64 * 1024**2
+
+# Large uploads may take many hours to complete
+URL_EXPIRATION = 24 * 60 * 60
+
+
+class UploadNotFoundError(Exception):
+    """A multipart upload doesn't exist, because it was completed or aborted."""
+
+
+def _no_such_upload(error: ClientError) -> bool:
+    return error.response['Error']['Code'] == 'NoSuchUpload'
+
+
+def part_sizes(file_size: int, part_size: int = DEFAULT_PART_SIZE) -> Iterator[Tuple[int, int]]:
+    """Yield the number and size of each part of an upload."""
+    part_size = max(part_size, math.ceil(file_size / MAX_PARTS), MIN_PART_SIZE)
+    part_size = min(part_size, MAX_PART_SIZE)
+
+    part_count = max(math.ceil(file_size / part_size), 1)
+    for part_number in range(1, part_count + 1):
+        yield part_number, min(part_size, file_size - (part_number - 1) * part_size)
+
+
+def md5_hex(md5: str) -> str:
+    """Convert a base64 encoded MD5 digest (as sent in Content-MD5) to hex, as used in ETags."""
+    try:
+        digest = base64.b64decode(md5, validate=True)
+    except binascii.Error:
+        raise ValueError('Not a base64 encoded digest.')
+    if len(digest) != hashlib.md5().digest_size:
+        raise ValueError('Not an MD5 digest.')
+
+    return digest.hex()
+
+
+def multipart_etag(part_md5s: List[str]) -> str:
+    """Return the ETag S3 assigns to a completed multipart upload, from its hex part MD5s."""
+    digest = hashlib.md5(b''.join(bytes.fromhex(md5) for md5 in part_md5s))
+    return f'{digest.hexdigest()}-{len(part_md5s)}'
+
+
+def create_upload(object_key: str, content_type: Optional[str] = None) -> str:
+    """Create a multipart upload, returning its upload ID."""
+    params = {'Bucket': get_bucket_name(), 'Key': object_key}
+    if content_type:
+        params['ContentType'] = content_type
+
+    return get_boto_client().create_multipart_upload(**params)['UploadId']
+
+
+def presign_part(object_key: str, upload_id: str, part_number: int, md5: str) -> str:
+    """
+    Return a URL which a single part may be PUT to.
+
+    The URL is signed with the part's Content-MD5, which must be sent with the part. S3 will then
+    reject any part whose content doesn't match the digest.
+    """
+    # SigV4 is required for the Content-MD5 header to be signed
+    client = get_boto_client(Config(signature_version='s3v4'))
+    return client.generate_presigned_url(
+        ClientMethod='upload_part',
+        Params={
+            'Bucket': get_bucket_name(),
+            'Key': object_key,
+            'UploadId': upload_id,
+            'PartNumber': part_number,
+            'ContentMD5': md5,
+        },
+        ExpiresIn=URL_EXPIRATION,
+    )
+
+
+def uploaded_parts(object_key: str, upload_id: str) -> Dict[int, dict]:
+    """
+    Return the size and ETag of each part uploaded so far, keyed by part number.
+
+    Raises UploadNotFoundError if the upload was completed or aborted.
+    """
+    client = get_boto_client()
+    parts = {}
+    paginator = client.get_paginator('list_parts')
+    try:
+        for page in paginator.paginate(
+            Bucket=get_bucket_name(), Key=object_key, UploadId=upload_id
+        ):
+            for part in page.get('Parts', []):
+                parts[part['PartNumber']] = {'size': part['Size'], 'etag': part['ETag'].strip('"')}
+    except ClientError as e:
+        if _no_such_upload(e):
+            raise UploadNotFoundError(upload_id) from e
+        raise
+
+    return parts
+
+
+def complete_upload(object_key: str, upload_id: str, etags: Dict[int, str]) -> str:
+    """
+    Complete a multipart upload from the ETag of each part, returning the object's ETag.
+
+    Completion is idempotent: if the upload was already completed (e.g. by a request whose
+    transaction was then rolled back), the ETag of the stored object is returned, for the caller
+    to check against the parts. Raises UploadNotFoundError if there's no such upload or object.
+    """
+    try:
+        response = get_boto_client().complete_multipart_upload(
+            Bucket=get_bucket_name(),
+            Key=object_key,
+            UploadId=upload_id,
+            MultipartUpload={
+                'Parts': [
+                    {'PartNumber': part_number, 'ETag': f'"{etag}"'}
+                    for part_number, etag in sorted(etags.items())
+                ]
+            },
+        )
+    except ClientError as e:
+        if not _no_such_upload(e):
+            raise
+
+        try:
+            _, etag = head_object(object_key)
+        except ClientError as head_error:
+            if head_error.response['Error']['Code'] in ('NoSuchKey', '404'):
+                raise UploadNotFoundError(upload_id) from e
+            raise
+        return etag
+
+    return response['ETag'].strip('"')
+
+
+def abort_upload(object_key: str, upload_id: str) -> None:
+    """Abort a multipart upload, deleting its parts, if it's still in progress."""
+    try:
+        get_boto_client().abort_multipart_upload(
+            Bucket=get_bucket_name(), Key=object_key, UploadId=upload_id
+        )
+    except ClientError as e:
+        if not _no_such_upload(e):
+            raise
+
+
+def list_uploads() -> Iterator[List[dict]]:
+    """Yield the multipart uploads in progress, a page (of up to 1000 uploads) at a time."""
+    paginator = get_boto_client().get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=get_bucket_name()):
+        yield page.get('Uploads', [])
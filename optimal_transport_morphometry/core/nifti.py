@@ -0,0 +1,278 @@
+from dataclasses import dataclass
+import math
+import struct
+from typing import List, Optional, Tuple
+import zlib
+
+from botocore.exceptions import ClientError
+
+from optimal_transport_morphometry.core.storage import get_boto_client, get_bucket_name
+
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+# The number of compressed bytes fetched by each ranged read, while looking for the header
+READ_SIZE = 4096
+
+# Give up on files with an implausibly large gzip header (e.g. a huge embedded filename)
+MAX_READ_SIZE = 64 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Datatype codes, from nifti1.h
+DATATYPES = {
+    1: 'binary',
+    2: 'uint8',
+    4: 'int16',
+    8: 'int32',
+    16: 'float32',
+    32: 'complex64',
+    64: 'float64',
+    128: 'rgb24',
+    256: 'int8',
+    512: 'uint16',
+    768: 'uint32',
+    1024: 'int64',
+    1280: 'uint64',
+    1536: 'float128',
+    1792: 'complex128',
+    2048: 'complex256',
+    2304: 'rgba32',
+}
+
+# Scalar datatypes that can be read by preprocessing
+SUPPORTED_DATATYPES = {
+    'uint8',
+    'int16',
+    'int32',
+    'float32',
+    'float64',
+    'int8',
+    'uint16',
+    'uint32',
+    'int64',
+    'uint64',
+}
+
+
+class NiftiError(Exception):
+    pass
+
+
+@dataclass
+class NiftiHeader:
+    version: int
+    dimensions: List[int]
+    voxel_size: List[float]
+    datatype: str
+    orientation: str
+
+    # Only present for uncompressed files, where it can be checked against the file size
+    data_size: Optional[int] = None
+
+    # The size and ETag of the object in storage, when read from storage
+    file_size: Optional[int] = None
+    etag: str = ''
+
+
+def _orientation(affine: List[List[float]]) -> str:
+    """Return the axis codes of a 3x3 voxel to world matrix, e.g. 'RAS' or 'LPI'."""
+    labels = [('L', 'R'), ('P', 'A'), ('I', 'S')]
+    codes = ''
+    world_axes = set()
+    for column in range(3):
+        values = [affine[row][column] for row in range(3)]
+        world = max(range(3), key=lambda row: abs(values[row]))
+        world_axes.add(world)
+        codes += labels[world][values[world] > 0]
+
+    # Each voxel axis must map to a different world axis
+    if len(world_axes) != 3 or any(not math.isfinite(val) for row in affine for val in row):
+        raise NiftiError('Orientation matrix is degenerate.')
+
+    return codes
+
+
+def _quaternion_affine(b: float, c: float, d: float, qfac: float) -> List[List[float]]:
+    a = math.sqrt(max(1.0 - (b * b + c * c + d * d), 0.0))
+    return [
+        [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c) * qfac],
+        [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b) * qfac],
+        [2 * (b * d - a * c), 2 * (c * d + a * b), (a * a + d * d - c * c - b * b) * qfac],
+    ]
+
+
+def _header_size(data: bytes) -> Optional[int]:
+    """Return the header size given by the first field of a header, in either byte order."""
+    if len(data) < 4:
+        return None
+    for endian in '<>':
+        (sizeof_hdr,) = struct.unpack_from(f'{endian}i', data)
+        if sizeof_hdr in (NIFTI1_HEADER_SIZE, NIFTI2_HEADER_SIZE):
+            return sizeof_hdr
+
+    return None
+
+
+def _unpack(data: bytes) -> Tuple[int, tuple]:
+    """Unpack the fields of a NIfTI-1 or NIfTI-2 header, in either byte order."""
+    if _header_size(data) is None:
+        raise NiftiError('Not a NIfTI file.')
+
+    for endian in '<>':
+        (sizeof_hdr,) = struct.unpack_from(f'{endian}i', data)
+        if sizeof_hdr == NIFTI1_HEADER_SIZE and len(data) >= NIFTI1_HEADER_SIZE:
+            dims = struct.unpack_from(f'{endian}8h', data, 40)
+            datatype, bitpix = struct.unpack_from(f'{endian}2h', data, 70)
+            pixdim = struct.unpack_from(f'{endian}8f', data, 76)
+            (vox_offset,) = struct.unpack_from(f'{endian}f', data, 108)
+            qform_code, sform_code = struct.unpack_from(f'{endian}2h', data, 252)
+            quatern = struct.unpack_from(f'{endian}3f', data, 256)
+            srows = struct.unpack_from(f'{endian}12f', data, 280)
+            magic = data[344:348]
+            return 1, (
+                dims,
+                datatype,
+                bitpix,
+                pixdim,
+                vox_offset,
+                qform_code,
+                sform_code,
+                quatern,
+                srows,
+                magic,
+            )
+        if sizeof_hdr == NIFTI2_HEADER_SIZE and len(data) >= NIFTI2_HEADER_SIZE:
+            magic = data[4:12]
+            datatype, bitpix = struct.unpack_from(f'{endian}2h', data, 12)
+            dims = struct.unpack_from(f'{endian}8q', data, 16)
+            pixdim = struct.unpack_from(f'{endian}8d', data, 104)
+            (vox_offset,) = struct.unpack_from(f'{endian}q', data, 168)
+            qform_code, sform_code = struct.unpack_from(f'{endian}2i', data, 344)
+            quatern = struct.unpack_from(f'{endian}3d', data, 352)
+            srows = struct.unpack_from(f'{endian}12d', data, 400)
+            return 2, (
+                dims,
+                datatype,
+                bitpix,
+                pixdim,
+                vox_offset,
+                qform_code,
+                sform_code,
+                quatern,
+                srows,
+                magic,
+            )
+
+    raise NiftiError('Not a NIfTI file.')
+
+
+def parse_header(data: bytes) -> NiftiHeader:
+    """Parse and validate the header of a single file (.nii) NIfTI-1 or NIfTI-2 volume."""
+    version, fields = _unpack(data)
+    dims, datatype, bitpix, pixdim, vox_offset, qform_code, sform_code, quatern, srows, magic = (
+        fields
+    )
+    if magic[:3] not in (b'n+1', b'n+2'):
+        # Headers in a separate .hdr file have the magic 'ni1', and can't be read on their own
+        raise NiftiError('Not a single file NIfTI volume.')
+
+    ndim = dims[0]
+    if not 1 <= ndim <= 7:
+        raise NiftiError(f'Invalid number of dimensions: {ndim}.')
+    dimensions = list(dims[1 : ndim + 1])
+    if any(dim < 1 for dim in dimensions):
+        raise NiftiError(f'Invalid dimensions: {dimensions}.')
+
+    # Trailing singleton dimensions (e.g. a single time point) are harmless
+    while len(dimensions) > 3 and dimensions[-1] == 1:
+        dimensions.pop()
+    if len(dimensions) != 3:
+        raise NiftiError(f'Expected a 3D volume, not {len(dimensions)}D.')
+
+    voxel_size = [float(size) for size in pixdim[1:4]]
+    if any(not math.isfinite(size) or size <= 0 for size in voxel_size):
+        raise NiftiError(f'Invalid voxel size: {voxel_size}.')
+
+    datatype_name = DATATYPES.get(datatype, str(datatype))
+    if datatype_name not in SUPPORTED_DATATYPES:
+        raise NiftiError(f'Unsupported datatype: {datatype_name}.')
+
+    # Prefer the sform, then the qform, falling back to the default (Analyze) orientation
+    if sform_code > 0:
+        affine = [list(srows[row * 4 : row * 4 + 3]) for row in range(3)]
+    elif qform_code > 0:
+        affine = _quaternion_affine(*quatern, qfac=-1.0 if pixdim[0] < 0 else 1.0)
+    else:
+        affine = [[-1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+
+    return NiftiHeader(
+        version=version,
+        dimensions=dimensions,
+        voxel_size=voxel_size,
+        datatype=datatype_name,
+        orientation=_orientation(affine),
+        data_size=int(vox_offset) + math.prod(dimensions) * bitpix // 8,
+    )
+
+
+def _get_range(object_key: str, start: int, end: int) -> Tuple[bytes, int, str]:
+    """Return the bytes in an inclusive range of an object, and the object's size and ETag."""
+    try:
+        response = get_boto_client().get_object(
+            Bucket=get_bucket_name(), Key=object_key, Range=f'bytes={start}-{end}'
+        )
+    except ClientError as e:
+        # Other errors may be transient, so aren't a reason to reject the file
+        code = e.response['Error']['Code']
+        if code in ('NoSuchKey', '404'):
+            raise NiftiError('File not found in storage.')
+        if code == 'InvalidRange':
+            raise NiftiError('File is empty.')
+        raise
+
+    # A range may be ignored for very small objects, in which case there's no ContentRange
+    content_range = response.get('ContentRange')
+    total = int(content_range.rsplit('/', 1)[1]) if content_range else response['ContentLength']
+    return response['Body'].read(), total, response['ETag'].strip('"')
+
+
+def read_header(object_key: str) -> NiftiHeader:
+    """
+    Read and validate the header of a NIfTI volume in storage, without downloading the volume.
+
+    Only the start of the object is fetched, with ranged reads. Compressed (.nii.gz) volumes are
+    decompressed as a stream, until enough of the header has been decompressed.
+    """
+    data, total, etag = _get_range(object_key, 0, READ_SIZE - 1)
+    if not data.startswith(GZIP_MAGIC):
+        header = parse_header(data)
+        if header.data_size is not None and total < header.data_size:
+            raise NiftiError(f'File is truncated: expected {header.data_size} bytes, got {total}.')
+        header.file_size, header.etag = total, etag
+        return header
+
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    header_data = b''
+    fetched = len(data)
+    while True:
+        try:
+            header_data += decompressor.decompress(data, NIFTI2_HEADER_SIZE - len(header_data))
+        except zlib.error as e:
+            raise NiftiError(f'Invalid gzip data: {e}')
+
+        # NIfTI-1 headers are shorter, so stop as soon as the whole header is available
+        if len(header_data) >= (_header_size(header_data) or NIFTI2_HEADER_SIZE):
+            break
+        if fetched >= min(total, MAX_READ_SIZE):
+            break
+
+        data, _, _ = _get_range(object_key, fetched, fetched + READ_SIZE - 1)
+        fetched += len(data)
+
+    header = parse_header(header_data)
+
+    # The uncompressed size isn't known without reading the whole file
+    header.data_size = None
+    header.file_size, header.etag = total, etag
+    return header
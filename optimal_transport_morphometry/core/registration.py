@@ -0,0 +1,101 @@
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+
+@dataclass(frozen=True)
+class RegistrationProfile:
+    """A named set of parameters, for registering images to the atlas with ANTs."""
+
+    name: str
+    description: str
+
+    # The transform type of ants.registration, e.g. 'Affine' or 'SyN'
+    type_of_transform: str
+
+    # The multi-resolution schedule of the linear stages, one entry per level
+    aff_iterations: Tuple[int, ...]
+    aff_shrink_factors: Tuple[int, ...]
+    aff_smoothing_sigmas: Tuple[int, ...]
+
+    # The number of histogram bins, and the fraction of voxels sampled, by the linear metric
+    aff_sampling: int
+    aff_random_sampling_rate: float
+
+    # The schedule of the deformable stage, if there is one
+    reg_iterations: Tuple[int, ...] = ()
+
+    @property
+    def deformable(self) -> bool:
+        return bool(self.reg_iterations)
+
+    def parameters(self) -> dict:
+        """Return the keyword arguments of ants.registration."""
+        parameters = {
+            'type_of_transform': self.type_of_transform,
+            'aff_iterations': self.aff_iterations,
+            'aff_shrink_factors': self.aff_shrink_factors,
+            'aff_smoothing_sigmas': self.aff_smoothing_sigmas,
+            'aff_sampling': self.aff_sampling,
+            'aff_random_sampling_rate': self.aff_random_sampling_rate,
+        }
+        if self.deformable:
+            parameters['reg_iterations'] = self.reg_iterations
+
+        return parameters
+
+
+REGISTRATION_PROFILES: Dict[str, RegistrationProfile] = {
+    profile.name: profile
+    for profile in [
+        RegistrationProfile(
+            name='fast_affine',
+            description='Fast affine',
+            type_of_transform='Affine',
+            aff_iterations=(200, 100, 50),
+            aff_shrink_factors=(4, 2, 1),
+            aff_smoothing_sigmas=(2, 1, 0),
+            aff_sampling=32,
+            aff_random_sampling_rate=0.1,
+        ),
+        RegistrationProfile(
+            name='rigid_affine',
+            description='Rigid and affine',
+            # Translation, rigid, similarity, then affine stages, each initialized by the last
+            type_of_transform='TRSAA',
+            aff_iterations=(1000, 500, 250, 100),
+            aff_shrink_factors=(8, 4, 2, 1),
+            aff_smoothing_sigmas=(3, 2, 1, 0),
+            aff_sampling=32,
+            aff_random_sampling_rate=0.2,
+        ),
+        RegistrationProfile(
+            name='syn',
+            description='Full SyN',
+            # The defaults of ants.registration, which every batch used before profiles existed
+            type_of_transform='SyN',
+            aff_iterations=(2100, 1200, 1200, 10),
+            aff_shrink_factors=(6, 4, 2, 1),
+            aff_smoothing_sigmas=(3, 2, 1, 0),
+            aff_sampling=32,
+            aff_random_sampling_rate=0.2,
+            reg_iterations=(40, 20, 0),
+        ),
+    ]
+}
+
+DEFAULT_REGISTRATION_PROFILE = 'syn'
+
+
+def jacobian_determinant_image(fixed, transforms: List[str], profile: RegistrationProfile):
+    """Return the Jacobian determinant of the forward transforms of a registration."""
+    import ants
+    import numpy as np
+
+    if profile.deformable:
+        # The first transform is the deformation field
+        return ants.create_jacobian_determinant_image(fixed, transforms[0], False, True)
+
+    # A linear transform has the same determinant everywhere
+    transform = ants.read_transform(transforms[0])
+    matrix = np.asarray(transform.parameters[:9]).reshape(3, 3)
+    return fixed.new_image_like(np.full(fixed.shape, np.linalg.det(matrix), dtype=np.float32))
@@ -15,6 +15,8 @@ class AnalysisResultSerializer(serializers.ModelSerializer):
             'created',
             'modified',
             'preprocessing_batch',
+            'backend',
+            'fingerprint',
             'status',
             'error_message',
             'zip_file',
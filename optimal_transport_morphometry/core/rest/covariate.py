@@ -0,0 +1,10 @@
+from rest_framework import serializers
+
+from optimal_transport_morphometry.core.models import Covariate
+
+
+class CovariateSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Covariate
+        fields = ['id', 'name', 'type', 'categories']
+        read_only_fields = fields
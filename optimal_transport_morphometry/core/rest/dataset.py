@@ -2,10 +2,10 @@ import codecs
 from typing import List
 
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.db import IntegrityError, transaction
-from django.db.models import Count, Exists, OuterRef
 from django.shortcuts import get_object_or_404
-from drf_yasg.utils import no_body, swagger_auto_schema
+from drf_yasg.utils import swagger_auto_schema
 from guardian.shortcuts import assign_perm, get_objects_for_user, get_users_with_perms, remove_perm
 from rest_framework import serializers, status
 from rest_framework.decorators import action
@@ -23,14 +23,31 @@ from optimal_transport_morphometry.core.models import (
     Dataset,
     Image,
     PreprocessingBatch,
+    RegisteredImage,
     UploadBatch,
 )
+from optimal_transport_morphometry.core.models.covariate import dataset_covariates
+from optimal_transport_morphometry.core.models.preprocessing import (
+    FeatureStorage,
+    OutputCodec,
+    OutputDtype,
+    Tissue,
+    default_downsample_factors,
+    default_feature_tissues,
+)
+from optimal_transport_morphometry.core.registration import (
+    DEFAULT_REGISTRATION_PROFILE,
+    REGISTRATION_PROFILES,
+)
 from optimal_transport_morphometry.core.rest.analysis import AnalysisResultSerializer
+from optimal_transport_morphometry.core.rest.covariate import CovariateSerializer
 from optimal_transport_morphometry.core.rest.image import ImageSerializer
+from optimal_transport_morphometry.core.rest.metadata import metadata_filter
 from optimal_transport_morphometry.core.rest.preprocessing import PreprocessingBatchSerializer
 from optimal_transport_morphometry.core.rest.serializers import LimitOffsetSerializer
 from optimal_transport_morphometry.core.rest.upload_batch import UploadBatchSerializer
 from optimal_transport_morphometry.core.rest.user import UserSerializer
+from optimal_transport_morphometry.core.search import search_by_name
 from optimal_transport_morphometry.core.tasks import preprocess_images, run_utm
 
 
@@ -44,16 +61,29 @@ class DatasetSerializer(serializers.ModelSerializer):
             'public',
             'current_preprocessing_batch',
             'current_analysis_result',
+            'uploads_active',
+            'image_count',
         ]
         read_only_fields = [
             'id',
             'current_preprocessing_batch',
             'current_analysis_result',
+            'uploads_active',
+            'image_count',
         ]
 
     # Set default value
     public = serializers.BooleanField(default=False)
 
+    def update(self, instance: Dataset, validated_data: dict) -> Dataset:
+        # The counts are incremented concurrently with F() expressions, so only the updated
+        # fields are saved, rather than writing back stale counts
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(update_fields=[*validated_data, 'modified'])
+
+        return instance
+
 
 class DatasetDetailSerializer(serializers.ModelSerializer):
     class Meta:
@@ -79,8 +109,6 @@ class DatasetDetailSerializer(serializers.ModelSerializer):
         choices=['admin', 'write', None],
     )
 
-    uploads_active = serializers.BooleanField()
-    image_count = serializers.IntegerField()
     current_preprocessing_batch = PreprocessingBatchSerializer()
     current_analysis_result = AnalysisResultSerializer()
 
@@ -88,11 +116,75 @@ class DatasetDetailSerializer(serializers.ModelSerializer):
 class DatasetListQuerySerializer(serializers.Serializer):
     # Add fields for filtering
     name = serializers.CharField(required=False)
+    ranked = serializers.BooleanField(
+        default=False, help_text='Include similar names, ordered by similarity to the name filter.'
+    )
     access = serializers.ChoiceField(choices=['public', 'shared', 'owned'], required=False)
 
 
 class CreateBatchSerializer(serializers.Serializer):
-    csvfile = serializers.FileField(allow_empty_file=False, max_length=1024 * 1024)
+    csvfile = serializers.FileField(allow_empty_file=False)
+
+
+class PreprocessSerializer(serializers.Serializer):
+    registration_profile = serializers.ChoiceField(
+        choices=list(REGISTRATION_PROFILES),
+        default=DEFAULT_REGISTRATION_PROFILE,
+        help_text='The parameters used to register images to the atlas.',
+    )
+    feature_tissues = serializers.ListField(
+        child=serializers.ChoiceField(choices=Tissue.choices),
+        min_length=1,
+        default=default_feature_tissues,
+        help_text='The tissues to create feature images of.',
+    )
+    modulated = serializers.BooleanField(
+        default=True, help_text='Whether feature images are modulated by the Jacobian.'
+    )
+    downsample_factors = serializers.ListField(
+        child=serializers.FloatField(min_value=1.0),
+        min_length=1,
+        default=default_downsample_factors,
+        help_text='The factors by which feature images are downsampled, creating one of each.',
+    )
+    output_dtype = serializers.ChoiceField(
+        choices=OutputDtype.choices,
+        default=OutputDtype.FLOAT32,
+        help_text='The dtype of every preprocessed image, except segmentations (always bytes).',
+    )
+    output_codec = serializers.ChoiceField(
+        choices=OutputCodec.choices,
+        default=OutputCodec.GZIP,
+        help_text='How preprocessed images are compressed.',
+    )
+    compression_level = serializers.IntegerField(
+        min_value=1, max_value=9, default=6, help_text='The gzip compression level.'
+    )
+    feature_storage = serializers.ChoiceField(
+        choices=FeatureStorage.choices,
+        default=FeatureStorage.DENSE,
+        help_text='Whether feature images are stored as dense volumes, as their values within'
+        ' the brain mask, or both.',
+    )
+    derive_only = serializers.BooleanField(
+        default=False,
+        help_text='Reuse the registrations and segmentations of the current preprocessing batch,'
+        ' only recomputing Jacobians and feature images. The registration profile is ignored.',
+    )
+
+
+class AnalysisSerializer(serializers.Serializer):
+    backend = serializers.ChoiceField(
+        choices=AnalysisResult.Backend.choices,
+        default=AnalysisResult.Backend.UTM,
+        help_text='What computes the analysis. The VBM backend only computes correlation maps,'
+        ' but is much faster.',
+    )
+    force = serializers.BooleanField(
+        default=False,
+        help_text='Run the analysis, even if an identical one (of the same feature images,'
+        ' metadata and backend version) has finished, whose results would otherwise be reused.',
+    )
 
 
 class PreprocessResponseSerializer(serializers.Serializer):
@@ -149,16 +241,8 @@ class DatasetViewSet(ModelViewSet):
         responses={200: DatasetDetailSerializer()},
     )
     def retrieve(self, request, pk):
-        # Annotate image count and if uploads exist
-        queryset = self.filter_queryset(self.get_queryset())
-        queryset = queryset.annotate(
-            image_count=Count('images', distinct=True),
-            uploads_active=Exists(
-                UploadBatch.objects.filter(dataset_id=OuterRef('id')),
-            ),
-        )
-
         # Retrieve dataset and check permissions
+        queryset = self.filter_queryset(self.get_queryset())
         dataset = get_object_or_404(queryset, id=pk)
         self.check_object_permissions(self.request, dataset)
 
@@ -198,7 +282,7 @@ class DatasetViewSet(ModelViewSet):
         # Filter name
         name = serializer.validated_data.get('name')
         if name:
-            queryset = queryset.filter(name__icontains=name)
+            queryset = search_by_name(queryset, name, ranked=serializer.validated_data['ranked'])
 
         # Build response
         return self.get_paginated_response(
@@ -312,11 +396,13 @@ class DatasetViewSet(ModelViewSet):
 
     @swagger_auto_schema(
         operation_description='Start preprocessing on a dataset.',
-        request_body=no_body,
+        request_body=PreprocessSerializer(),
         responses={200: PreprocessingBatchSerializer()},
     )
     @action(detail=True, methods=['POST'])
     def preprocess(self, request, pk: str):
+        serializer = PreprocessSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
         dataset: Dataset = self.get_object()
         if (
             dataset.current_preprocessing_batch is not None
@@ -328,9 +414,41 @@ class DatasetViewSet(ModelViewSet):
         # Check against empty runs
         if not dataset.images.count():
             raise serializers.ValidationError('Cannot run preprocessing on empty dataset.')
+        if not dataset.images.exclude(validation_status=Image.ValidationStatus.INVALID).exists():
+            raise serializers.ValidationError('Cannot run preprocessing with no valid images.')
+
+        # Derive-only batches need the transforms of every registration they derive from
+        derived_from = None
+        registration_profile = serializer.validated_data['registration_profile']
+        if serializer.validated_data['derive_only']:
+            derived_from = dataset.current_preprocessing_batch
+            if derived_from is None or derived_from.status != PreprocessingBatch.Status.FINISHED:
+                raise serializers.ValidationError(
+                    'Deriving requires a finished preprocessing batch.'
+                )
+            if RegisteredImage.objects.filter(
+                preprocessing_batch=derived_from, affine_transform=''
+            ).exists():
+                raise serializers.ValidationError(
+                    'The current preprocessing batch has no stored transforms.'
+                )
+            registration_profile = derived_from.registration_profile
 
         # Create new preprocessing batch
-        batch = PreprocessingBatch.objects.create(dataset=dataset, atlas=Atlas.default_atlas())
+        batch = PreprocessingBatch.objects.create(
+            dataset=dataset,
+            atlas=derived_from.atlas if derived_from else Atlas.default_atlas(),
+            registration_profile=registration_profile,
+            # Feature images are keyed by tissue and downsample factor, so ignore repeats
+            feature_tissues=list(dict.fromkeys(serializer.validated_data['feature_tissues'])),
+            modulated=serializer.validated_data['modulated'],
+            downsample_factors=list(dict.fromkeys(serializer.validated_data['downsample_factors'])),
+            output_dtype=serializer.validated_data['output_dtype'],
+            output_codec=serializer.validated_data['output_codec'],
+            compression_level=serializer.validated_data['compression_level'],
+            feature_storage=serializer.validated_data['feature_storage'],
+            derived_from=derived_from,
+        )
 
         # Set current batch
         dataset.current_preprocessing_batch = batch
@@ -342,11 +460,13 @@ class DatasetViewSet(ModelViewSet):
 
     @swagger_auto_schema(
         operation_description='Run analysis on a dataset.',
-        request_body=no_body,
+        request_body=AnalysisSerializer(),
         responses={200: PreprocessResponseSerializer()},
     )
     @action(detail=True, methods=['POST'])
     def utm_analysis(self, request, pk: str):
+        serializer = AnalysisSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
         dataset: Dataset = self.get_object()
 
         # Ensure preprocessing was previously run
@@ -359,31 +479,51 @@ class DatasetViewSet(ModelViewSet):
 
         # Create analysis result
         analysis: AnalysisResult = AnalysisResult.objects.create(
-            preprocessing_batch=dataset.current_preprocessing_batch
+            preprocessing_batch=dataset.current_preprocessing_batch,
+            backend=serializer.validated_data['backend'],
         )
 
         # Set current analysis result
         dataset.current_analysis_result = analysis
-        dataset.save()
+        dataset.save(update_fields=['current_analysis_result'])
 
         # Dispatch task
-        run_utm.delay(analysis.id)
+        run_utm.delay(analysis.id, force=serializer.validated_data['force'])
         return Response(None, status=status.HTTP_204_NO_CONTENT)
 
     @swagger_auto_schema(
-        operation_description='Retrieve all dataset images.',
+        operation_description='Retrieve all dataset images.'
+        ' Images may be filtered by metadata, using parameters of the form'
+        ' `metadata__<key>` (equality), `metadata__<key>__in` (comma separated values),'
+        ' or `metadata__<key>__gt`, `__gte`, `__lt`, `__lte` (numeric ranges).',
         query_serializer=LimitOffsetSerializer(),
     )
     @action(detail=True, methods=['GET'])
     def images(self, request, pk: str):
         dataset: Dataset = self.get_object()
-        images = Image.objects.filter(dataset=dataset).order_by('name')
+        images = (
+            Image.objects.filter(dataset=dataset)
+            .filter(metadata_filter(request.query_params, dataset_covariates(dataset)))
+            .prefetch_related('covariate_values__covariate')
+            .order_by('name')
+        )
         return self.get_paginated_response(
             ImageSerializer(self.paginate_queryset(images), many=True).data
         )
 
     @swagger_auto_schema(
-        operation_description='Create Upload Batch.',
+        operation_description="List this dataset's covariates (typed metadata columns).",
+        responses={200: CovariateSerializer(many=True)},
+    )
+    @action(detail=True, methods=['GET'], pagination_class=None)
+    def covariates(self, request, pk: str):
+        dataset: Dataset = self.get_object()
+        serializer = CovariateSerializer(dataset.covariates.all(), many=True)
+        return Response(serializer.data)
+
+    @swagger_auto_schema(
+        operation_description='Create Upload Batch.'
+        " Invalid rows of the CSV are skipped, and reported in the batch's `errors`.",
         request_body=CreateBatchSerializer(),
     )
     @action(detail=True, methods=['POST'])
@@ -399,6 +539,10 @@ class DatasetViewSet(ModelViewSet):
             batch = load_batch_from_csv(csvfile, dataset=dataset)
         except IntegrityError:
             raise serializers.ValidationError('No new images (all included images already exist)')
+        except ValidationError as e:
+            raise serializers.ValidationError(e.messages)
+        except UnicodeDecodeError:
+            raise serializers.ValidationError('CSV must be UTF-8 encoded.')
 
         serializer = UploadBatchSerializer(batch)
         return Response(serializer.data, status=201)
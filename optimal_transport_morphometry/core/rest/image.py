@@ -1,25 +1,55 @@
+from typing import Dict, List
+
 from django.contrib.auth.models import User
 from django.db import transaction
+from django.db.models import F, prefetch_related_objects
 from django.http import HttpResponseRedirect
-from django.shortcuts import get_object_or_404
 from django_filters import rest_framework as filters
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import mixins, serializers
 from rest_framework.decorators import action
-from rest_framework.exceptions import NotAuthenticated, PermissionDenied
+from rest_framework.exceptions import NotAuthenticated, NotFound, PermissionDenied
 from rest_framework.permissions import SAFE_METHODS, BasePermission
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 
-from optimal_transport_morphometry.core.models import Dataset, Image, PendingUpload
+from optimal_transport_morphometry.core.models import (
+    CovariateValue,
+    Dataset,
+    Image,
+    PendingUpload,
+)
+from optimal_transport_morphometry.core.models.blob import reference_blobs
+from optimal_transport_morphometry.core.models.covariate import (
+    dataset_covariates,
+    image_covariate_values,
+)
+from optimal_transport_morphometry.core.tasks import validate_images
 
 
 class ImageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Image
-        fields = ['id', 'name', 'type', 'dataset', 'metadata']
-        read_only_fields = ['type', 'dataset', 'metadata']
+        fields = [
+            'id',
+            'name',
+            'type',
+            'dataset',
+            'metadata',
+            'size',
+            'checksum',
+            'validation_status',
+            'validation_error',
+            'dimensions',
+            'voxel_size',
+            'datatype',
+            'orientation',
+        ]
+        read_only_fields = fields
+
+    # Querysets should prefetch 'covariate_values__covariate'
+    metadata = serializers.DictField(source='all_metadata', read_only=True)
 
 
 class CreateImageSerializer(serializers.ModelSerializer):
@@ -30,6 +60,84 @@ class CreateImageSerializer(serializers.ModelSerializer):
     pending_upload = serializers.IntegerField()
 
 
+class BulkCreateImageSerializer(serializers.Serializer):
+    images = CreateImageSerializer(many=True, allow_empty=False, max_length=1000)
+
+    def validate_images(self, images: List[dict]):
+        pending_upload_ids = [image['pending_upload'] for image in images]
+        if len(set(pending_upload_ids)) != len(pending_upload_ids):
+            raise serializers.ValidationError('Each pending upload may only be included once.')
+
+        return images
+
+
+def finalize_uploads(user: User, images: List[dict]) -> List[Image]:
+    """
+    Create an image from each pending upload and blob, and delete the pending uploads.
+
+    Each blob is an object key in storage, optionally with its `size` and `checksum` if already
+    known. Otherwise they're recorded once the blob is validated. Raises NotFound if any pending
+    upload isn't visible to the user, and PermissionDenied if the user can't write to any of their
+    datasets.
+    """
+    pending_upload_ids = [image['pending_upload'] for image in images]
+
+    # Fetch all allowed uploads at once
+    uploads: Dict[int, PendingUpload] = (
+        PendingUpload.objects.filter(batch__dataset_id__in=Dataset.visible_datasets(user))
+        .select_related('batch__dataset')
+        .in_bulk(pending_upload_ids)
+    )
+    missing = [pk for pk in pending_upload_ids if pk not in uploads]
+    if missing:
+        raise NotFound(f'Pending uploads not found: {missing}')
+
+    # Ensure user has write access, checking each dataset once
+    datasets: Dict[int, Dataset] = {
+        upload.batch.dataset_id: upload.batch.dataset for upload in uploads.values()
+    }
+    for dataset in datasets.values():
+        if dataset.user_access(user) is None:
+            raise PermissionDenied()
+
+    covariates = {pk: dataset_covariates(dataset) for pk, dataset in datasets.items()}
+    created: List[Image] = []
+    covariate_values: List[CovariateValue] = []
+    for image in images:
+        upload = uploads[image['pending_upload']]
+        dataset = upload.batch.dataset
+        created.append(
+            Image(
+                blob=image['blob'],
+                name=upload.name,
+                dataset=dataset,
+                size=image.get('size'),
+                checksum=image.get('checksum', ''),
+            )
+        )
+        covariate_values.extend(
+            image_covariate_values(created[-1], upload.metadata, covariates[dataset.id])
+        )
+
+    # Create all at once, and update the counts since bulk_create bypasses signals
+    Image.objects.bulk_create(created)
+    CovariateValue.objects.bulk_create(covariate_values)
+    reference_blobs(created)
+    for dataset_id in datasets:
+        count = sum(1 for image in created if image.dataset_id == dataset_id)
+        Dataset.objects.filter(pk=dataset_id).update(image_count=F('image_count') + count)
+
+    # Completed batches are deleted once this is committed
+    PendingUpload.objects.filter(pk__in=pending_upload_ids).delete()
+
+    # Blobs are validated asynchronously, since their headers must be read from storage
+    image_ids = [image.id for image in created]
+    transaction.on_commit(lambda: validate_images.delay(image_ids))
+
+    prefetch_related_objects(created, 'covariate_values__covariate')
+    return created
+
+
 class ImagePermissions(BasePermission):
     def has_permission(self, request: Request, view):
         # Only endpoint that this hits is create
@@ -57,13 +165,15 @@ class ImageViewSet(
     mixins.RetrieveModelMixin,
     GenericViewSet,
 ):
-    queryset = Image.objects.select_related('dataset').all()
+    queryset = Image.objects.select_related('dataset').prefetch_related(
+        'covariate_values__covariate'
+    )
 
     permission_classes = [ImagePermissions]
     serializer_class = ImageSerializer
 
     filter_backends = [filters.DjangoFilterBackend]
-    filterset_fields = ['dataset']
+    filterset_fields = ['dataset', 'validation_status']
 
     def get_queryset(self):
         # Get all allowed images
@@ -84,31 +194,23 @@ class ImageViewSet(
     def create(self, request):
         serializer = CreateImageSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        blob = serializer.validated_data['blob']
 
-        # Construct queryset of allowed pending uploads
-        queryset = PendingUpload.objects.filter(
-            batch__dataset_id__in=Dataset.visible_datasets(self.request.user)
-        )
-
-        # Fetch upload or 404
-        upload: PendingUpload = get_object_or_404(
-            queryset.select_related('batch__dataset'),
-            pk=serializer.validated_data['pending_upload'],
-        )
+        (image,) = finalize_uploads(request.user, [serializer.validated_data])
+        serializer = self.get_serializer(image)
+        return Response(serializer.data)
 
-        # If found, ensure user has write access
-        dataset: Dataset = upload.batch.dataset
-        if dataset.user_access(request.user) is None:
-            raise PermissionDenied()
+    @transaction.atomic
+    @swagger_auto_schema(
+        operation_description='Create many images at once, from pending uploads and their blobs.'
+        ' Either all images are created, or none are.',
+        request_body=BulkCreateImageSerializer(),
+        responses={200: ImageSerializer(many=True)},
+    )
+    @action(detail=False, methods=['POST'])
+    def bulk(self, request):
+        serializer = BulkCreateImageSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
 
-        # TODO validate existence of key in storage
-        image = Image.objects.create(
-            blob=blob,
-            name=upload.name,
-            metadata=upload.metadata,
-            dataset=upload.batch.dataset,
-        )
-        upload.delete()
-        serializer = self.get_serializer(image)
+        images = finalize_uploads(request.user, serializer.validated_data['images'])
+        serializer = self.get_serializer(images, many=True)
         return Response(serializer.data)
@@ -0,0 +1,99 @@
+import json
+from typing import Dict, Optional
+
+from django.db import models
+from django.http import QueryDict
+from rest_framework import serializers
+
+from optimal_transport_morphometry.core.models import Covariate, CovariateValue
+from optimal_transport_morphometry.core.models.metadata import parse_metadata_value
+
+METADATA_PARAM_PREFIX = 'metadata__'
+RANGE_OPERATORS = {'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+
+
+def _parse_param(param: str):
+    key, operator = param[len(METADATA_PARAM_PREFIX) :], 'exact'
+    if '__' in key:
+        head, tail = key.rsplit('__', 1)
+        if tail == 'in' or tail in RANGE_OPERATORS:
+            key, operator = head, tail
+
+    if not key:
+        raise serializers.ValidationError({param: 'A metadata key must be specified.'})
+
+    return key, operator
+
+
+def _covariate_predicate(
+    param: str, operator: str, raw_value: str, covariate: Covariate
+) -> models.Q:
+    if operator == 'exact':
+        encoded = [covariate.encode(parse_metadata_value(raw_value))]
+    elif operator == 'in':
+        encoded = [covariate.encode(parse_metadata_value(val)) for val in raw_value.split(',')]
+    else:
+        value = parse_metadata_value(raw_value)
+        if not covariate.numeric:
+            raise serializers.ValidationError({param: f'"{covariate.name}" is not numeric.'})
+        if not isinstance(value, (int, float)):
+            raise serializers.ValidationError({param: f'"{raw_value}" is not a number.'})
+
+        encoded = None
+        lookup = {f'value__{operator}': value}
+
+    if encoded is not None:
+        # Values which can't be represented by this covariate can't match any image
+        lookup = {'value__in': [val for val in encoded if val is not None]}
+
+    values = CovariateValue.objects.filter(
+        image=models.OuterRef('pk'), covariate=covariate, **lookup
+    )
+    return models.Q(models.Exists(values))
+
+
+def _predicate(param: str, raw_value: str) -> str:
+    key, operator = _parse_param(param)
+    path = f'$.{json.dumps(key)}'
+
+    if operator == 'exact':
+        return f'{path} == {json.dumps(parse_metadata_value(raw_value))}'
+
+    if operator == 'in':
+        values = [parse_metadata_value(val) for val in raw_value.split(',')]
+        return ' || '.join(f'{path} == {json.dumps(val)}' for val in values)
+
+    # Range operators only apply to numbers
+    value = parse_metadata_value(raw_value)
+    if not isinstance(value, (int, float)):
+        raise serializers.ValidationError({param: f'"{raw_value}" is not a number.'})
+
+    return f'{path} {RANGE_OPERATORS[operator]} {json.dumps(value)}'
+
+
+def metadata_filter(
+    query_params: QueryDict, covariates: Optional[Dict[str, Covariate]] = None
+) -> models.Q:
+    """
+    Return an image filter, built from query parameters of the form `metadata__<key>`.
+
+    A key may be suffixed with an operator: `__in` (comma separated values), or one of the
+    numeric range operators `__gt`, `__gte`, `__lt` and `__lte`. Values are typed the same
+    way as uploaded CSV values, so `metadata__CDR=0.5` matches the number 0.5. Keys which are
+    one of the given covariates are filtered on their covariate values, and any other keys on
+    the remaining `metadata`.
+    """
+    covariates = covariates or {}
+    query = models.Q()
+    for param in query_params:
+        if not param.startswith(METADATA_PARAM_PREFIX):
+            continue
+
+        key, operator = _parse_param(param)
+        for raw_value in query_params.getlist(param):
+            if key in covariates:
+                query &= _covariate_predicate(param, operator, raw_value, covariates[key])
+            else:
+                query &= models.Q(metadata__matches_jsonpath=_predicate(param, raw_value))
+
+    return query
@@ -1,3 +1,5 @@
+import itertools
+
 from django.shortcuts import get_object_or_404
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import mixins, serializers
@@ -9,12 +11,14 @@ from rest_framework.viewsets import GenericViewSet
 from optimal_transport_morphometry.core.models import (
     Dataset,
     FeatureImage,
+    FeatureMask,
+    Image,
     JacobianImage,
+    PreprocessedImage,
     PreprocessingBatch,
     RegisteredImage,
     SegmentedImage,
 )
-from optimal_transport_morphometry.core.models.image import Image
 from optimal_transport_morphometry.core.rest.image import ImageSerializer
 from optimal_transport_morphometry.core.rest.serializers import LimitOffsetSerializer
 
@@ -31,7 +35,21 @@ PREPROCESSED_IMAGE_FIELDS = [
 class FeatureImageSerializer(serializers.ModelSerializer):
     class Meta:
         model = FeatureImage
-        fields = PREPROCESSED_IMAGE_FIELDS + ['downsample_factor']
+        fields = PREPROCESSED_IMAGE_FIELDS + ['tissue', 'downsample_factor', 'values']
+
+
+class FeatureMaskSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = FeatureMask
+        fields = [
+            'id',
+            'kind',
+            'tissue',
+            'downsample_factor',
+            'blob',
+            'voxel_count',
+            'voxel_index',
+        ]
 
 
 class JacobianImageSerializer(serializers.ModelSerializer):
@@ -44,7 +62,14 @@ class JacobianImageSerializer(serializers.ModelSerializer):
 class RegisteredImageSerializer(serializers.ModelSerializer):
     class Meta:
         model = RegisteredImage
-        fields = PREPROCESSED_IMAGE_FIELDS + ['registration_type']
+        fields = PREPROCESSED_IMAGE_FIELDS + [
+            'registration_type',
+            'registration_parameters',
+            'registration_runtime',
+            'affine_transform',
+            'warp_transform',
+            'inverse_warp_transform',
+        ]
 
 
 class SegmentedImageSerializer(serializers.ModelSerializer):
@@ -56,7 +81,24 @@ class SegmentedImageSerializer(serializers.ModelSerializer):
 class PreprocessingBatchSerializer(serializers.ModelSerializer):
     class Meta:
         model = PreprocessingBatch
-        fields = ['id', 'created', 'modified', 'dataset', 'atlas', 'status', 'error_message']
+        fields = [
+            'id',
+            'created',
+            'modified',
+            'dataset',
+            'atlas',
+            'registration_profile',
+            'feature_tissues',
+            'modulated',
+            'downsample_factors',
+            'output_dtype',
+            'output_codec',
+            'compression_level',
+            'feature_storage',
+            'derived_from',
+            'status',
+            'error_message',
+        ]
 
 
 class PreprocessingBatchDetailSerializer(serializers.ModelSerializer):
@@ -68,6 +110,15 @@ class PreprocessingBatchDetailSerializer(serializers.ModelSerializer):
             'modified',
             'dataset',
             'atlas',
+            'registration_profile',
+            'feature_tissues',
+            'modulated',
+            'downsample_factors',
+            'output_dtype',
+            'output_codec',
+            'compression_level',
+            'feature_storage',
+            'derived_from',
             'status',
             'error_message',
             'current_image_name',
@@ -80,10 +131,9 @@ class PreprocessingBatchDetailSerializer(serializers.ModelSerializer):
     expected_image_count = serializers.IntegerField()
 
 
-class ImageGroupSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = Image
-        new_fields = ['registered', 'jacobian', 'segmented', 'feature']
+class ImageGroupSerializer(ImageSerializer):
+    class Meta(ImageSerializer.Meta):
+        new_fields = ['registered', 'jacobian', 'segmented', 'feature', 'features']
         fields = ImageSerializer.Meta.fields + new_fields
         read_only_fields = ImageSerializer.Meta.fields + new_fields
 
@@ -91,6 +141,7 @@ class ImageGroupSerializer(serializers.ModelSerializer):
     jacobian = JacobianImageSerializer(allow_null=True)
     segmented = SegmentedImageSerializer(allow_null=True)
     feature = FeatureImageSerializer(allow_null=True)
+    features = FeatureImageSerializer(many=True)
 
 
 class PreprocessingBatchViewSet(mixins.RetrieveModelMixin, GenericViewSet):
@@ -110,16 +161,14 @@ class PreprocessingBatchViewSet(mixins.RetrieveModelMixin, GenericViewSet):
         batch: PreprocessingBatch = get_object_or_404(queryset, pk=pk)
 
         # Compute progress by counting all preprocessed images,
-        # compared against the total expected image count
-        batch.expected_image_count = batch.dataset.images.count() * 4.0
+        # compared against the total expected image count (of every valid image)
+        batch.expected_image_count = (
+            batch.dataset.images.filter(validation_status=Image.ValidationStatus.VALID).count()
+            * batch.outputs_per_image
+        )
         batch.progress = 0
         if batch.expected_image_count > 0:
-            batch.progress = (
-                FeatureImage.objects.filter(preprocessing_batch=batch).count()
-                + JacobianImage.objects.filter(preprocessing_batch=batch).count()
-                + RegisteredImage.objects.filter(preprocessing_batch=batch).count()
-                + SegmentedImage.objects.filter(preprocessing_batch=batch).count()
-            ) / batch.expected_image_count
+            batch.progress = batch.preprocessed_images.count() / batch.expected_image_count
 
         # Add image currently being worked on
         batch.current_image_name = getattr(batch.current_image(), 'name', None)
@@ -136,21 +185,43 @@ class PreprocessingBatchViewSet(mixins.RetrieveModelMixin, GenericViewSet):
     @action(detail=True, methods=['GET'])
     def images(self, request, pk: str):
         batch: PreprocessingBatch = self.get_object()
-        batch_images = self.paginate_queryset(batch.source_images().order_by('name'))
+        batch_images = self.paginate_queryset(
+            batch.source_images().order_by('name').prefetch_related('covariate_values__covariate')
+        )
 
         # Create map and start assigning processed images to each
-        # We do this so we can make ~4 queries, as opposed to O(n) queries
+        # We do this so we can make a single query, as opposed to O(n) queries
         image_map = {im.id: im for im in batch_images}
-        image_classes = [
-            (RegisteredImage, 'registered'),
-            (JacobianImage, 'jacobian'),
-            (SegmentedImage, 'segmented'),
-            (FeatureImage, 'feature'),
-        ]
-        for klass, key in image_classes:
-            qs = klass.objects.filter(source_image__in=batch_images)
-            for image in qs.iterator():
-                setattr(image_map[image.source_image_id], key, image)
+        for im, kind in itertools.product(batch_images, PreprocessedImage.Kind.values):
+            setattr(im, kind, None)
+        for im in batch_images:
+            im.features = []
+        qs = PreprocessedImage.objects.filter(
+            preprocessing_batch=batch, source_image__in=batch_images
+        )
+        for image in qs.iterator():
+            source_image = image_map[image.source_image_id]
+            if image.kind != PreprocessedImage.Kind.FEATURE:
+                setattr(source_image, image.kind, image)
+                continue
+
+            # Every feature image is listed, and the first tissue and downsample factor is primary
+            source_image.features.append(image)
+            primary = (batch.feature_tissues[0], batch.downsample_factors[0])
+            if (image.tissue, image.downsample_factor) == primary:
+                source_image.feature = image
 
         serializer = ImageGroupSerializer(image_map.values(), many=True)
         return self.get_paginated_response(serializer.data)
+
+    @swagger_auto_schema(
+        operation_description='Retrieve the feature masks of a preprocessing batch: the support'
+        ' which sparse feature images are stored within and, once the batch is finished, the'
+        ' union and intersection of its feature images.',
+        responses={200: FeatureMaskSerializer(many=True)},
+    )
+    @action(detail=True, methods=['GET'])
+    def masks(self, request, pk: str):
+        batch: PreprocessingBatch = self.get_object()
+        masks = batch.feature_masks.order_by('kind', 'tissue', 'downsample_factor')
+        return Response(FeatureMaskSerializer(masks, many=True).data)
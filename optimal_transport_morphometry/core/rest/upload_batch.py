@@ -1,25 +1,147 @@
+from typing import Dict, List
+
+from django.db import transaction
 from django_filters import rest_framework as filters
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import parsers, serializers
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotAuthenticated, NotFound, PermissionDenied
 from rest_framework.mixins import RetrieveModelMixin
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 
-from optimal_transport_morphometry.core.models import Dataset, PendingUpload, UploadBatch
+from optimal_transport_morphometry.core import multipart
+from optimal_transport_morphometry.core.models import Dataset, Image, PendingUpload, UploadBatch
+from optimal_transport_morphometry.core.rest.image import ImageSerializer, finalize_uploads
 from optimal_transport_morphometry.core.rest.pending_upload import PendingUploadSerializer
 from optimal_transport_morphometry.core.rest.serializers import LimitOffsetSerializer
+from optimal_transport_morphometry.core.search import search_by_name
 
 
 class PendingUploadListRequestSerializer(LimitOffsetSerializer):
     name = serializers.CharField(required=False)
+    ranked = serializers.BooleanField(
+        default=False, help_text='Include similar names, ordered by similarity to the name filter.'
+    )
 
 
 class UploadBatchSerializer(serializers.ModelSerializer):
     class Meta:
         model = UploadBatch
-        fields = ['id', 'created', 'dataset']
+        fields = ['id', 'created', 'dataset', 'errors', 'unrecorded_errors']
+
+
+class MultipartInitializeUploadSerializer(serializers.Serializer):
+    pending_upload = serializers.IntegerField()
+    size = serializers.IntegerField(min_value=0)
+    content_type = serializers.CharField(required=False, allow_blank=True)
+
+
+def _validate_unique_uploads(uploads: List[dict]) -> List[dict]:
+    pending_upload_ids = [upload['pending_upload'] for upload in uploads]
+    if len(set(pending_upload_ids)) != len(pending_upload_ids):
+        raise serializers.ValidationError('Each pending upload may only be included once.')
+
+    return uploads
+
+
+class MultipartInitializeSerializer(serializers.Serializer):
+    uploads = MultipartInitializeUploadSerializer(many=True, allow_empty=False, max_length=1000)
+
+    def validate_uploads(self, uploads: List[dict]):
+        return _validate_unique_uploads(uploads)
+
+
+class MultipartPartSerializer(serializers.Serializer):
+    part_number = serializers.IntegerField(min_value=1, max_value=multipart.MAX_PARTS)
+    size = serializers.IntegerField(read_only=True)
+    md5 = serializers.CharField(
+        write_only=True, help_text='The base64 encoded MD5 digest of the part.'
+    )
+
+    def validate_md5(self, md5: str) -> str:
+        try:
+            multipart.md5_hex(md5)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+
+        return md5
+
+
+class UploadedPartSerializer(serializers.Serializer):
+    part_number = serializers.IntegerField()
+    etag = serializers.CharField(help_text='The hex encoded MD5 digest of the part.')
+
+
+class MultipartUploadSerializer(serializers.Serializer):
+    pending_upload = serializers.IntegerField()
+    object_key = serializers.CharField()
+    upload_id = serializers.CharField()
+    parts = MultipartPartSerializer(many=True)
+    uploaded_parts = UploadedPartSerializer(
+        many=True, help_text='Parts which have already been uploaded.'
+    )
+
+
+class MultipartPresignPartSerializer(MultipartPartSerializer):
+    pending_upload = serializers.IntegerField()
+    upload_url = serializers.URLField(read_only=True)
+
+
+class MultipartPresignSerializer(serializers.Serializer):
+    parts = MultipartPresignPartSerializer(many=True, allow_empty=False, max_length=10000)
+
+
+class MultipartCompleteUploadSerializer(serializers.Serializer):
+    pending_upload = serializers.IntegerField()
+    parts = MultipartPartSerializer(many=True, allow_empty=False)
+
+
+class MultipartCompleteSerializer(serializers.Serializer):
+    uploads = MultipartCompleteUploadSerializer(many=True, allow_empty=False, max_length=1000)
+
+    def validate_uploads(self, uploads: List[dict]):
+        return _validate_unique_uploads(uploads)
+
+
+def _verify_parts(upload: PendingUpload, parts: List[dict]) -> Dict[int, str]:
+    """
+    Verify that every part of an upload is in storage, and matches its expected MD5.
+
+    Returns the ETag of each part, for completion.
+    """
+    expected = dict(multipart.part_sizes(upload.size))
+    if sorted(part['part_number'] for part in parts) != sorted(expected):
+        raise serializers.ValidationError(
+            {str(upload.id): f'Expected parts 1 to {len(expected)}, each exactly once.'}
+        )
+
+    try:
+        uploaded = multipart.uploaded_parts(upload.object_key, upload.upload_id)
+    except multipart.UploadNotFoundError:
+        # It may have been completed by an earlier request which then failed, so its parts can't
+        # be listed. Completion instead checks the object's ETag against the parts' MD5s.
+        return {part['part_number']: multipart.md5_hex(part['md5']) for part in parts}
+
+    etags = {}
+    for part in parts:
+        part_number = part['part_number']
+        stored = uploaded.get(part_number)
+        if stored is None:
+            raise serializers.ValidationError({str(upload.id): f'Part {part_number} is missing.'})
+        if stored['size'] != expected[part_number]:
+            raise serializers.ValidationError(
+                {str(upload.id): f'Part {part_number} should be {expected[part_number]} bytes.'}
+            )
+        if stored['etag'] != multipart.md5_hex(part['md5']):
+            raise serializers.ValidationError(
+                {str(upload.id): f'Part {part_number} does not match its checksum.'}
+            )
+
+        etags[part_number] = stored['etag']
+
+    return etags
 
 
 class UploadBatchViewSet(RetrieveModelMixin, GenericViewSet):
@@ -36,6 +158,21 @@ class UploadBatchViewSet(RetrieveModelMixin, GenericViewSet):
         datasets = Dataset.visible_datasets(self.request.user)
         return self.queryset.filter(dataset__in=datasets)
 
+    def _get_pending_uploads(self, pending_upload_ids: List[int]) -> Dict[int, PendingUpload]:
+        """Return pending uploads of this batch, which the user must be able to write to."""
+        batch: UploadBatch = self.get_object()
+        if not self.request.user.is_authenticated:
+            raise NotAuthenticated()
+        if batch.dataset.user_access(self.request.user) is None:
+            raise PermissionDenied()
+
+        uploads = batch.pending_uploads.in_bulk(pending_upload_ids)
+        missing = sorted(set(pending_upload_ids) - set(uploads))
+        if missing:
+            raise NotFound(f'Pending uploads not found in this batch: {missing}')
+
+        return uploads
+
     @swagger_auto_schema(
         operation_description='List pending uploads for a batch.',
         query_serializer=PendingUploadListRequestSerializer(),
@@ -46,14 +183,14 @@ class UploadBatchViewSet(RetrieveModelMixin, GenericViewSet):
         serializer = PendingUploadListRequestSerializer(data=request.query_params)
         serializer.is_valid(raise_exception=True)
 
-        # Retrieve all pending uploads
+        # Retrieve all pending uploads, in a stable order so that pages don't overlap
         batch: UploadBatch = self.get_object()
-        queryset = PendingUpload.objects.filter(batch_id=batch.id)
+        queryset = PendingUpload.objects.filter(batch_id=batch.id).order_by('id')
 
         # Filter by name if desired
         name = serializer.validated_data.get('name')
         if name is not None:
-            queryset = queryset.filter(name__icontains=name)
+            queryset = search_by_name(queryset, name, ranked=serializer.validated_data['ranked'])
 
         # Paginate and return
         page = self.paginate_queryset(queryset)
@@ -63,3 +200,139 @@ class UploadBatchViewSet(RetrieveModelMixin, GenericViewSet):
 
         serializer = PendingUploadSerializer(queryset, many=True)
         return Response(serializer.data)
+
+    @swagger_auto_schema(
+        operation_description='Start, or resume, multipart uploads of many pending uploads.'
+        ' Each upload is split into parts, which are presigned with the `multipart_presign`'
+        ' endpoint. If an upload of the same size is already in progress, it is resumed, and'
+        ' the parts which were already uploaded are listed, so that only missing or corrupt'
+        ' parts need to be uploaded again.',
+        request_body=MultipartInitializeSerializer(),
+        responses={200: MultipartUploadSerializer(many=True)},
+    )
+    @action(detail=True, methods=['POST'])
+    def multipart_initialize(self, request, pk):
+        serializer = MultipartInitializeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        requested = serializer.validated_data['uploads']
+        uploads = self._get_pending_uploads([upload['pending_upload'] for upload in requested])
+
+        results = []
+        for upload_request in requested:
+            upload = uploads[upload_request['pending_upload']]
+            uploaded_parts = None
+            if upload.upload_id and upload.size == upload_request['size']:
+                try:
+                    uploaded_parts = multipart.uploaded_parts(upload.object_key, upload.upload_id)
+                except multipart.UploadNotFoundError:
+                    # It was completed or aborted, so a new upload is started
+                    pass
+
+            if uploaded_parts is None:
+                uploaded_parts = {}
+                if upload.upload_id:
+                    multipart.abort_upload(upload.object_key, upload.upload_id)
+
+                upload.object_key = Image._meta.get_field('blob').generate_filename(
+                    None, upload.name
+                )
+                upload.upload_id = multipart.create_upload(
+                    upload.object_key, upload_request.get('content_type')
+                )
+                upload.size = upload_request['size']
+                upload.save(update_fields=['object_key', 'upload_id', 'size'])
+
+            results.append(
+                {
+                    'pending_upload': upload.id,
+                    'object_key': upload.object_key,
+                    'upload_id': upload.upload_id,
+                    'parts': [
+                        {'part_number': part_number, 'size': size}
+                        for part_number, size in multipart.part_sizes(upload.size)
+                    ],
+                    'uploaded_parts': [
+                        {'part_number': part_number, 'etag': part['etag']}
+                        for part_number, part in sorted(uploaded_parts.items())
+                    ],
+                }
+            )
+
+        return Response(MultipartUploadSerializer(results, many=True).data)
+
+    @swagger_auto_schema(
+        operation_description='Presign many upload parts, across any number of pending uploads.'
+        ' Each part must be PUT to its URL with a `Content-MD5` header matching its `md5`.',
+        request_body=MultipartPresignSerializer(),
+        responses={200: MultipartPresignPartSerializer(many=True)},
+    )
+    @action(detail=True, methods=['POST'])
+    def multipart_presign(self, request, pk):
+        serializer = MultipartPresignSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        parts = serializer.validated_data['parts']
+        uploads = self._get_pending_uploads(list({part['pending_upload'] for part in parts}))
+        for part in parts:
+            upload = uploads[part['pending_upload']]
+            if not upload.upload_id:
+                raise serializers.ValidationError(
+                    {str(upload.id): 'Multipart upload has not been initialized.'}
+                )
+
+            part['upload_url'] = multipart.presign_part(
+                upload.object_key, upload.upload_id, part['part_number'], part['md5']
+            )
+
+        return Response(MultipartPresignPartSerializer(parts, many=True).data)
+
+    @transaction.atomic
+    @swagger_auto_schema(
+        operation_description='Complete multipart uploads, and create their images.'
+        ' Every part is verified against its MD5 before any upload is completed.',
+        request_body=MultipartCompleteSerializer(),
+        responses={200: ImageSerializer(many=True)},
+    )
+    @action(detail=True, methods=['POST'])
+    def multipart_complete(self, request, pk):
+        serializer = MultipartCompleteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        completions = serializer.validated_data['uploads']
+        uploads = self._get_pending_uploads([upload['pending_upload'] for upload in completions])
+
+        # Verify everything before completing anything. Completion can't be rolled back with the
+        # transaction, but is idempotent, so a failure after it can still simply be retried.
+        verified = []
+        for completion in completions:
+            upload = uploads[completion['pending_upload']]
+            if not upload.upload_id:
+                raise serializers.ValidationError(
+                    {str(upload.id): 'Multipart upload has not been initialized.'}
+                )
+            verified.append((upload, _verify_parts(upload, completion['parts'])))
+
+        images = []
+        for upload, etags in verified:
+            try:
+                etag = multipart.complete_upload(upload.object_key, upload.upload_id, etags)
+            except multipart.UploadNotFoundError:
+                raise serializers.ValidationError(
+                    {str(upload.id): 'Multipart upload no longer exists, and must be initialized.'}
+                )
+            if etag != multipart.multipart_etag([etags[number] for number in sorted(etags)]):
+                raise serializers.ValidationError(
+                    {str(upload.id): 'Completed upload does not match its checksum.'}
+                )
+            images.append(
+                {
+                    'pending_upload': upload.id,
+                    'blob': upload.object_key,
+                    'size': upload.size,
+                    'checksum': etag,
+                }
+            )
+
+        images = finalize_uploads(request.user, images)
+        return Response(ImageSerializer(images, many=True).data)
@@ -0,0 +1,238 @@
+"""
+A pool of long-lived R processes, which run the UTM scripts without starting R for each analysis.
+
+Each worker loads the UTM packages once, then runs each script in a fork of itself (see
+rworker.R for the protocol). Each Celery worker process has its own pool, started when it's
+first used.
+"""
+
+import atexit
+import logging
+import os
+import pathlib
+import queue
+import select
+import subprocess
+import threading
+import time
+from typing import List, Optional, Sequence
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+WORKER_SCRIPT = pathlib.Path(__file__).with_name('rworker.R')
+
+# The packages used by the UTM scripts, which are loaded when each worker starts
+PRELOADED_PACKAGES = [
+    'optparse',
+    'data.table',
+    'foreach',
+    'doParallel',
+    'glmnet',
+    'yaml',
+    'RNifti',
+    'ANTsR',
+    'msr',
+    'gmra',
+    'mop',
+]
+
+# How long a worker may take to load its packages, and to respond to a health check
+START_TIMEOUT = 300
+PING_TIMEOUT = 10
+
+
+class RWorkerError(Exception):
+    """An R worker crashed, or didn't respond."""
+
+
+class RWorkerStartError(RWorkerError):
+    """An R worker couldn't be started."""
+
+
+class RWorker:
+    """A single long-lived R process, which runs one script at a time."""
+
+    def __init__(self, packages: Sequence[str] = PRELOADED_PACKAGES, command: Sequence[str] = ()):
+        self.packages = list(packages)
+
+        # The command which starts the worker, given the response file descriptor and packages
+        self.command = list(command) or ['Rscript', str(WORKER_SCRIPT)]
+        self.process: Optional[subprocess.Popen] = None
+        self._responses: Optional[int] = None
+        self._buffer = b''
+
+    def start(self) -> None:
+        """Start the worker, waiting until its packages are loaded."""
+        read_fd, write_fd = os.pipe()
+        try:
+            self.process = subprocess.Popen(
+                [*self.command, str(write_fd), *self.packages],
+                stdin=subprocess.PIPE,
+                pass_fds=[write_fd],
+            )
+        except OSError as e:
+            os.close(read_fd)
+            raise RWorkerStartError(f'Could not start an R worker: {e}') from e
+        finally:
+            # Only the worker writes responses, so EOF is read once it (and its forks) exit
+            os.close(write_fd)
+
+        self._responses = read_fd
+        self._buffer = b''
+        try:
+            self._expect('READY', START_TIMEOUT)
+        except RWorkerError as e:
+            self.stop()
+            raise RWorkerStartError(str(e)) from e
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def healthy(self) -> bool:
+        """Return whether the worker is running, and responds to a health check."""
+        if not self.alive():
+            return False
+
+        try:
+            self._request('PING')
+            self._expect('PONG', PING_TIMEOUT)
+        except RWorkerError:
+            return False
+
+        return True
+
+    def run(self, script: str, args: List[str], timeout: Optional[float] = None) -> int:
+        """Run an R script with arguments, returning its exit status."""
+        self._request('\t'.join(['RUN', script, *args]))
+        response = self._readline(timeout)
+        kind, _, status = response.partition('\t')
+        if kind != 'DONE':
+            raise RWorkerError(f'Unexpected response from R worker: {response!r}')
+
+        return int(status)
+
+    def stop(self) -> None:
+        """Stop the worker, killing it if it doesn't exit once its requests are closed."""
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(PING_TIMEOUT)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+        if self._responses is not None:
+            os.close(self._responses)
+            self._responses = None
+
+    def _request(self, line: str) -> None:
+        if not self.alive():
+            raise RWorkerError('R worker is not running.')
+
+        try:
+            self.process.stdin.write(f'{line}\n'.encode())
+            self.process.stdin.flush()
+        except OSError as e:
+            raise RWorkerError('R worker exited.') from e
+
+    def _readline(self, timeout: Optional[float]) -> str:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while b'\n' not in self._buffer:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            ready, _, _ = select.select([self._responses], [], [], remaining)
+            if not ready:
+                raise RWorkerError('Timed out waiting for R worker.')
+
+            chunk = os.read(self._responses, 4096)
+            if not chunk:
+                raise RWorkerError(f'R worker exited with status {self.process.wait()}.')
+            self._buffer += chunk
+
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line.decode()
+
+    def _expect(self, response: str, timeout: float) -> None:
+        line = self._readline(timeout)
+        if line != response:
+            raise RWorkerError(f'Expected {response} from R worker, not {line!r}.')
+
+
+class RWorkerPool:
+    """
+    A fixed number of R workers, each running one script at a time.
+
+    Workers are started when they're first needed, and health checked before each script is run.
+    Any which crashed or stopped responding are restarted.
+    """
+
+    def __init__(self, size: int, **worker_kwargs):
+        self._workers: 'queue.Queue[RWorker]' = queue.Queue()
+        for _ in range(size):
+            self._workers.put(RWorker(**worker_kwargs))
+
+    def run(self, script: str, args: List[str], timeout: Optional[float] = None) -> int:
+        """Run an R script in an idle worker, waiting for one if they're all busy."""
+        worker = self._workers.get()
+        try:
+            if not worker.healthy():
+                if worker.process is not None:
+                    logger.warning('Restarting unresponsive R worker')
+                worker.stop()
+                worker.start()
+
+            try:
+                return worker.run(script, args, timeout)
+            except RWorkerError:
+                # It may be mid-request, so is restarted before it's next used
+                worker.stop()
+                raise
+        finally:
+            self._workers.put(worker)
+
+    def close(self) -> None:
+        """Stop every idle worker."""
+        while True:
+            try:
+                worker = self._workers.get_nowait()
+            except queue.Empty:
+                return
+            worker.stop()
+
+
+_pool: Optional[RWorkerPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> Optional[RWorkerPool]:
+    """Return the pool of this process, or None if it's disabled."""
+    global _pool
+
+    if not settings.UTM_R_WORKERS:
+        return None
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = RWorkerPool(settings.UTM_R_WORKERS)
+            atexit.register(_pool.close)
+
+    return _pool
+
+
+def run_r_script(script: str, args: List[str]) -> int:
+    """
+    Run an R script, returning its exit status.
+
+    It's run in this process's pool of R workers, if it's enabled. If a worker can't be started
+    (e.g. a package fails to load), it's run by a new Rscript process instead.
+    """
+    pool = get_pool()
+    if pool is not None:
+        try:
+            return pool.run(script, args)
+        except RWorkerStartError:
+            logger.exception('R worker pool unavailable, running Rscript instead')
+
+    return subprocess.run(['Rscript', script, *args]).returncode
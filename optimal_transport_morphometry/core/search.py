@@ -0,0 +1,45 @@
+from functools import lru_cache
+
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import DEFAULT_DB_ALIAS, connections, models
+from django.db.models.functions import Upper
+
+
+@lru_cache(maxsize=None)
+def trigram_search_available(using: str = DEFAULT_DB_ALIAS) -> bool:
+    """Return whether the pg_trgm extension is installed in the given database."""
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return False
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT EXISTS(SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+        return cursor.fetchone()[0]
+
+
+def search_by_name(
+    queryset: models.QuerySet, value: str, ranked: bool = False, field: str = 'name'
+) -> models.QuerySet:
+    """
+    Filter a queryset to rows whose `field` matches `value`.
+
+    The default mode is a case insensitive substring match, which is served by the
+    `UPPER(field) gin_trgm_ops` indexes when pg_trgm is available. The ranked mode additionally
+    matches similar (misspelled) names, using the `%` operator and `pg_trgm.similarity_threshold`,
+    and orders results by similarity. If pg_trgm is not installed, ranked mode falls back to the
+    substring match, ordered by `field`.
+    """
+    substring_match = models.Q(**{f'{field}__icontains': value})
+    if not ranked:
+        return queryset.filter(substring_match)
+
+    if not trigram_search_available(queryset.db):
+        return queryset.filter(substring_match).order_by(field)
+
+    # Compare against the same expression that's indexed, so the `%` operator can use the index
+    return (
+        queryset.alias(upper_name=Upper(field))
+        .annotate(similarity=TrigramSimilarity(Upper(field), value.upper()))
+        .filter(substring_match | models.Q(upper_name__trigram_similar=value.upper()))
+        .order_by('-similarity', field)
+    )
@@ -0,0 +1,55 @@
+"""
+Sparse feature images, which only store their values within a feature mask.
+
+A mask's voxel index is the indices of its non-zero voxels, when flattened in C order. The values
+of a sparse feature image are in the same order, so the dense volume can always be rebuilt.
+"""
+
+
+def mask_values(img, mask_img):
+    """Return the values of an image within a mask, in the order of the mask's voxel index."""
+    return img.numpy()[mask_img.numpy() > 0]
+
+
+def rehydrate(values, mask_img, fill: float = 0):
+    """Return the dense volume of in-mask values, which is `fill` outside of the mask."""
+    import numpy as np
+
+    mask = mask_img.numpy() > 0
+    if values.shape != (np.count_nonzero(mask),):
+        raise ValueError(f'Expected {np.count_nonzero(mask)} values, not {values.shape}.')
+
+    data = np.full(mask.shape, fill, dtype=values.dtype)
+    data[mask] = values
+    return mask_img.new_image_like(data)
+
+
+def voxel_index(mask_img):
+    """Return the voxel index of a mask."""
+    import numpy as np
+
+    # Every volume has fewer than 2**31 voxels
+    return np.flatnonzero(mask_img.numpy() > 0).astype(np.int32)
+
+
+class MaskReduction:
+    """
+    The union and intersection of where many images are non-zero, added one image at a time.
+
+    Only the two masks are kept, so memory is bounded however many images are added.
+    """
+
+    def __init__(self):
+        self.union = None
+        self.intersection = None
+        self.count = 0
+
+    def add(self, img) -> None:
+        nonzero = img.numpy() != 0
+        if self.union is None:
+            self.union = nonzero
+            self.intersection = nonzero.copy()
+        else:
+            self.union |= nonzero
+            self.intersection &= nonzero
+        self.count += 1
@@ -1,5 +1,6 @@
 import pathlib
-from typing import TYPE_CHECKING, Optional
+import threading
+from typing import TYPE_CHECKING, List, Optional, Tuple
 from urllib.parse import urlparse
 
 import boto3
@@ -23,12 +24,18 @@ except ImportError:
     # This should only be used for type interrogation, never instantiation
     MinioStorage = type('FakeMinioStorage', (), {})
 
+_thread_local = threading.local()
+
 
 def get_boto_client(config: Optional[botocore.client.Config] = None) -> 'S3Client':
     """Return an s3 client from the current storage."""
     storage_class = get_storage_class()
     if issubclass(storage_class, MinioStorage):
-        return boto3.client(
+        # The default session isn't thread-safe, so each thread creates clients from its own
+        session = getattr(_thread_local, 'session', None)
+        if session is None:
+            session = _thread_local.session = boto3.session.Session()
+        return session.client(
             's3',
             endpoint_url=f'http://{settings.MINIO_STORAGE_ENDPOINT}',
             aws_access_key_id=settings.MINIO_STORAGE_ACCESS_KEY,
@@ -54,6 +61,13 @@ def get_bucket_name():
     raise Exception('Unsupported Storage')
 
 
+def head_object(object_key: str, client: Optional['S3Client'] = None) -> Tuple[int, str]:
+    """Return the size and ETag of an object in storage, optionally with an existing client."""
+    client = client or get_boto_client()
+    response = client.head_object(Bucket=get_bucket_name(), Key=object_key)
+    return response['ContentLength'], response['ETag'].strip('"')
+
+
 def resign_s3_url(s3_url: str):
     client = get_boto_client()
 
@@ -83,3 +97,21 @@ def upload_local_file(filepath: str):
         ClientMethod='get_object',
         Params={'Bucket': bucket_name, 'Key': object_key},
     )
+
+
+# The most keys that can be deleted by a single DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+
+
+def delete_objects(object_keys: List[str]) -> None:
+    """Delete many objects from storage, in as few requests as possible."""
+    client = get_boto_client()
+    bucket_name = get_bucket_name()
+    for start in range(0, len(object_keys), DELETE_BATCH_SIZE):
+        client.delete_objects(
+            Bucket=bucket_name,
+            Delete={
+                'Objects': [{'Key': key} for key in object_keys[start : start + DELETE_BATCH_SIZE]],
+                'Quiet': True,
+            },
+        )
@@ -1,21 +1,67 @@
-import csv
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import dataclasses
+import datetime
+import itertools
 import pathlib
 import shutil
-import subprocess
 import tempfile
-from tempfile import NamedTemporaryFile, TemporaryDirectory, mkdtemp
-from typing import List, TextIO
+from tempfile import TemporaryDirectory
+import time
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
 
+from botocore.exceptions import BotoCoreError, ClientError
 from celery import shared_task
-from django.core.files import File
+from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from optimal_transport_morphometry.core import garbage, models
+from optimal_transport_morphometry.core.analysis import (
+    ANALYSIS_BACKENDS,
+    AnalysisError,
+    UTMBackend,
+    analysis_fingerprint,
+)
+from optimal_transport_morphometry.core.encoding import nifti_suffix
+from optimal_transport_morphometry.core.models.blob import reference_blobs
+from optimal_transport_morphometry.core.models.covariate import design_matrix
+from optimal_transport_morphometry.core.models.preprocessing import FeatureStorage, Tissue
+from optimal_transport_morphometry.core.nifti import NiftiError, read_header
+from optimal_transport_morphometry.core.registration import (
+    REGISTRATION_PROFILES,
+    jacobian_determinant_image,
+)
+from optimal_transport_morphometry.core.sparse import MaskReduction
+from optimal_transport_morphometry.core.storage import delete_objects, upload_local_file
+from optimal_transport_morphometry.core.transfers import (
+    PREFETCHER,
+    OutputUploader,
+    iter_feature_images,
+    load_mask,
+    local_copy,
+)
 
-from optimal_transport_morphometry.core import models
-from optimal_transport_morphometry.core.storage import upload_local_file
-
-UTM_FOLDER = '/opt/UTM'
 ATLAS_CACHE_DIR = pathlib.Path(tempfile.gettempdir()) / 'OTM' / 'atlases'
 
+# The label of each tissue in a segmentation, in the order of the priors it's segmented with
+TISSUE_LABELS = {Tissue.CSF: 1, Tissue.GREY: 2, Tissue.WHITE: 3}
+
+# The number of image headers read from storage at once
+VALIDATION_CONCURRENCY = 16
+VALIDATION_FIELDS = [
+    'size',
+    'checksum',
+    'validation_status',
+    'validation_error',
+    'dimensions',
+    'voxel_size',
+    'datatype',
+    'orientation',
+]
+
 
 def handle_preprocess_failure(self, exc, task_id, args, kwargs, einfo):
     batch_id = args[0]
@@ -29,6 +75,14 @@ def handle_preprocess_failure(self, exc, task_id, args, kwargs, einfo):
     batch.save(update_fields=['error_message', 'status'])
 
 
+def handle_finalize_failure(self, exc, task_id, args, kwargs, einfo):
+    batch: models.PreprocessingBatch = models.PreprocessingBatch.objects.get(pk=args[0])
+
+    # The batch stays finished, since analyses fall back to its support masks
+    batch.error_message += str(exc) + '\n\n' + str(einfo)
+    batch.save(update_fields=['error_message'])
+
+
 def atlas_filepath(atlas: models.Atlas):
     return ATLAS_CACHE_DIR / pathlib.Path(atlas.name)
 
@@ -44,127 +98,548 @@ def download_atlas(atlas: models.Atlas):
             atlas_file.write(chunk)
 
 
+PREPROCESSED_MODELS = [
+    models.RegisteredImage,
+    models.JacobianImage,
+    models.SegmentedImage,
+    models.FeatureImage,
+]
+
+
 def batch_finished(batch: models.PreprocessingBatch) -> bool:
-    expected_image_count = batch.source_images().count() * 4
-    current_image_count = sum(
-        [
-            model.objects.filter(preprocessing_batch=batch.id).count()
-            for model in [
-                models.JacobianImage,
-                models.SegmentedImage,
-                models.RegisteredImage,
-                models.FeatureImage,
-            ]
-        ]
+    # Every valid image is either preprocessed, or reuses earlier outputs
+    expected_image_count = (
+        batch.dataset.images.filter(validation_status=models.Image.ValidationStatus.VALID).count()
+        * batch.outputs_per_image
     )
 
     # Return false if all images aren't present yet
-    if current_image_count < expected_image_count:
+    return batch.preprocessed_images.count() >= expected_image_count
+
+
+def reuse_preprocessed_images(batch: models.PreprocessingBatch, image: models.Image) -> bool:
+    """
+    Copy earlier outputs of the same content, atlas, registration, features and dtype to a batch.
+
+    Returns whether outputs were reused. The copies share the blobs of the earlier outputs, so
+    duplicate scans (e.g. in several datasets) are only ever preprocessed once.
+    """
+    if not image.checksum:
+        return False
+
+    feature_image = (
+        models.FeatureImage.objects.filter(
+            source_image__checksum=image.checksum,
+            preprocessing_batch__atlas_id=batch.atlas_id,
+            preprocessing_batch__registration_profile=batch.registration_profile,
+            preprocessing_batch__modulated=batch.modulated,
+            preprocessing_batch__output_dtype=batch.output_dtype,
+            preprocessing_batch__feature_storage=batch.feature_storage,
+            tissue=batch.feature_tissues[0],
+            downsample_factor=batch.downsample_factors[0],
+        )
+        .exclude(preprocessing_batch=batch)
+        .order_by('-created')
+        .first()
+    )
+    if feature_image is None:
         return False
 
+    # Only reuse a complete set of outputs, from the same preprocessing run, which may have had
+    # feature images this batch doesn't need
+    outputs = [
+        output
+        for output in models.PreprocessedImage.objects.filter(
+            source_image_id=feature_image.source_image_id,
+            preprocessing_batch_id=feature_image.preprocessing_batch_id,
+        )
+        if output.kind != models.PreprocessedImage.Kind.FEATURE
+        or (
+            output.tissue in batch.feature_tissues
+            and output.downsample_factor in batch.downsample_factors
+        )
+    ]
+    if len(outputs) < batch.outputs_per_image:
+        return False
+
+    copy_preprocessed_images(outputs, batch, image)
+    copy_feature_masks(feature_image.preprocessing_batch_id, batch)
     return True
 
 
+def copy_preprocessed_images(
+    outputs: List[models.PreprocessedImage], batch: models.PreprocessingBatch, image: models.Image
+) -> None:
+    """
+    Copy outputs into a batch, as outputs of an image. The copies share the blobs of the outputs.
+
+    Any outputs of the same kinds which the batch already has for the image, e.g. from an
+    interrupted attempt at preprocessing it, are replaced.
+    """
+    with transaction.atomic():
+        models.PreprocessedImage.objects.filter(
+            preprocessing_batch=batch,
+            source_image=image,
+            kind__in=[output.kind for output in outputs],
+        ).delete()
+
+        for output in outputs:
+            output.pk = None
+            output.source_image = image
+            output.preprocessing_batch = batch
+        models.PreprocessedImage.objects.bulk_create(outputs)
+
+
+def copy_feature_masks(source_batch_id: int, batch: models.PreprocessingBatch) -> None:
+    """Copy the support masks a batch needs from another batch, with the same atlas."""
+    masks = list(
+        models.FeatureMask.objects.filter(
+            preprocessing_batch_id=source_batch_id,
+            kind=models.FeatureMask.Kind.SUPPORT,
+            tissue__in=batch.feature_tissues,
+            downsample_factor__in=batch.downsample_factors,
+        )
+    )
+    for mask in masks:
+        mask.pk = None
+        mask.preprocessing_batch = batch
+    models.FeatureMask.objects.bulk_create(masks, ignore_conflicts=True)
+
+
+def validate_image_header(image: models.Image) -> models.Image:
+    """Record the header of an image's volume, or why it can't be preprocessed. Doesn't save."""
+    try:
+        header = read_header(image.blob.name)
+    except NiftiError as e:
+        image.validation_status = models.Image.ValidationStatus.INVALID
+        image.validation_error = str(e)
+    except (BotoCoreError, ClientError) as e:
+        # Storage errors may be transient, so the image is left pending, to be validated again
+        print(f'Could not read header of {image.name}: {e}')
+    else:
+        image.validation_status = models.Image.ValidationStatus.VALID
+        image.validation_error = ''
+        image.size = header.file_size
+        image.checksum = header.etag
+        image.dimensions = header.dimensions
+        image.voxel_size = header.voxel_size
+        image.datatype = header.datatype
+        image.orientation = header.orientation
+
+    return image
+
+
+@shared_task
+def validate_images(image_ids: List[int]):
+    """Validate the headers of many pending images, reading them from storage concurrently."""
+    pending = models.Image.objects.filter(validation_status=models.Image.ValidationStatus.PENDING)
+    with ThreadPoolExecutor(VALIDATION_CONCURRENCY) as executor:
+        images = list(executor.map(validate_image_header, pending.filter(id__in=image_ids)))
+    validated = {
+        image.pk: image
+        for image in images
+        if image.validation_status != models.Image.ValidationStatus.PENDING
+    }
+
+    with transaction.atomic():
+        # The same images may be validated at once (e.g. by preprocessing, and after upload), so
+        # only those which are still pending once locked are saved, and referenced, by this call
+        locked = dict(
+            pending.select_for_update()
+            .filter(pk__in=list(validated))
+            .order_by('pk')
+            .values_list('pk', 'checksum')
+        )
+        models.Image.objects.bulk_update([validated[pk] for pk in locked], VALIDATION_FIELDS)
+
+        # Images whose checksum is only now known may be duplicates of an existing blob
+        reference_blobs([validated[pk] for pk, checksum in locked.items() if not checksum])
+
+
+def save_preprocessed_images(
+    outputs: List[models.PreprocessedImage], masks: Optional[List[models.FeatureMask]] = None
+) -> None:
+    """Save the rows of uploaded preprocessed images and feature masks, in a single transaction."""
+    masks = masks or []
+
+    # A retried task replaces the outputs of its earlier attempt, rather than duplicating them
+    with transaction.atomic():
+        # Several images may have created the same masks at once, which are all identical
+        models.FeatureMask.objects.bulk_create(masks, ignore_conflicts=True)
+        for output in outputs:
+            models.PreprocessedImage.objects.filter(
+                preprocessing_batch_id=output.preprocessing_batch_id,
+                source_image_id=output.source_image_id,
+                kind=output.kind,
+                tissue=output.tissue,
+                downsample_factor=output.downsample_factor,
+            ).delete()
+            output.save()
+
+    # The objects of masks which another image stored first are duplicates, so are deleted
+    if masks:
+        stored = set(
+            models.FeatureMask.objects.filter(
+                blob__in=[mask.blob.name for mask in masks]
+            ).values_list('blob', flat=True)
+        )
+        duplicates = [
+            key
+            for mask in masks
+            if mask.blob.name not in stored
+            for key in [mask.blob.name, mask.voxel_index.name]
+            if key
+        ]
+        if duplicates:
+            delete_objects(duplicates)
+
+
+def read_priors() -> Tuple[List[Any], Any]:
+    """Read the cached tissue priors of the atlas, and the brain mask which they cover."""
+    import ants
+
+    priors = [
+        ants.image_read(str(atlas_filepath(models.Atlas.objects.get(name=f'{tissue}.nii.gz'))))
+        for tissue in TISSUE_LABELS
+    ]
+    mask = priors[0].copy()
+    mask_view = mask.view()
+    for i in range(1, len(priors)):
+        mask_view[priors[i].numpy() > 0] = 1
+    mask_view[mask_view > 0] = 1
+
+    return priors, mask
+
+
+def downsample_image(img, downsample: float):
+    import ants
+    import numpy as np
+
+    if downsample <= 1:
+        return img
+
+    shape = np.round(np.asarray(img.shape) / downsample)
+    return ants.resample_image(img, shape, True)
+
+
+def feature_mask_image(brain_mask, downsample: float):
+    """
+    Return the voxels which feature images downsampled by a factor may be non-zero in.
+
+    Every image is segmented within the brain mask, and downsampling interpolates with
+    non-negative weights, so feature images are zero wherever the downsampled brain mask is.
+    """
+    import numpy as np
+
+    downsampled = downsample_image(brain_mask, downsample)
+    return downsampled.new_image_like((downsampled.numpy() > 0).astype(np.float32))
+
+
+def create_feature_images(
+    seg_img, jac_img, batch: models.PreprocessingBatch
+) -> Iterator[Tuple[str, float, Any]]:
+    """
+    Yield every feature image of a batch from a segmentation, as (tissue, downsample factor, image).
+
+    Each feature image is the mask of a tissue, optionally modulated by the Jacobian (so it
+    preserves the tissue's volume), then downsampled. All of them are created from the same
+    segmentation, while it's in memory.
+    """
+    import numpy as np
+
+    seg = seg_img.numpy()
+    jac = jac_img.numpy()
+    for tissue in batch.feature_tissues:
+        data = (seg == TISSUE_LABELS[tissue]).astype(np.float32)
+        if batch.modulated:
+            data *= jac
+        tissue_img = seg_img.new_image_like(data)
+
+        for downsample in batch.downsample_factors:
+            yield tissue, downsample, downsample_image(tissue_img, downsample)
+
+
+def save_feature_images(
+    batch: models.PreprocessingBatch,
+    image: models.Image,
+    seg_img,
+    jac_img,
+    uploader: OutputUploader,
+    brain_mask=None,
+) -> None:
+    """Save every feature image of a batch, densely, sparsely (within the brain mask) or both."""
+    masks = {}
+    if batch.feature_storage != FeatureStorage.DENSE:
+        masks = {
+            downsample: feature_mask_image(brain_mask, downsample)
+            for downsample in batch.downsample_factors
+        }
+
+    for tissue, downsample, feature_img in create_feature_images(seg_img, jac_img, batch):
+        feature_image = models.FeatureImage(
+            source_image=image,
+            preprocessing_batch=batch,
+            tissue=tissue,
+            downsample_factor=downsample,
+        )
+        name = f'feature_{tissue}_{downsample:g}'
+        if batch.feature_storage != FeatureStorage.SPARSE:
+            uploader.save_image(feature_image, feature_img, name)
+        if masks:
+            uploader.save_values(feature_image, feature_img, masks[downsample], name)
+
+    # Masks are the same for every image, so are only stored by the first. Images which finish
+    # at once (before any has saved its masks) each upload them, which is accepted, since it's
+    # bounded by the number of workers. Only one row is saved, and the other uploads are deleted.
+    existing = set(
+        batch.feature_masks.filter(kind=models.FeatureMask.Kind.SUPPORT).values_list(
+            'tissue', 'downsample_factor'
+        )
+    )
+    for tissue in batch.feature_tissues:
+        for downsample, mask_img in masks.items():
+            if (tissue, downsample) not in existing:
+                uploader.save_mask(
+                    models.FeatureMask(
+                        preprocessing_batch=batch, tissue=tissue, downsample_factor=downsample
+                    ),
+                    mask_img,
+                    f'mask_{tissue}_{downsample:g}',
+                )
+
+
+def next_image(batch: models.PreprocessingBatch, image: models.Image) -> Optional[models.Image]:
+    """Return the image dispatched after an image, which its worker is likely to process next."""
+    return (
+        batch.dataset.images.filter(
+            validation_status=models.Image.ValidationStatus.VALID, name__gt=image.name
+        )
+        .exclude(pk__in=batch.completed_image_ids())
+        .order_by('name')
+        .first()
+    )
+
+
+def finish_image(batch: models.PreprocessingBatch) -> None:
+    # Set status if applicable
+    batch.refresh_from_db()
+    no_failures = batch.status == models.PreprocessingBatch.Status.RUNNING
+    if batch_finished(batch) and no_failures:
+        finish_batch(batch)
+
+
+def finish_batch(batch: models.PreprocessingBatch) -> None:
+    """Mark a running batch finished, and finalize it."""
+    # Several images may finish at once, but only one of them finalizes the batch
+    finished = models.PreprocessingBatch.objects.filter(
+        pk=batch.pk, status=models.PreprocessingBatch.Status.RUNNING
+    ).update(status=models.PreprocessingBatch.Status.FINISHED, modified=timezone.now())
+    if finished:
+        finalize_preprocessing_batch.delay(batch.pk)
+
+
+@shared_task(on_failure=handle_finalize_failure)
+def finalize_preprocessing_batch(batch_id: int):
+    """
+    Compute the union and intersection masks of a finished batch, and their voxel indices.
+
+    Each tissue and downsample factor is reduced in a single pass over its feature images, one
+    image at a time, so memory is bounded by the size of a few volumes.
+    """
+    batch = models.PreprocessingBatch.objects.get(pk=batch_id)
+    support_masks = {
+        (mask.tissue, mask.downsample_factor): mask
+        for mask in batch.feature_masks.filter(kind=models.FeatureMask.Kind.SUPPORT)
+    }
+
+    with OutputUploader(batch.output_encoding) as uploader:
+        for tissue, downsample in itertools.product(
+            batch.feature_tissues, batch.downsample_factors
+        ):
+            feature_images = models.FeatureImage.objects.filter(
+                preprocessing_batch=batch, tissue=tissue, downsample_factor=downsample
+            ).order_by('pk')
+
+            # Every sparse feature image shares the same support mask
+            mask_img = None
+            if (tissue, downsample) in support_masks:
+                mask_img = load_mask(support_masks[tissue, downsample])
+
+            reduction = MaskReduction()
+            template = None
+            for feature_img in iter_feature_images(feature_images.iterator(), mask_img):
+                reduction.add(feature_img)
+                template = feature_img
+            if template is None:
+                continue
+
+            for kind, mask in [
+                (models.FeatureMask.Kind.UNION, reduction.union),
+                (models.FeatureMask.Kind.INTERSECTION, reduction.intersection),
+            ]:
+                uploader.save_mask(
+                    models.FeatureMask(
+                        preprocessing_batch=batch,
+                        kind=kind,
+                        tissue=tissue,
+                        downsample_factor=downsample,
+                    ),
+                    template.new_image_like(mask.astype('float32')),
+                    f'{kind}_{tissue}_{downsample:g}',
+                )
+
+    # Replace the masks of any earlier attempt
+    with transaction.atomic():
+        batch.feature_masks.exclude(kind=models.FeatureMask.Kind.SUPPORT).delete()
+        models.FeatureMask.objects.bulk_create(uploader.masks)
+
+
 @shared_task(on_failure=handle_preprocess_failure)
-def preprocess_image(batch_id: int, image_id: int, downsample: float):
+def preprocess_image(batch_id: int, image_id: int):
     import ants
     import numpy as np
 
     # Fetch relevant models
     image = models.Image.objects.get(id=image_id)
     atlas = models.Atlas.objects.get(name='T1.nii.gz')
-    atlas_csf = models.Atlas.objects.get(name='csf.nii.gz')
-    atlas_grey = models.Atlas.objects.get(name='grey.nii.gz')
-    atlas_white = models.Atlas.objects.get(name='white.nii.gz')
     batch = models.PreprocessingBatch.objects.get(pk=batch_id)
 
-    # Read cached atlases
+    # Read cached atlases, and create mask
     atlas_img = ants.image_read(str(atlas_filepath(atlas)))
-    atlas_csf_img = ants.image_read(str(atlas_filepath(atlas_csf)))
-    atlas_grey_img = ants.image_read(str(atlas_filepath(atlas_grey)))
-    atlas_white_img = ants.image_read(str(atlas_filepath(atlas_white)))
-
-    # Create mask
-    priors = [atlas_csf_img, atlas_grey_img, atlas_white_img]
-    mask = priors[0].copy()
-    mask_view = mask.view()
-    for i in range(1, len(priors)):
-        mask_view[priors[i].numpy() > 0] = 1
-    mask_view[mask_view > 0] = 1
+    priors, mask = read_priors()
 
     # For creating preprocessed images
     common_model_args = {'source_image': image, 'preprocessing_batch': batch}
 
-    # Read img
-    with NamedTemporaryFile(suffix=image.name) as tmp, image.blob.open() as blob:
-        for chunk in blob.chunks():
-            tmp.write(chunk)
-        input_img = ants.image_read(tmp.name)
+    # Read img, then download the next image while this one is processed
+    with PREFETCHER.local_copy(image.blob, image.name) as path:
+        input_img = ants.image_read(path)
+    upcoming_image = next_image(batch, image)
+    if upcoming_image is not None:
+        PREFETCHER.prefetch(upcoming_image.blob, upcoming_image.name)
 
     print(f'Running N4 bias correction: {image.name}')
     im_n4 = ants.n4_bias_field_correction(input_img)
     del input_img
-    print(f'Running registration: {image.name}')
-    reg = ants.registration(atlas_img, im_n4)
+    profile = REGISTRATION_PROFILES[batch.registration_profile]
+    print(f'Running registration ({profile.name}): {image.name}')
+    registration_parameters = profile.parameters()
+    start = time.monotonic()
+    reg = ants.registration(atlas_img, im_n4, **registration_parameters)
+    registration_runtime = time.monotonic() - start
     del im_n4
-    jac_img = ants.create_jacobian_determinant_image(
-        atlas_img, reg['fwdtransforms'][0], False, True
-    )
+    jac_img = jacobian_determinant_image(atlas_img, reg['fwdtransforms'], profile)
     jac_img = jac_img.apply(np.abs)
 
-    reg_model = models.RegisteredImage(**common_model_args)
-    reg_img = reg['warpedmovout']
-    with NamedTemporaryFile(suffix='registered.nii.gz') as tmp:
-        ants.image_write(reg_img, tmp.name)
-        reg_model.blob = File(tmp, name='registered.nii.gz')
-        reg_model.save()
-
-    jac_model = models.JacobianImage(**common_model_args)
-    with NamedTemporaryFile(suffix='jacobian.nii.gz') as tmp:
-        ants.image_write(jac_img, tmp.name)
-        jac_model.blob = File(tmp, name='jacobian.nii.gz')
-        jac_model.save()
-
-    print(f'Running segmentation: {image.name}')
-    seg = ants.prior_based_segmentation(reg_img, priors, mask)
-    del reg_img
-
-    seg_model = models.SegmentedImage(**common_model_args)
-    with NamedTemporaryFile(suffix='segmented.nii.gz') as tmp:
-        ants.image_write(seg['segmentation'], tmp.name)
-        seg_model.blob = File(tmp, name='segmented.nii.gz')
-        seg_model.save()
-
-    print(f'Creating feature image: {image.name}')
-    seg_img_view = seg['segmentation'].view()
-    feature_img = seg['segmentation'].copy()
-    feature_img_view = feature_img.view()
-    feature_img_view.fill(0)
-    feature_img_view[seg_img_view == 2] = 1  # 2 is grey matter label, 3 is white matter label
-
-    intensity_img_view = jac_img.view()
-    feature_img_view *= intensity_img_view
-
-    if downsample > 1:
-        shape = np.round(np.asarray(feature_img.shape) / downsample)
-        feature_img = ants.resample_image(feature_img, shape, True)
-
-    feature_model = models.FeatureImage(**common_model_args, downsample_factor=downsample)
-    with NamedTemporaryFile(suffix='feature.nii.gz') as tmp:
-        ants.image_write(feature_img, tmp.name)
-        feature_model.blob = File(tmp, name='feature.nii.gz')
-        feature_model.save()
+    # Outputs are uploaded in the background, while the rest are computed
+    with OutputUploader(batch.output_encoding) as uploader:
+        # Keep the transforms, so later batches can derive outputs from them
+        registered_image = models.RegisteredImage(
+            **common_model_args,
+            registration_type=profile.type_of_transform,
+            registration_parameters=registration_parameters,
+            registration_runtime=registration_runtime,
+        )
+        uploader.save_file(
+            registered_image.affine_transform, reg['fwdtransforms'][-1], 'affine.mat'
+        )
+        if profile.deformable:
+            uploader.save_file(
+                registered_image.warp_transform, reg['fwdtransforms'][0], 'warp.nii.gz'
+            )
+            uploader.save_file(
+                registered_image.inverse_warp_transform,
+                reg['invtransforms'][-1],
+                'inverse_warp.nii.gz',
+            )
+
+        reg_img = reg['warpedmovout']
+        uploader.save_image(registered_image, reg_img, 'registered')
+        uploader.save_image(models.JacobianImage(**common_model_args), jac_img, 'jacobian')
 
-    # Set status if applicable
-    batch.refresh_from_db()
-    no_failures = batch.status == models.PreprocessingBatch.Status.RUNNING
-    if batch_finished(batch) and no_failures:
-        batch.status = models.PreprocessingBatch.Status.FINISHED
-        batch.save()
+        print(f'Running segmentation: {image.name}')
+        seg = ants.prior_based_segmentation(reg_img, priors, mask)
+        del reg_img
+
+        uploader.save_image(
+            models.SegmentedImage(**common_model_args),
+            seg['segmentation'],
+            'segmented',
+            labels=True,
+        )
+
+        print(f'Creating feature images: {image.name}')
+        save_feature_images(batch, image, seg['segmentation'], jac_img, uploader, mask)
+
+    for path in set(reg['fwdtransforms'] + reg['invtransforms']):
+        pathlib.Path(path).unlink(missing_ok=True)
+
+    # Only counted as preprocessed once every output is stored
+    save_preprocessed_images(uploader.outputs, uploader.masks)
+    finish_image(batch)
+
+
+@shared_task(on_failure=handle_preprocess_failure)
+def derive_image(batch_id: int, image_id: int):
+    """Derive the Jacobian and feature image of an image, from an earlier registration of it."""
+    import ants
+    import numpy as np
+
+    image = models.Image.objects.get(id=image_id)
+    atlas = models.Atlas.objects.get(name='T1.nii.gz')
+    batch = models.PreprocessingBatch.objects.get(pk=batch_id)
+    atlas_img = ants.image_read(str(atlas_filepath(atlas)))
+    profile = REGISTRATION_PROFILES[batch.registration_profile]
+
+    outputs = {
+        output.kind: output
+        for output in models.PreprocessedImage.objects.filter(
+            preprocessing_batch_id=batch.derived_from_id,
+            source_image=image,
+            kind__in=[
+                models.PreprocessedImage.Kind.REGISTERED,
+                models.PreprocessedImage.Kind.SEGMENTED,
+            ],
+        )
+    }
+    registered_image = outputs[models.PreprocessedImage.Kind.REGISTERED]
+    segmented_image = outputs[models.PreprocessedImage.Kind.SEGMENTED]
+
+    print(f'Deriving Jacobian: {image.name}')
+    with ExitStack() as stack:
+        # In the same order as the forward transforms of a registration
+        transforms = [stack.enter_context(local_copy(registered_image.affine_transform, '.mat'))]
+        if registered_image.warp_transform:
+            transforms.insert(
+                0, stack.enter_context(local_copy(registered_image.warp_transform, '.nii.gz'))
+            )
+        jac_img = jacobian_determinant_image(atlas_img, transforms, profile)
+    jac_img = jac_img.apply(np.abs)
+
+    with local_copy(segmented_image.blob, nifti_suffix(segmented_image.blob.name)) as path:
+        seg_img = ants.image_read(path)
+
+    with OutputUploader(batch.output_encoding) as uploader:
+        uploader.save_image(
+            models.JacobianImage(source_image=image, preprocessing_batch=batch),
+            jac_img,
+            'jacobian',
+        )
+
+        print(f'Creating feature images: {image.name}')
+        brain_mask = None
+        if batch.feature_storage != FeatureStorage.DENSE:
+            _, brain_mask = read_priors()
+        save_feature_images(batch, image, seg_img, jac_img, uploader, brain_mask)
+
+    # The registration and segmentation are unchanged, so are shared with the earlier batch
+    copy_preprocessed_images([registered_image, segmented_image], batch, image)
+    save_preprocessed_images(uploader.outputs, uploader.masks)
+    finish_image(batch)
 
 
 @shared_task(on_failure=handle_preprocess_failure)
-def preprocess_images(batch_id: int, downsample: float = 3.0):
+def preprocess_images(batch_id: int):
     # Fetch atlases, raising an error if some aren't found
     atlas = models.Atlas.objects.get(name='T1.nii.gz')
     atlas_csf = models.Atlas.objects.get(name='csf.nii.gz')
@@ -192,13 +667,65 @@ def preprocess_images(batch_id: int, downsample: float = 3.0):
     download_atlas(atlas_grey)
     download_atlas(atlas_white)
 
-    # Kick off individual tasks
-    for image in dataset.images.order_by('name').all():
-        preprocess_image.delay(batch.pk, image.pk, downsample)
+    # Validate any images which haven't been yet, so that bad volumes are never preprocessed
+    unvalidated = dataset.images.filter(validation_status=models.Image.ValidationStatus.PENDING)
+    validate_images(list(unvalidated.values_list('id', flat=True)))
+
+    images = dataset.images.filter(validation_status=models.Image.ValidationStatus.VALID)
+    invalid_count = dataset.images.filter(
+        validation_status=models.Image.ValidationStatus.INVALID
+    ).count()
+    if invalid_count:
+        batch.error_message += f'Skipped {invalid_count} invalid images.\n\n'
+        batch.save(update_fields=['error_message'])
+    unvalidated_count = unvalidated.count()
+    if unvalidated_count:
+        batch.error_message += f'Skipped {unvalidated_count} images which could not be read.\n\n'
+        batch.save(update_fields=['error_message'])
+    if not images.exists():
+        raise Exception('No valid images to preprocess.')
+
+    # Kick off individual tasks, for any images which haven't been preprocessed before. When
+    # retried, images this batch already has every output of are complete.
+
+    # Images registered and segmented by the batch this is derived from are derived from those
+    registered = models.RegisteredImage.objects.filter(
+        preprocessing_batch_id=batch.derived_from_id, source_image=OuterRef('pk')
+    ).exclude(affine_transform='')
+    segmented = models.SegmentedImage.objects.filter(
+        preprocessing_batch_id=batch.derived_from_id, source_image=OuterRef('pk')
+    )
+    images = images.annotate(registered=Exists(registered), segmented=Exists(segmented))
+    for image in images.exclude(pk__in=batch.completed_image_ids()).order_by('name'):
+        if reuse_preprocessed_images(batch, image):
+            continue
+        if image.registered and image.segmented:
+            derive_image.delay(batch.pk, image.pk)
+        else:
+            preprocess_image.delay(batch.pk, image.pk)
+
+    # If every image was reused, no task will finish the batch
+    if batch_finished(batch):
+        finish_batch(batch)
+
+
+@shared_task
+def collect_garbage(grace_period_hours: float = 24, dry_run: bool = False) -> dict:
+    """Delete objects in storage which no longer belong to anything, returning a summary."""
+    result = garbage.collect_garbage(
+        grace_period=datetime.timedelta(hours=grace_period_hours), dry_run=dry_run
+    )
+    return dataclasses.asdict(result)
+
+
+@shared_task
+def prune_preprocessing_batches() -> int:
+    """Delete preprocessing batches beyond the retention policy, returning how many."""
+    return garbage.prune_preprocessing_batches(settings.PREPROCESSING_BATCH_RETENTION)
 
 
-def upload_analysis_images(output_dir: str):
-    features = ['allocation', 'transport', 'vbm']
+def upload_analysis_images(output_dir: str, features: Iterable[str] = UTMBackend.features):
+    """Upload the maps of every variable, if it has all of the given features."""
     data = {}
 
     def handle_path(path: pathlib.Path):
@@ -246,7 +773,13 @@ def handle_analysis_failure(self, exc, task_id, args, kwargs, einfo):
 
 
 @shared_task(on_failure=handle_analysis_failure)
-def run_utm(analysis_id: int):
+def run_utm(analysis_id: int, force: bool = False):
+    """
+    Run an analysis with its backend, and upload its maps and a zip of all of its outputs.
+
+    If an identical analysis (with the same fingerprint) has already finished, its results are
+    reused instead, unless forced.
+    """
     # using default_configuration.yml in UTM repo for now
     # TODO: load config.yml file as well
     analysis_result: models.AnalysisResult = models.AnalysisResult.objects.select_related(
@@ -254,6 +787,7 @@ def run_utm(analysis_id: int):
     ).get(id=analysis_id)
     preprocessing_batch: models.PreprocessingBatch = analysis_result.preprocessing_batch
     dataset: models.Dataset = preprocessing_batch.dataset
+    backend = ANALYSIS_BACKENDS[analysis_result.backend]
 
     # Set status before starting
     analysis_result.status = models.AnalysisResult.Status.RUNNING
@@ -261,70 +795,48 @@ def run_utm(analysis_id: int):
 
     # TODO: Since analysis isn't being visualized by R shiny, output all
     # data into a temporary folder, to be removed after the task completes
-    with TemporaryDirectory() as tmpdir:
-        # Since these folders are contained within tmpdir,
-        # they will be automatically deleted when tmpdir is deleted
-        input_folder = mkdtemp(dir=tmpdir)
-        output_folder = mkdtemp(dir=tmpdir)
-
-        # Get all feature images in this preprocessing batch
-        feature_image_qs = models.FeatureImage.objects.filter(
-            preprocessing_batch=preprocessing_batch
-        ).select_related('source_image')
-
-        # Iterate over every feature image
-        variables = []
-        for feature_image in feature_image_qs:
-            image = feature_image.source_image
-            meta = image.metadata
-            meta.setdefault('name', image.name)
-
-            # Ensure file has .nii.gz extension
-            # Ants will produce a segmentation fault if it tries to read a
-            # compressed image with an uncompressed file extension, and visa versa
-            meta['name'] = pathlib.Path(meta['name']).with_suffix('.nii.gz')
-
-            # Add meta to variables
-            variables.append(meta)
-
-            # Write feature image to file
-            filename = f'{input_folder}/{meta["name"]}'
-            with feature_image.blob.open() as blob, open(filename, 'wb') as fd:
-                for chunk in blob.chunks():
-                    fd.write(chunk)
-
-        # Write variables to a csv file
-        variables_filename = f'{input_folder}/variables.csv'
-        headers = variables[0].keys()
-        with open(variables_filename, 'w') as csvfile:
-            _write_csv(csvfile, headers, variables)
-
-        # copy necessary R shiny files
-        shutil.copyfile(f'{UTM_FOLDER}/Scripts/Shiny/app.R', f'{output_folder}/app.R')
-        shutil.copyfile(
-            f'{UTM_FOLDER}/Scripts/Shiny/shiny-help.md', f'{output_folder}/shiny-help.md'
+    with TemporaryDirectory() as output_folder:
+        # Get the feature images of the batch's first tissue and downsample factor
+        feature_images = list(
+            preprocessing_batch.primary_feature_images().select_related('source_image')
         )
-        shutil.copyfile(
-            f'{UTM_FOLDER}/Scripts/ShinyVtkScripts/render.js', f'{output_folder}/render.js'
+
+        # Fetch the metadata and covariate values of every source image at once
+        columns, rows = design_matrix(
+            dataset, [feature_image.source_image for feature_image in feature_images]
         )
 
-        result = subprocess.run(
-            [
-                'Rscript',
-                '/opt/UTM/Scripts/run.utm.barycenter.R',
-                input_folder,
-                variables_filename,
-                '--working.folder',
-                output_folder,
-            ]
+        analysis_result.fingerprint = analysis_fingerprint(
+            analysis_result.backend, feature_images, columns, rows
+        )
+        previous = (
+            None
+            if force
+            else models.AnalysisResult.objects.filter(
+                fingerprint=analysis_result.fingerprint,
+                status=models.AnalysisResult.Status.FINISHED,
+            )
+            .exclude(pk=analysis_result.pk)
+            .order_by('-created')
+            .first()
         )
+        if previous is not None:
+            # Objects are shared by every result which references them, like reused outputs
+            analysis_result.zip_file = previous.zip_file.name
+            analysis_result.data = previous.data
+            analysis_result.status = models.AnalysisResult.Status.FINISHED
+            analysis_result.save()
+            dataset.save(update_fields=['modified'])
+            return
 
         # Set analysis status and return if failed
-        analysis_result.status = (
-            models.AnalysisResult.Status.FINISHED
-            if result.returncode == 0
-            else models.AnalysisResult.Status.FAILED
-        )
+        try:
+            backend.run(feature_images, columns, rows, output_folder)
+        except AnalysisError as e:
+            analysis_result.status = models.AnalysisResult.Status.FAILED
+            analysis_result.error_message += str(e)
+        else:
+            analysis_result.status = models.AnalysisResult.Status.FINISHED
 
         # Create and upload zip file
         if analysis_result.status == models.AnalysisResult.Status.FINISHED:
@@ -339,14 +851,8 @@ def run_utm(analysis_id: int):
                 )
 
             # Upload images to S3
-            analysis_result.data = upload_analysis_images(output_folder)
+            analysis_result.data = upload_analysis_images(output_folder, backend.features)
 
         # Save
         analysis_result.save()
-        dataset.save()
-
-
-def _write_csv(csvfile: TextIO, headers: List[str], rows: List[dict]):
-    writer = csv.DictWriter(csvfile, fieldnames=headers)
-    writer.writeheader()
-    writer.writerows(rows)
+        dataset.save(update_fields=['modified'])
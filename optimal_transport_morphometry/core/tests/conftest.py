@@ -5,6 +5,7 @@ from rest_framework.test import APIClient
 from .factories import (
     DatasetFactory,
     FeatureImageFactory,
+    FeatureMaskFactory,
     ImageFactory,
     JacobianImageFactory,
     PendingUploadFactory,
@@ -31,6 +32,7 @@ def authenticated_api_client(user) -> APIClient:
 
 register(DatasetFactory)
 register(FeatureImageFactory)
+register(FeatureMaskFactory)
 register(ImageFactory)
 register(JacobianImageFactory)
 register(PendingUploadFactory)
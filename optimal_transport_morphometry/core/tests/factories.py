@@ -5,6 +5,7 @@ from optimal_transport_morphometry.core.models import (
     Atlas,
     Dataset,
     FeatureImage,
+    FeatureMask,
     Image,
     JacobianImage,
     PendingUpload,
@@ -87,9 +88,21 @@ class FeatureImageFactory(AbstractPreprocessedImageFactory):
     class Meta:
         model = FeatureImage
 
+    tissue = 'grey'
     downsample_factor = 3.0
 
 
+class FeatureMaskFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = FeatureMask
+
+    preprocessing_batch = factory.SubFactory(PreprocessingBatchFactory)
+    tissue = 'grey'
+    downsample_factor = 3.0
+    blob = factory.django.FileField(data=b'fakemaskbytes', filename='mask.nii.gz')
+    voxel_count = 1000
+
+
 class JacobianImageFactory(AbstractPreprocessedImageFactory):
     class Meta:
         model = JacobianImage
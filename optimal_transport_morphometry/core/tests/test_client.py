@@ -0,0 +1,128 @@
+import datetime
+from pathlib import Path
+from typing import Dict, List
+
+from click.testing import CliRunner
+from django.utils import timezone
+from oauth2_provider.models import AccessToken
+import pytest
+import requests
+
+from optimal_transport_morphometry.core import models
+
+otm_client = pytest.importorskip('otm_client.client')
+otm_cli = pytest.importorskip('otm_client.cli')
+
+
+@pytest.fixture
+def token(user) -> str:
+    return AccessToken.objects.create(
+        user=user,
+        token='test-token',
+        scope='read write',
+        expires=timezone.now() + datetime.timedelta(hours=1),
+    ).token
+
+
+@pytest.fixture
+def otm(live_server, token):
+    return otm_client.OtmClient(f'{live_server.url}/api/v1', token=token)
+
+
+@pytest.fixture
+def upload_batch(user, dataset_factory, upload_batch_factory, pending_upload_factory):
+    batch: models.UploadBatch = upload_batch_factory(dataset=dataset_factory(owner=user))
+    for name in ['a.nii.gz', 'b.nii.gz']:
+        pending_upload_factory(batch=batch, name=name)
+
+    return batch
+
+
+@pytest.fixture
+def files(tmp_path: Path) -> Dict[str, Path]:
+    contents = {'a.nii.gz': b'NIfTI' * 1000, 'b.nii.gz': b'NIfTI' * 2000, 'c.nii.gz': b'NIfTI'}
+    for name, content in contents.items():
+        (tmp_path / name).write_bytes(content)
+
+    return {name: tmp_path / name for name in contents}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_client_upload_batch(otm, upload_batch, files):
+    pending = otm.pending_uploads(upload_batch.id)
+    assert sorted(pending) == ['a.nii.gz', 'b.nii.gz']
+
+    # Files which don't match a pending upload are skipped, and not counted towards progress
+    assert otm.match_files(upload_batch.id, files.values()) == {
+        pending['a.nii.gz']: files['a.nii.gz'],
+        pending['b.nii.gz']: files['b.nii.gz'],
+    }
+    uploaded: List[int] = []
+    images = otm.upload_batch(upload_batch.id, files.values(), progress=uploaded.append)
+    assert sorted(image['name'] for image in images) == ['a.nii.gz', 'b.nii.gz']
+    assert sum(uploaded) == files['a.nii.gz'].stat().st_size + files['b.nii.gz'].stat().st_size
+    for image in models.Image.objects.filter(id__in=[image['id'] for image in images]):
+        assert image.blob.read() == files[image.name].read_bytes()
+    assert not models.UploadBatch.objects.filter(id=upload_batch.id).exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_client_upload_batch_resume(otm, upload_batch, files):
+    otm.upload_batch(upload_batch.id, [files['a.nii.gz']])
+
+    # Files which were already uploaded no longer match a pending upload
+    images = otm.upload_batch(upload_batch.id, files.values())
+    assert [image['name'] for image in images] == ['b.nii.gz']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_client_upload_batch_unauthorized(live_server, upload_batch, files):
+    # The batch's dataset is private, so isn't visible without a valid token
+    otm = otm_client.OtmClient(f'{live_server.url}/api/v1', token='invalid')
+    with pytest.raises(otm_client.UploadError, match='404'):
+        otm.upload_batch(upload_batch.id, files.values())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_client_put_part_retry(otm, upload_batch, files, mocker):
+    put = mocker.patch('otm_client.client.requests.put')
+    mocker.patch('otm_client.client.time.sleep')
+    unavailable = mocker.Mock(ok=False, status_code=503, text='Unavailable')
+    put.side_effect = [unavailable, mocker.Mock(ok=True)]
+
+    part = otm_client._Part(1, files['a.nii.gz'], 1, 0, 10).compute_md5()
+    assert otm._put_part(part, 'http://storage/part') is part
+    assert put.call_count == 2
+
+    # Client errors aren't retried
+    put.reset_mock()
+    put.side_effect = [mocker.Mock(ok=False, status_code=403, text='Forbidden')]
+    with pytest.raises(otm_client.UploadError, match='403'):
+        otm._put_part(part, 'http://storage/part')
+    assert put.call_count == 1
+
+    # Network errors are retried, until they run out
+    put.reset_mock()
+    put.side_effect = requests.ConnectionError()
+    with pytest.raises(requests.ConnectionError):
+        otm._put_part(part, 'http://storage/part')
+    assert put.call_count == otm.retries + 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_client_cli_upload(live_server, token, upload_batch, files):
+    result = CliRunner().invoke(
+        otm_cli.cli,
+        [
+            '--api-url',
+            f'{live_server.url}/api/v1',
+            '--token',
+            token,
+            'upload',
+            str(upload_batch.id),
+            str(files['a.nii.gz'].parent),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert 'Created 2 images' in result.output
+    assert not models.UploadBatch.objects.filter(id=upload_batch.id).exists()
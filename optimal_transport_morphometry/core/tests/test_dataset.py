@@ -1,10 +1,21 @@
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.http import QueryDict
 from guardian.shortcuts import assign_perm, get_users_with_perms
 import pytest
 
-from optimal_transport_morphometry.core.models import Dataset, Image
+from optimal_transport_morphometry.core.batch_parser import load_batch_from_csv
+from optimal_transport_morphometry.core.models import CovariateValue, Dataset, Image
+from optimal_transport_morphometry.core.models.covariate import (
+    dataset_covariates,
+    image_covariate_values,
+)
+from optimal_transport_morphometry.core.rest.dataset import DatasetSerializer
+from optimal_transport_morphometry.core.rest.metadata import metadata_filter
+from optimal_transport_morphometry.core.search import trigram_search_available
 
 from . import fuzzy
+from .test_preprocessed import explain
 
 # from optimal_transport_morphometry.core import batch_parser, models
 
@@ -22,6 +33,8 @@ def test_dataset_create(user, api_client):
         'public': False,
         'current_preprocessing_batch': None,
         'current_analysis_result': None,
+        'uploads_active': False,
+        'image_count': 0,
     }
 
 
@@ -109,6 +122,61 @@ def test_dataset_retrieve_extra(
     assert r.json()['image_count'] == 1
 
 
+@pytest.mark.django_db
+def test_dataset_list_extra(api_client, user, dataset_factory, image_factory, upload_batch_factory):
+    dataset: Dataset = dataset_factory(owner=user)
+    image: Image = image_factory(dataset=dataset)
+    batch = upload_batch_factory(dataset=dataset)
+
+    api_client.force_authenticate(user)
+    r = api_client.get('/api/v1/datasets')
+    assert r.json()['results'][0]['uploads_active'] is True
+    assert r.json()['results'][0]['image_count'] == 1
+
+    # Ensure both are kept up to date on delete
+    image.delete()
+    batch.delete()
+    r = api_client.get('/api/v1/datasets')
+    assert r.json()['results'][0]['uploads_active'] is False
+    assert r.json()['results'][0]['image_count'] == 0
+
+
+@pytest.mark.django_db
+def test_dataset_reconcile_counts(capsys, dataset_factory, image_factory, upload_batch_factory):
+    dataset: Dataset = dataset_factory()
+    image_factory(dataset=dataset)
+    image_factory(dataset=dataset)
+    upload_batch_factory(dataset=dataset)
+
+    # Introduce drift
+    Dataset.objects.filter(id=dataset.id).update(image_count=5, uploads_active=False)
+
+    # Drift in either count is reported
+    call_command('reconcile_dataset_counts')
+    assert (
+        f'Dataset {dataset.id} ({dataset.name}): image_count 5 -> 2, uploads_active False -> True'
+        in capsys.readouterr().out
+    )
+    dataset.refresh_from_db()
+    assert dataset.image_count == 2
+    assert dataset.uploads_active is True
+
+
+@pytest.mark.django_db
+def test_dataset_update_preserves_counts(api_client, user, dataset_factory, image_factory):
+    dataset: Dataset = dataset_factory(owner=user)
+
+    # An image is created while the dataset is being updated, from a stale copy of it
+    image_factory(dataset=dataset)
+    serializer = DatasetSerializer(dataset, data={'description': 'Updated'}, partial=True)
+    serializer.is_valid(raise_exception=True)
+    serializer.save()
+
+    dataset.refresh_from_db()
+    assert dataset.description == 'Updated'
+    assert dataset.image_count == 1
+
+
 @pytest.mark.django_db
 def test_dataset_retrieve_private(api_client, user_factory, dataset_factory):
     user1: User = user_factory()
@@ -212,6 +280,34 @@ def test_dataset_list_filter_name(api_client, user, user_factory, dataset_factor
     assert resp.json()['results'][0]['id'] == ds_two.id
 
 
+@pytest.mark.django_db
+def test_dataset_list_filter_name_ranked(api_client, user, dataset_factory):
+    dataset_factory(name='dataset one', owner=user)
+    dataset_factory(name='dataset one two', owner=user)
+    dataset_factory(name='other', owner=user)
+
+    api_client.force_authenticate(user)
+    resp = api_client.get('/api/v1/datasets', {'name': 'dataset one', 'ranked': True})
+    assert resp.json()['count'] == 2
+    assert [ds['name'] for ds in resp.json()['results']] == ['dataset one', 'dataset one two']
+
+
+@pytest.mark.django_db
+def test_dataset_list_filter_name_ranked_similar(api_client, user, dataset_factory):
+    if not trigram_search_available():
+        pytest.skip('pg_trgm extension not available')
+
+    dataset: Dataset = dataset_factory(name='oasis cross-sectional', owner=user)
+    api_client.force_authenticate(user)
+
+    # Misspelled names are only matched in ranked mode
+    resp = api_client.get('/api/v1/datasets', {'name': 'oasus cross-sectoinal'})
+    assert resp.json()['count'] == 0
+    resp = api_client.get('/api/v1/datasets', {'name': 'oasus cross-sectoinal', 'ranked': True})
+    assert resp.json()['count'] == 1
+    assert resp.json()['results'][0]['id'] == dataset.id
+
+
 @pytest.mark.django_db
 def test_dataset_list_public(api_client, user, user_factory, dataset_factory):
     dataset_factory()
@@ -460,3 +556,91 @@ def test_dataset_list_images(api_client, user_factory, image_factory, dataset_fa
     assert r.status_code == 200
     assert r.json()['count'] == 1
     assert r.json()['results'][0]['id'] == image.id
+
+
+@pytest.mark.django_db
+def test_dataset_list_images_metadata_filter(api_client, user, image_factory, dataset_factory):
+    dataset: Dataset = dataset_factory(owner=user)
+    young: Image = image_factory(dataset=dataset, metadata={'Age': 21, 'CDR': 0, 'Gender': 'F'})
+    old: Image = image_factory(dataset=dataset, metadata={'Age': 74, 'CDR': 0.5, 'Gender': 'M'})
+    unknown: Image = image_factory(dataset=dataset, metadata={'Age': 'N/A', 'CDR': 1})
+
+    def filtered_ids(params):
+        r = api_client.get(f'/api/v1/datasets/{dataset.pk}/images', params)
+        assert r.status_code == 200
+        return {result['id'] for result in r.json()['results']}
+
+    api_client.force_authenticate(user)
+    assert filtered_ids({}) == {young.id, old.id, unknown.id}
+    assert filtered_ids({'metadata__Gender': 'M'}) == {old.id}
+    assert filtered_ids({'metadata__CDR': '0.5'}) == {old.id}
+    assert filtered_ids({'metadata__CDR__in': '0,1'}) == {young.id, unknown.id}
+
+    # Ranges only match numeric values
+    assert filtered_ids({'metadata__Age__gte': '21'}) == {young.id, old.id}
+    assert filtered_ids({'metadata__Age__gt': '21', 'metadata__CDR__lte': '0.5'}) == {old.id}
+    assert filtered_ids({'metadata__Age__lt': '100', 'metadata__Gender': 'F'}) == {young.id}
+
+    # Values which overflow a float are strings, so never match numbers
+    assert filtered_ids({'metadata__Age': '1e400'}) == set()
+    r = api_client.get(f'/api/v1/datasets/{dataset.pk}/images', {'metadata__Age__gte': '1e400'})
+    assert r.status_code == 400
+
+
+@pytest.mark.django_db
+def test_metadata_filter_index(image_factory):
+    image_factory(metadata={'Gender': 'M'})
+
+    # The jsonpath predicates of equality filters are served by the GIN index
+    query = metadata_filter(QueryDict('metadata__Gender__in=F,M'))
+    plan = explain(list, Image.objects.filter(query))
+    assert 'core_image_metadata_gin' in plan
+
+
+@pytest.mark.django_db
+def test_dataset_list_images_covariate_filter(api_client, user, image_factory, dataset_factory):
+    dataset: Dataset = dataset_factory(owner=user)
+    load_batch_from_csv(['name,Age,Gender', 'a.nii,21,F', 'b.nii,74,M', 'c.nii,,M'], dataset)
+    covariates = dataset_covariates(dataset)
+
+    images = []
+    for metadata in [{'Age': 21, 'Gender': 'F'}, {'Age': 74, 'Gender': 'M'}, {'Gender': 'M'}]:
+        image: Image = image_factory.build(dataset=dataset)
+        values = image_covariate_values(image, metadata, covariates)
+        image.save()
+        CovariateValue.objects.bulk_create(values)
+        images.append(image)
+    young, old, unknown = images
+
+    def filtered_ids(params):
+        r = api_client.get(f'/api/v1/datasets/{dataset.pk}/images', params)
+        assert r.status_code == 200
+        return {result['id'] for result in r.json()['results']}
+
+    api_client.force_authenticate(user)
+    assert filtered_ids({'metadata__Gender': 'M'}) == {old.id, unknown.id}
+    assert filtered_ids({'metadata__Gender': 'X'}) == set()
+    assert filtered_ids({'metadata__Gender__in': 'F,X'}) == {young.id}
+    assert filtered_ids({'metadata__Age': '74'}) == {old.id}
+    assert filtered_ids({'metadata__Age__gt': '20', 'metadata__Gender': 'F'}) == {young.id}
+
+    # Ranges aren't defined for categories
+    r = api_client.get(f'/api/v1/datasets/{dataset.pk}/images', {'metadata__Gender__gt': 'F'})
+    assert r.status_code == 400
+
+    r = api_client.get(f'/api/v1/datasets/{dataset.pk}/covariates')
+    assert r.status_code == 200
+    assert [(c['name'], c['type'], c['categories']) for c in r.json()] == [
+        ('Age', 'int', []),
+        ('Gender', 'category', ['F', 'M']),
+    ]
+
+
+@pytest.mark.django_db
+def test_dataset_list_images_metadata_filter_invalid(api_client, user, dataset_factory):
+    dataset: Dataset = dataset_factory(owner=user)
+
+    api_client.force_authenticate(user)
+    r = api_client.get(f'/api/v1/datasets/{dataset.pk}/images', {'metadata__Age__gt': 'old'})
+    assert r.status_code == 400
+    assert r.json() == {'metadata__Age__gt': '"old" is not a number.'}
@@ -1,6 +1,45 @@
+import gzip
+import hashlib
+import re
+import struct
+from typing import Optional, Tuple
+
+from botocore.exceptions import EndpointConnectionError
+from django.core.files.storage import default_storage
 import pytest
 
-from optimal_transport_morphometry.core.models import Dataset, Image, PendingUpload, UploadBatch
+from optimal_transport_morphometry.core import tasks
+from optimal_transport_morphometry.core.batch_parser import load_batch_from_csv
+from optimal_transport_morphometry.core.models import (
+    Blob,
+    Dataset,
+    Image,
+    PendingUpload,
+    UploadBatch,
+)
+from optimal_transport_morphometry.core.nifti import NiftiError, parse_header
+from optimal_transport_morphometry.core.tasks import validate_images
+
+
+def nifti_header(
+    dims: Tuple[int, ...] = (4, 5, 6),
+    pixdim: Tuple[float, ...] = (1.0, 1.0, 1.5),
+    datatype: int = 4,
+    bitpix: int = 16,
+    srow: Optional[Tuple[float, ...]] = None,
+    endian: str = '<',
+) -> bytes:
+    header = bytearray(352)
+    struct.pack_into(f'{endian}i', header, 0, 348)
+    struct.pack_into(f'{endian}8h', header, 40, len(dims), *dims, *[1] * (7 - len(dims)))
+    struct.pack_into(f'{endian}2h', header, 70, datatype, bitpix)
+    struct.pack_into(f'{endian}8f', header, 76, 1.0, *pixdim, *[0.0] * (7 - len(pixdim)))
+    struct.pack_into(f'{endian}f', header, 108, 352.0)
+    if srow is not None:
+        struct.pack_into(f'{endian}h', header, 254, 1)
+        struct.pack_into(f'{endian}12f', header, 280, *srow)
+    header[344:348] = b'n+1\0'
+    return bytes(header)
 
 
 @pytest.mark.django_db
@@ -27,6 +66,26 @@ def test_image_create(
     assert UploadBatch.objects.filter(id=batch.id).exists()
 
 
+@pytest.mark.django_db
+def test_image_create_covariates(
+    user, api_client, s3ff_field_value, dataset_factory, upload_batch_factory
+):
+    dataset: Dataset = dataset_factory(owner=user)
+    csvfile = ['name,Age,Site', 'a.nii,71,Boston', 'b.nii,65,Paris']
+    batch: UploadBatch = load_batch_from_csv(csvfile, dataset)
+    upload: PendingUpload = batch.pending_uploads.get(name='a.nii')
+
+    api_client.force_authenticate(user)
+    r = api_client.post('/api/v1/images', {'pending_upload': upload.pk, 'blob': s3ff_field_value})
+    assert r.status_code == 200
+    assert r.json()['metadata'] == {'Age': 71, 'Site': 'Boston'}
+
+    # Covariates are stored in their own table, rather than as metadata
+    image: Image = Image.objects.get(id=r.json()['id'])
+    assert image.metadata == {}
+    assert image.covariate_values.count() == 2
+
+
 @pytest.mark.django_db
 def test_image_create_unauthorized(
     api_client, user_factory, s3ff_field_value, pending_upload_factory
@@ -55,14 +114,19 @@ def test_image_create_deletes_batch(
     dataset_factory,
     pending_upload_factory,
     upload_batch_factory,
+    django_capture_on_commit_callbacks,
 ):
     # Create dataset with one batch that has one pending upload
     dataset: Dataset = dataset_factory(owner=user)
     batch: UploadBatch = upload_batch_factory(dataset=dataset)
     upload: PendingUpload = pending_upload_factory(batch=batch)
 
+    # Completed batches are deleted once the request is committed
     api_client.force_authenticate(user)
-    r = api_client.post('/api/v1/images', {'pending_upload': upload.id, 'blob': s3ff_field_value})
+    with django_capture_on_commit_callbacks(execute=True):
+        r = api_client.post(
+            '/api/v1/images', {'pending_upload': upload.id, 'blob': s3ff_field_value}
+        )
     assert r.status_code == 200
 
     # Assert that the original batch is gone
@@ -105,3 +169,236 @@ def test_image_access_unauthorized(
     assert r.status_code == 404
     r = api_client.get(f'/api/v1/images/{image.id}/download')
     assert r.status_code == 404
+
+
+@pytest.mark.django_db
+def test_image_bulk_create(
+    user,
+    api_client,
+    s3ff_field_value,
+    dataset_factory,
+    pending_upload_factory,
+    upload_batch_factory,
+    django_capture_on_commit_callbacks,
+):
+    dataset: Dataset = dataset_factory(owner=user)
+    batch: UploadBatch = upload_batch_factory(dataset=dataset)
+    uploads = [pending_upload_factory(batch=batch, metadata={'Age': i}) for i in range(3)]
+
+    api_client.force_authenticate(user)
+    r = api_client.post(
+        '/api/v1/images/bulk',
+        {'images': [{'pending_upload': u.pk, 'blob': s3ff_field_value} for u in uploads[:2]]},
+    )
+    assert r.status_code == 200
+    assert [image['name'] for image in r.json()] == [u.name for u in uploads[:2]]
+    assert [image['metadata'] for image in r.json()] == [{'Age': 0}, {'Age': 1}]
+
+    # Batch is only deleted once all of its uploads are finalized
+    batch.refresh_from_db()
+    assert batch.remaining_uploads == 1
+    with django_capture_on_commit_callbacks(execute=True):
+        r = api_client.post(
+            '/api/v1/images/bulk',
+            {'images': [{'pending_upload': uploads[2].pk, 'blob': s3ff_field_value}]},
+        )
+    assert r.status_code == 200
+    assert not UploadBatch.objects.filter(id=batch.id).exists()
+
+    dataset.refresh_from_db()
+    assert dataset.image_count == 3
+    assert not PendingUpload.objects.filter(batch_id=batch.id).exists()
+
+
+@pytest.mark.django_db
+def test_image_bulk_create_invalid(
+    user,
+    user_factory,
+    api_client,
+    s3ff_field_value,
+    dataset_factory,
+    pending_upload_factory,
+    upload_batch_factory,
+):
+    upload: PendingUpload = pending_upload_factory(
+        batch=upload_batch_factory(dataset=dataset_factory(owner=user))
+    )
+    public_upload: PendingUpload = pending_upload_factory(
+        batch=upload_batch_factory(dataset=dataset_factory(owner=user_factory(), public=True))
+    )
+
+    def bulk_create(*uploads):
+        images = [{'pending_upload': u.pk, 'blob': s3ff_field_value} for u in uploads]
+        return api_client.post('/api/v1/images/bulk', {'images': images})
+
+    api_client.force_authenticate(user)
+    assert bulk_create(upload, upload).status_code == 400
+    assert bulk_create(upload, public_upload).status_code == 403
+
+    # Nothing is created unless every upload can be finalized
+    assert not Image.objects.exists()
+    assert PendingUpload.objects.filter(id=upload.id).exists()
+
+    api_client.force_authenticate(user_factory())
+    assert bulk_create(upload).status_code == 404
+
+
+@pytest.mark.parametrize(
+    'srow,orientation',
+    [
+        (None, 'LAS'),
+        ((1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0), 'RAS'),
+        ((-1, 0, 0, 0, 0, -1, 0, 0, 0, 0, -1, 0), 'LPI'),
+        ((0, 0, 1, 0, 1, 0, 0, 0, 0, -1, 0, 0), 'AIR'),
+    ],
+)
+def test_nifti_parse_header(srow, orientation):
+    header = parse_header(nifti_header(srow=srow))
+    assert header.dimensions == [4, 5, 6]
+    assert header.voxel_size == [1.0, 1.0, 1.5]
+    assert header.datatype == 'int16'
+    assert header.orientation == orientation
+
+    # Byte order is detected from the header size
+    assert parse_header(nifti_header(srow=srow, endian='>')) == header
+
+
+@pytest.mark.parametrize(
+    'kwargs,error',
+    [
+        ({'dims': (4, 5)}, 'Expected a 3D volume, not 2D.'),
+        ({'dims': (4, 5, 6, 2)}, 'Expected a 3D volume, not 4D.'),
+        ({'pixdim': (1.0, 0.0, 1.0)}, 'Invalid voxel size: [1.0, 0.0, 1.0].'),
+        ({'datatype': 128, 'bitpix': 24}, 'Unsupported datatype: rgb24.'),
+    ],
+)
+def test_nifti_parse_header_invalid(kwargs, error):
+    with pytest.raises(NiftiError, match=re.escape(error)):
+        parse_header(nifti_header(**kwargs))
+
+    with pytest.raises(NiftiError, match='Not a NIfTI file.'):
+        parse_header(b'fakeimagebytes')
+
+
+@pytest.mark.django_db
+def test_image_validate(dataset, image_factory):
+    data = nifti_header(dims=(20, 20, 20)) + bytes(20 * 20 * 20 * 2)
+    compressed: Image = image_factory(
+        dataset=dataset, blob__data=gzip.compress(data), blob__filename='a.nii.gz'
+    )
+    uncompressed: Image = image_factory(dataset=dataset, blob__data=data, blob__filename='b.nii')
+    truncated: Image = image_factory(
+        dataset=dataset, blob__data=data[:1000], blob__filename='c.nii'
+    )
+    invalid: Image = image_factory(dataset=dataset)
+    assert invalid.validation_status == Image.ValidationStatus.PENDING
+
+    validate_images([compressed.id, uncompressed.id, truncated.id, invalid.id])
+    for image in [compressed, uncompressed]:
+        image.refresh_from_db()
+        assert image.validation_status == Image.ValidationStatus.VALID
+        content = image.blob.read()
+        assert image.size == len(content)
+        assert image.checksum == hashlib.md5(content).hexdigest()
+        assert image.dimensions == [20, 20, 20]
+        assert image.voxel_size == [1.0, 1.0, 1.5]
+        assert image.datatype == 'int16'
+        assert image.orientation == 'LAS'
+
+    truncated.refresh_from_db()
+    assert truncated.validation_status == Image.ValidationStatus.INVALID
+    assert truncated.validation_error == 'File is truncated: expected 16352 bytes, got 1000.'
+
+    invalid.refresh_from_db()
+    assert invalid.validation_status == Image.ValidationStatus.INVALID
+    assert invalid.validation_error == 'Not a NIfTI file.'
+
+
+@pytest.mark.django_db
+def test_image_validate_storage_error(dataset, image_factory, mocker):
+    data = gzip.compress(nifti_header() + bytes(4 * 5 * 6 * 2))
+    images = [
+        image_factory(dataset=dataset, blob__data=data, blob__filename=name)
+        for name in ['a.nii.gz', 'b.nii.gz']
+    ]
+    read_header = tasks.read_header
+
+    def flaky_read_header(object_key):
+        if object_key == images[0].blob.name:
+            raise EndpointConnectionError(endpoint_url='http://storage')
+        return read_header(object_key)
+
+    # An image which can't be read is left pending, without failing the others
+    mocker.patch.object(tasks, 'read_header', side_effect=flaky_read_header)
+    validate_images([image.id for image in images])
+    for image in images:
+        image.refresh_from_db()
+    assert images[0].validation_status == Image.ValidationStatus.PENDING
+    assert images[1].validation_status == Image.ValidationStatus.VALID
+
+
+@pytest.mark.django_db(transaction=True)
+def test_image_validate_concurrently(dataset, image_factory, mocker):
+    data = gzip.compress(nifti_header() + bytes(4 * 5 * 6 * 2))
+    image: Image = image_factory(dataset=dataset, blob__data=data, blob__filename='a.nii.gz')
+    validate_image_header = tasks.validate_image_header
+    validated_elsewhere = []
+
+    def validate_during_another(image):
+        # Another validation of the same image finishes while this one reads its header
+        if not validated_elsewhere:
+            validated_elsewhere.append(image.pk)
+            validate_images([image.pk])
+        return validate_image_header(image)
+
+    mocker.patch.object(tasks, 'validate_image_header', side_effect=validate_during_another)
+    validate_images([image.pk])
+
+    # The blob is only referenced once, by whichever validation saved the image first
+    image.refresh_from_db()
+    assert image.validation_status == Image.ValidationStatus.VALID
+    assert Blob.objects.get(key=image.blob.name).ref_count == 1
+
+
+@pytest.mark.django_db
+def test_image_blob_deduplicated(
+    dataset_factory, image_factory, django_capture_on_commit_callbacks
+):
+    data = gzip.compress(nifti_header() + bytes(4 * 5 * 6 * 2))
+    images = [
+        image_factory(dataset=dataset_factory(), blob__data=data, blob__filename='a.nii.gz')
+        for _ in range(2)
+    ]
+    keys = [image.blob.name for image in images]
+    assert keys[0] != keys[1]
+
+    # Both images share a single object once their checksums are known
+    with django_capture_on_commit_callbacks(execute=True):
+        validate_images([image.id for image in images])
+    for image in images:
+        image.refresh_from_db()
+    shared_key = images[0].blob.name
+    assert images[1].blob.name == shared_key
+    assert Blob.objects.get(key=shared_key).ref_count == 2
+    assert [default_storage.exists(key) for key in keys].count(True) == 1
+
+    # The object is only deleted once it's unreferenced
+    with django_capture_on_commit_callbacks(execute=True):
+        images[0].delete()
+    assert Blob.objects.get(key=shared_key).ref_count == 1
+    assert default_storage.exists(shared_key)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        images[1].delete()
+    assert not Blob.objects.exists()
+    assert not default_storage.exists(shared_key)
+
+
+@pytest.mark.django_db
+def test_image_delete_unregistered_blob(image_factory, django_capture_on_commit_callbacks):
+    image: Image = image_factory()
+    assert default_storage.exists(image.blob.name)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        image.delete()
+    assert not default_storage.exists(image.blob.name)
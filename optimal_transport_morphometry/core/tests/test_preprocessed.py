@@ -1,6 +1,44 @@
+import datetime
+import gzip
+import hashlib
+import pathlib
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 import pytest
 
-from optimal_transport_morphometry.core.models import PreprocessingBatch
+from optimal_transport_morphometry.core import garbage, tasks, transfers
+from optimal_transport_morphometry.core.batch_parser import load_batch_from_csv
+from optimal_transport_morphometry.core.encoding import OutputEncoding, compress, nifti_suffix
+from optimal_transport_morphometry.core.garbage import collect_garbage
+from optimal_transport_morphometry.core.models import (
+    AnalysisResult,
+    CovariateValue,
+    FeatureImage,
+    FeatureMask,
+    Image,
+    JacobianImage,
+    PreprocessedImage,
+    PreprocessingBatch,
+    RegisteredImage,
+    SegmentedImage,
+)
+from optimal_transport_morphometry.core.models.covariate import (
+    dataset_covariates,
+    image_covariate_values,
+)
+from optimal_transport_morphometry.core.tasks import (
+    batch_finished,
+    next_image,
+    reuse_preprocessed_images,
+    save_preprocessed_images,
+)
+from optimal_transport_morphometry.core.tests.test_images import nifti_header
+from optimal_transport_morphometry.core.transfers import OutputUploader, Prefetcher
 
 
 @pytest.mark.django_db
@@ -13,6 +51,7 @@ def test_fetch_preprocessed_images(
     jacobian_image_factory,
     registered_image_factory,
     segmented_image_factory,
+    feature_mask_factory,
 ):
     batch: PreprocessingBatch = preprocessing_batch_factory(dataset__owner=user)
     for _ in range(4):
@@ -33,3 +72,460 @@ def test_fetch_preprocessed_images(
         assert 'registered' in entry
         assert 'segmented' in entry
         assert entry['dataset'] == batch.dataset.id
+
+    # Sparse feature images are within a mask, shared by the whole batch
+    mask: FeatureMask = feature_mask_factory(preprocessing_batch=batch)
+    r = api_client.get(f'/api/v1/preprocessing_batches/{batch.id}/masks')
+    assert r.status_code == 200
+    assert [(entry['id'], entry['tissue']) for entry in r.json()] == [(mask.id, 'grey')]
+
+
+@pytest.mark.django_db
+def test_backfill_blob_info(image_factory, feature_image_factory):
+    data = gzip.compress(nifti_header(dims=(3, 3, 3)) + bytes(3 * 3 * 3 * 2))
+    feature_image: FeatureImage = feature_image_factory(
+        blob__data=data, blob__filename='feature.nii.gz'
+    )
+    image: Image = image_factory()
+    assert image.size is None
+
+    call_command('backfill_blob_info')
+    feature_image.refresh_from_db()
+    assert feature_image.size == len(data)
+    assert feature_image.checksum == hashlib.md5(data).hexdigest()
+    assert feature_image.dimensions == [3, 3, 3]
+    assert feature_image.voxel_size == [1.0, 1.0, 1.5]
+
+    # Blobs which aren't volumes still have their size recorded
+    image.refresh_from_db()
+    assert image.size == len(b'fakeimagebytes')
+    assert image.dimensions is None
+
+
+@pytest.mark.django_db
+def test_reuse_preprocessed_images(
+    preprocessing_batch_factory,
+    image_factory,
+    feature_image_factory,
+    jacobian_image_factory,
+    registered_image_factory,
+    segmented_image_factory,
+    feature_mask_factory,
+):
+    batch: PreprocessingBatch = preprocessing_batch_factory()
+    image: Image = image_factory(dataset=batch.dataset, checksum='abc')
+    mask: FeatureMask = feature_mask_factory(preprocessing_batch=batch)
+    outputs = [
+        factory(source_image=image, preprocessing_batch=batch)
+        for factory in [
+            feature_image_factory,
+            jacobian_image_factory,
+            registered_image_factory,
+            segmented_image_factory,
+        ]
+    ]
+
+    # The same scan in another dataset, preprocessed with the same atlas
+    other_batch: PreprocessingBatch = preprocessing_batch_factory(atlas=batch.atlas)
+    duplicate: Image = image_factory(dataset=other_batch.dataset, checksum='abc')
+    other_batch.downsample_factors = [2.0]
+    assert not reuse_preprocessed_images(other_batch, duplicate)
+    other_batch.feature_tissues, other_batch.downsample_factors = ['white'], [3.0]
+    assert not reuse_preprocessed_images(other_batch, duplicate)
+
+    # Every feature image of the batch must be reusable
+    other_batch.feature_tissues = ['grey', 'white']
+    assert not reuse_preprocessed_images(other_batch, duplicate)
+    other_batch.feature_tissues = ['grey']
+    assert reuse_preprocessed_images(other_batch, duplicate)
+
+    for output, model in zip(
+        outputs, [FeatureImage, JacobianImage, RegisteredImage, SegmentedImage]
+    ):
+        copy = model.objects.get(preprocessing_batch=other_batch)
+        assert copy.source_image == duplicate
+        assert copy.blob.name == output.blob.name
+
+    # The masks of sparse feature images are shared too
+    assert other_batch.feature_masks.get().blob.name == mask.blob.name
+
+    # Reusing again (e.g. when the task is retried) replaces the copies, rather than duplicating
+    assert reuse_preprocessed_images(other_batch, duplicate)
+    assert FeatureImage.objects.filter(preprocessing_batch=other_batch).count() == 1
+    assert other_batch.feature_masks.count() == 1
+
+    # Different content is never reused
+    assert not reuse_preprocessed_images(
+        other_batch, image_factory(dataset=other_batch.dataset, checksum='def')
+    )
+
+
+@pytest.mark.django_db
+def test_finish_image(
+    mocker,
+    preprocessing_batch_factory,
+    image_factory,
+    feature_image_factory,
+    jacobian_image_factory,
+    registered_image_factory,
+    segmented_image_factory,
+):
+    finalize = mocker.patch.object(tasks.finalize_preprocessing_batch, 'delay')
+    batch: PreprocessingBatch = preprocessing_batch_factory(
+        status=PreprocessingBatch.Status.RUNNING
+    )
+    image: Image = image_factory(
+        dataset=batch.dataset, validation_status=Image.ValidationStatus.VALID
+    )
+    for factory in [feature_image_factory, jacobian_image_factory, registered_image_factory]:
+        factory(source_image=image, preprocessing_batch=batch)
+
+    tasks.finish_image(batch)
+    assert batch.status == PreprocessingBatch.Status.RUNNING
+    finalize.assert_not_called()
+
+    # The union and intersection masks are computed once, by the last image to finish
+    segmented_image_factory(source_image=image, preprocessing_batch=batch)
+    tasks.finish_image(batch)
+    tasks.finish_image(PreprocessingBatch.objects.get(pk=batch.pk))
+    assert PreprocessingBatch.objects.get(pk=batch.pk).status == PreprocessingBatch.Status.FINISHED
+    finalize.assert_called_once_with(batch.pk)
+
+
+@pytest.mark.django_db
+def test_preprocessing_batch_progress(
+    user, api_client, preprocessing_batch_factory, image_factory, feature_image_factory
+):
+    batch: PreprocessingBatch = preprocessing_batch_factory(
+        dataset__owner=user, status=PreprocessingBatch.Status.RUNNING
+    )
+
+    # Invalid images are never preprocessed, so are neither expected nor current
+    image_factory(dataset=batch.dataset, name='a', validation_status=Image.ValidationStatus.INVALID)
+    image: Image = image_factory(
+        dataset=batch.dataset, name='b', validation_status=Image.ValidationStatus.VALID
+    )
+    feature_image_factory(source_image=image, preprocessing_batch=batch)
+    assert batch.current_image() == image
+
+    api_client.force_authenticate(user)
+    r = api_client.get(f'/api/v1/preprocessing_batches/{batch.id}')
+    assert r.status_code == 200
+    assert r.json()['expected_image_count'] == batch.outputs_per_image
+    assert r.json()['progress'] == 1 / batch.outputs_per_image
+    assert r.json()['current_image_name'] == 'b'
+
+
+@pytest.mark.django_db
+def test_finalize_preprocessing_batch_failure(mocker, preprocessing_batch_factory):
+    batch: PreprocessingBatch = preprocessing_batch_factory(
+        status=PreprocessingBatch.Status.FINISHED
+    )
+    mocker.patch.object(tasks, 'OutputUploader', side_effect=RuntimeError('Storage unavailable'))
+
+    # Failures are recorded on the batch, which stays finished
+    result = tasks.finalize_preprocessing_batch.apply(args=[batch.pk])
+    assert result.failed()
+    batch.refresh_from_db()
+    assert batch.status == PreprocessingBatch.Status.FINISHED
+    assert batch.error_message.startswith('Storage unavailable')
+
+
+@pytest.mark.django_db
+def test_fetch_preprocessed_images_covariates(
+    user, api_client, preprocessing_batch_factory, image_factory, feature_image_factory
+):
+    batch: PreprocessingBatch = preprocessing_batch_factory(dataset__owner=user)
+    load_batch_from_csv(['name,Age,Site', 'a.nii,71,Boston'], batch.dataset)
+    image: Image = image_factory.build(dataset=batch.dataset)
+    metadata = {'Age': 71, 'Site': 'Boston', 'Scanner': 'GE'}
+    values = image_covariate_values(image, metadata, dataset_covariates(batch.dataset))
+    image.save()
+    CovariateValue.objects.bulk_create(values)
+    feature_image_factory(source_image=image, preprocessing_batch=batch)
+
+    # Covariates are merged into the metadata of each source image
+    api_client.force_authenticate(user)
+    r = api_client.get(f'/api/v1/preprocessing_batches/{batch.id}/images')
+    assert r.status_code == 200
+    assert r.json()['results'][0]['metadata'] == metadata
+
+
+@pytest.mark.django_db
+def test_prefetch(preprocessing_batch_factory, image_factory):
+    batch: PreprocessingBatch = preprocessing_batch_factory()
+    image, upcoming_image = [
+        image_factory(
+            dataset=batch.dataset,
+            name=name,
+            blob=ContentFile(name.encode(), name=name),
+            validation_status=Image.ValidationStatus.VALID,
+        )
+        for name in ['a.nii', 'b.nii']
+    ]
+    assert next_image(batch, image) == upcoming_image
+    assert next_image(batch, upcoming_image) is None
+
+    prefetcher = Prefetcher()
+    prefetcher.prefetch(upcoming_image.blob, '.nii')
+    with prefetcher.local_copy(upcoming_image.blob, '.nii') as path:
+        with open(path, 'rb') as local_file:
+            assert local_file.read() == b'b.nii'
+
+    # Another input is downloaded as usual, discarding the prefetched copy
+    prefetcher.prefetch(upcoming_image.blob, '.nii')
+    with prefetcher.local_copy(image.blob, '.nii') as path:
+        with open(path, 'rb') as local_file:
+            assert local_file.read() == b'a.nii'
+    assert prefetcher._key is None
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'pigz'])
+def test_compress(tmp_path, codec):
+    path = tmp_path / 'feature.nii'
+    data = nifti_header() + bytes(range(256)) * 64
+    path.write_bytes(data)
+
+    compressed_path = compress(str(path), OutputEncoding(codec=codec, compression_level=1))
+    assert compressed_path == f'{path}.gz'
+    assert nifti_suffix(compressed_path) == '.nii.gz'
+    assert not path.exists()
+
+    # Compressed deterministically, so the same volume always has the same checksum
+    compressed = pathlib.Path(compressed_path).read_bytes()
+    assert gzip.decompress(compressed) == data
+    path.write_bytes(data)
+    compress(str(path), OutputEncoding(codec=codec, compression_level=1))
+    assert pathlib.Path(compressed_path).read_bytes() == compressed
+    assert nifti_suffix(str(path)) == '.nii'
+
+
+@pytest.mark.django_db
+def test_output_uploader(tmp_path, registered_image_factory):
+    registered_image: RegisteredImage = registered_image_factory()
+    transform = tmp_path / 'affine.mat'
+    transform.write_bytes(b'transform')
+
+    with OutputUploader(OutputEncoding()) as uploader:
+        uploader.save_file(registered_image.affine_transform, str(transform), 'affine.mat')
+    with registered_image.affine_transform.open() as stored:
+        assert stored.read() == b'transform'
+
+    # Rows are never saved when an upload fails
+    with pytest.raises(FileNotFoundError):
+        with OutputUploader(OutputEncoding()) as uploader:
+            uploader.save_file(registered_image.warp_transform, str(tmp_path / 'missing'), 'warp')
+    registered_image.refresh_from_db()
+    assert not registered_image.warp_transform
+
+    save_preprocessed_images([registered_image])
+    assert PreprocessedImage.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_output_uploader_images(mocker, registered_image_factory, jacobian_image_factory):
+    ants = pytest.importorskip('ants')
+    np = pytest.importorskip('numpy')
+    outputs = [registered_image_factory(), jacobian_image_factory()]
+    img = ants.from_numpy(np.ones((4, 5, 6), dtype=np.float32))
+
+    # Every upload thread shares the uploader's client, since creating clients isn't thread-safe
+    get_boto_client = mocker.spy(transfers, 'get_boto_client')
+    with OutputUploader(OutputEncoding()) as uploader:
+        for i, output in enumerate(outputs):
+            uploader.save_image(output, img, f'output_{i}')
+    get_boto_client.assert_called_once()
+    for output in outputs:
+        assert output.size == default_storage.size(output.blob.name)
+        assert output.checksum
+
+
+@pytest.mark.django_db
+def test_save_duplicate_masks(feature_mask_factory):
+    mask: FeatureMask = feature_mask_factory()
+
+    # Another image uploaded the same mask at once, but stored it second
+    duplicate: FeatureMask = feature_mask_factory.build(
+        preprocessing_batch=mask.preprocessing_batch
+    )
+    duplicate.blob.save('mask.nii.gz', ContentFile(b'fakemaskbytes'), save=False)
+    save_preprocessed_images([], [duplicate])
+
+    assert FeatureMask.objects.get().blob.name == mask.blob.name
+    assert default_storage.exists(mask.blob.name)
+    assert not default_storage.exists(duplicate.blob.name)
+
+
+@pytest.mark.django_db
+def test_preprocessed_image_kinds(
+    feature_image_factory, jacobian_image_factory, registered_image_factory
+):
+    feature_image: FeatureImage = feature_image_factory()
+    jacobian_image: JacobianImage = jacobian_image_factory(
+        source_image=feature_image.source_image,
+        preprocessing_batch=feature_image.preprocessing_batch,
+    )
+    registered_image_factory()
+
+    assert feature_image.kind == PreprocessedImage.Kind.FEATURE
+    assert jacobian_image.kind == PreprocessedImage.Kind.JACOBIAN
+    assert list(FeatureImage.objects.all()) == [feature_image]
+    assert list(JacobianImage.objects.all()) == [jacobian_image]
+    assert SegmentedImage.objects.count() == 0
+    assert feature_image.source_image.preprocessed_images.count() == 2
+
+
+@pytest.mark.django_db
+def test_preprocessed_image_unique(feature_image_factory):
+    feature_image: FeatureImage = feature_image_factory()
+    with pytest.raises(IntegrityError), transaction.atomic():
+        feature_image_factory(
+            source_image=feature_image.source_image,
+            preprocessing_batch=feature_image.preprocessing_batch,
+        )
+
+
+def explain(func, *args, **kwargs) -> str:
+    """Return the query plans of every query made by a function."""
+    with CaptureQueriesContext(connection) as context:
+        func(*args, **kwargs)
+
+    plans = []
+    with connection.cursor() as cursor:
+        # The tables are tiny, so sequential scans would otherwise always be cheapest
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        for query in context.captured_queries:
+            if query['sql'].startswith('SELECT'):
+                cursor.execute(f'EXPLAIN {query["sql"]}')
+                plans += [row[0] for row in cursor.fetchall()]
+
+    return '\n'.join(plans)
+
+
+@pytest.mark.django_db
+def test_preprocessed_image_indexes(
+    user,
+    django_assert_num_queries,
+    api_client,
+    preprocessing_batch_factory,
+    image_factory,
+    feature_image_factory,
+    jacobian_image_factory,
+    registered_image_factory,
+    segmented_image_factory,
+):
+    batch: PreprocessingBatch = preprocessing_batch_factory(dataset__owner=user)
+    images = [
+        image_factory(
+            dataset=batch.dataset, name=name, validation_status=Image.ValidationStatus.VALID
+        )
+        for name in ['a', 'b']
+    ]
+    for factory in [
+        feature_image_factory,
+        jacobian_image_factory,
+        registered_image_factory,
+        segmented_image_factory,
+    ]:
+        factory(source_image=images[0], preprocessing_batch=batch)
+    feature_image_factory(source_image=images[1], preprocessing_batch=batch)
+
+    # Outputs from other batches don't count towards this batch
+    feature_image_factory(source_image=images[1])
+
+    # Each lookup is a single query of the unified table
+    with django_assert_num_queries(1):
+        assert set(batch.source_images()) == set(images)
+    with django_assert_num_queries(1):
+        assert batch.current_image() == images[1]
+    with django_assert_num_queries(2):
+        assert not batch_finished(batch)
+
+    api_client.force_authenticate(user)
+    plans = [
+        explain(batch_finished, batch),
+        explain(list, batch.source_images()),
+        explain(batch.current_image),
+        explain(api_client.get, f'/api/v1/preprocessing_batches/{batch.id}/images'),
+    ]
+    for plan in plans:
+        assert 'unique_preprocessed_image' in plan
+
+
+@pytest.mark.django_db
+def test_collect_garbage(
+    image_factory, feature_image_factory, registered_image_factory, feature_mask_factory
+):
+    image: Image = image_factory()
+    feature_image: FeatureImage = feature_image_factory()
+    feature_image.values.save('values.npy', ContentFile(b'values'))
+    mask: FeatureMask = feature_mask_factory()
+    registered_image: RegisteredImage = registered_image_factory()
+    registered_image.affine_transform.save('affine.mat', ContentFile(b'transform'))
+    orphan = default_storage.save('orphan.nii.gz', ContentFile(b'orphan'))
+
+    # Recent objects are never deleted
+    collect_garbage()
+    assert default_storage.exists(orphan)
+
+    result = collect_garbage(grace_period=datetime.timedelta(0), dry_run=True)
+    assert result.deleted >= 1
+    assert default_storage.exists(orphan)
+
+    collect_garbage(grace_period=datetime.timedelta(0))
+    assert not default_storage.exists(orphan)
+    for key in [
+        image.blob.name,
+        feature_image.blob.name,
+        feature_image.values.name,
+        mask.blob.name,
+        feature_image.source_image.blob.name,
+        registered_image.affine_transform.name,
+    ]:
+        assert default_storage.exists(key)
+
+
+@pytest.mark.django_db
+def test_prune_preprocessing_batches(
+    dataset, preprocessing_batch_factory, feature_image_factory, feature_mask_factory
+):
+    batches = [
+        preprocessing_batch_factory(dataset=dataset, status=PreprocessingBatch.Status.FINISHED)
+    ]
+    batches += [
+        preprocessing_batch_factory(
+            dataset=dataset, atlas=batches[0].atlas, status=PreprocessingBatch.Status.FINISHED
+        )
+        for _ in range(4)
+    ]
+    for i, batch in enumerate(batches):
+        PreprocessingBatch.objects.filter(pk=batch.pk).update(
+            created=timezone.now() - datetime.timedelta(days=len(batches) - i)
+        )
+    dataset.current_preprocessing_batch = batches[-1]
+    dataset.save()
+
+    # The oldest batch has been analyzed, and the next oldest is still running
+    AnalysisResult.objects.create(preprocessing_batch=batches[0])
+    PreprocessingBatch.objects.filter(pk=batches[1].pk).update(
+        status=PreprocessingBatch.Status.RUNNING
+    )
+
+    # The outputs of the pruned batch are shared by a batch which reused them
+    pruned = feature_image_factory(preprocessing_batch=batches[2])
+    shared = feature_image_factory(preprocessing_batch=batches[3], blob=pruned.blob.name)
+    pruned_mask = feature_mask_factory(preprocessing_batch=batches[2])
+    shared_mask = feature_mask_factory(preprocessing_batch=batches[3], blob=pruned_mask.blob.name)
+
+    assert garbage.prune_preprocessing_batches(retained=1) == 1
+    assert not PreprocessingBatch.objects.filter(pk=batches[2].pk).exists()
+    assert PreprocessingBatch.objects.filter(dataset=dataset).count() == 4
+    assert not FeatureImage.objects.filter(pk=pruned.pk).exists()
+    assert default_storage.exists(shared.blob.name)
+    assert not FeatureMask.objects.filter(pk=pruned_mask.pk).exists()
+    assert default_storage.exists(shared_mask.blob.name)
+
+    # Once unreferenced, objects are deleted along with their batch
+    assert garbage.prune_preprocessing_batches(retained=0) == 1
+    assert not default_storage.exists(shared.blob.name)
+    assert not default_storage.exists(shared_mask.blob.name)
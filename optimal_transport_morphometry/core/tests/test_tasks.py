@@ -1,6 +1,30 @@
+import pathlib
+import sys
+
 import pytest
 
-from optimal_transport_morphometry.core.models import AnalysisResult, Dataset, PreprocessingBatch
+from optimal_transport_morphometry.core import tasks
+from optimal_transport_morphometry.core.analysis import (
+    analysis_fingerprint,
+    numeric_variables,
+    write_vbm_maps,
+)
+from optimal_transport_morphometry.core.models import (
+    AnalysisResult,
+    Dataset,
+    FeatureMask,
+    Image,
+    PreprocessingBatch,
+)
+from optimal_transport_morphometry.core.models.covariate import design_matrix
+from optimal_transport_morphometry.core.rworker import (
+    RWorker,
+    RWorkerError,
+    RWorkerPool,
+    RWorkerStartError,
+)
+from optimal_transport_morphometry.core.tasks import upload_analysis_images
+from optimal_transport_morphometry.core.vbm import correlation_maps
 
 
 @pytest.fixture
@@ -26,12 +50,132 @@ def test_dispatch_preprocess(user, api_client, dataset_factory, image_factory):
     # Assert resp
     assert r.status_code == 200
 
+    # The most accurate registration is used by default
+    assert r.json()['registration_profile'] == 'syn'
+
     # Get batch
     batch_id = r.json()['id']
     r = api_client.get(f'/api/v1/preprocessing_batches/{batch_id}')
     assert r.status_code == 200
 
 
+@pytest.mark.django_db
+def test_dispatch_preprocess_registration_profile(user, api_client, dataset_factory, image_factory):
+    api_client.force_authenticate(user)
+
+    dataset: Dataset = dataset_factory(owner=user)
+    image_factory(dataset=dataset)
+    r = api_client.post(
+        f'/api/v1/datasets/{dataset.id}/preprocess', {'registration_profile': 'unknown'}
+    )
+    assert r.status_code == 400
+    assert 'registration_profile' in r.json()
+
+    r = api_client.post(
+        f'/api/v1/datasets/{dataset.id}/preprocess', {'registration_profile': 'fast_affine'}
+    )
+    assert r.status_code == 200
+    assert r.json()['registration_profile'] == 'fast_affine'
+    batch = PreprocessingBatch.objects.get(pk=r.json()['id'])
+    assert batch.registration_profile == 'fast_affine'
+
+
+@pytest.mark.django_db
+def test_dispatch_preprocess_feature_images(user, api_client, dataset_factory, image_factory):
+    api_client.force_authenticate(user)
+
+    dataset: Dataset = dataset_factory(owner=user)
+    image_factory(dataset=dataset)
+    r = api_client.post(
+        f'/api/v1/datasets/{dataset.id}/preprocess',
+        {'feature_tissues': ['bone'], 'downsample_factors': [3.0]},
+    )
+    assert r.status_code == 400
+    assert 'feature_tissues' in r.json()
+
+    r = api_client.post(
+        f'/api/v1/datasets/{dataset.id}/preprocess',
+        {
+            'feature_tissues': ['grey', 'white', 'grey'],
+            'modulated': False,
+            'downsample_factors': [1.0, 3.0],
+        },
+    )
+    assert r.status_code == 200
+    batch = PreprocessingBatch.objects.get(pk=r.json()['id'])
+    assert batch.feature_tissues == ['grey', 'white']
+    assert not batch.modulated
+    assert batch.downsample_factors == [1.0, 3.0]
+
+    # A registered, Jacobian and segmented image, and a feature image per tissue and factor
+    assert batch.outputs_per_image == 7
+
+
+@pytest.mark.django_db
+def test_dispatch_preprocess_output_encoding(user, api_client, dataset_factory, image_factory):
+    api_client.force_authenticate(user)
+
+    dataset: Dataset = dataset_factory(owner=user)
+    image_factory(dataset=dataset)
+    r = api_client.post(f'/api/v1/datasets/{dataset.id}/preprocess', {'compression_level': 0})
+    assert r.status_code == 400
+    assert 'compression_level' in r.json()
+
+    r = api_client.post(
+        f'/api/v1/datasets/{dataset.id}/preprocess',
+        {'output_dtype': 'float64', 'output_codec': 'raw'},
+    )
+    assert r.status_code == 200
+    batch = PreprocessingBatch.objects.get(pk=r.json()['id'])
+    assert batch.output_encoding.dtype == 'float64'
+    assert batch.output_encoding.suffix == '.nii'
+
+
+@pytest.mark.django_db
+def test_dispatch_preprocess_derive_only(
+    user, api_client, preprocessed_dataset, image_factory, registered_image_factory
+):
+    api_client.force_authenticate(user)
+
+    dataset: Dataset = preprocessed_dataset
+    current_batch: PreprocessingBatch = dataset.current_preprocessing_batch
+    PreprocessingBatch.objects.filter(pk=current_batch.pk).update(
+        registration_profile='fast_affine'
+    )
+    image = image_factory(dataset=dataset)
+    registered_image = registered_image_factory(
+        source_image=image, preprocessing_batch=current_batch
+    )
+
+    # Registrations from before transforms were stored can't be derived from
+    data = {'derive_only': True, 'downsample_factors': [2.0]}
+    r = api_client.post(f'/api/v1/datasets/{dataset.id}/preprocess', data)
+    assert r.status_code == 400
+    assert r.json() == ['The current preprocessing batch has no stored transforms.']
+
+    registered_image.affine_transform = 'transforms/affine.mat'
+    registered_image.save()
+    r = api_client.post(f'/api/v1/datasets/{dataset.id}/preprocess', data)
+    assert r.status_code == 200
+    batch = PreprocessingBatch.objects.get(pk=r.json()['id'])
+    assert batch.derived_from == current_batch
+    assert batch.downsample_factors == [2.0]
+    assert batch.registration_profile == 'fast_affine'
+
+
+@pytest.mark.django_db
+def test_dispatch_preprocess_derive_only_unfinished(
+    user, api_client, dataset_factory, image_factory
+):
+    api_client.force_authenticate(user)
+
+    dataset: Dataset = dataset_factory(owner=user)
+    image_factory(dataset=dataset)
+    r = api_client.post(f'/api/v1/datasets/{dataset.id}/preprocess', {'derive_only': True})
+    assert r.status_code == 400
+    assert r.json() == ['Deriving requires a finished preprocessing batch.']
+
+
 @pytest.mark.django_db
 def test_dispatch_preprocess_empty(user, api_client, dataset_factory):
     api_client.force_authenticate(user)
@@ -44,6 +188,19 @@ def test_dispatch_preprocess_empty(user, api_client, dataset_factory):
     assert r.json() == ['Cannot run preprocessing on empty dataset.']
 
 
+@pytest.mark.django_db
+def test_dispatch_preprocess_invalid(user, api_client, dataset_factory, image_factory):
+    api_client.force_authenticate(user)
+
+    dataset: Dataset = dataset_factory(owner=user)
+    image_factory(dataset=dataset, validation_status=Image.ValidationStatus.INVALID)
+    r = api_client.post(f'/api/v1/datasets/{dataset.id}/preprocess')
+
+    # Assert resp
+    assert r.status_code == 400
+    assert r.json() == ['Cannot run preprocessing with no valid images.']
+
+
 @pytest.mark.django_db
 def test_dispatch_preprocess_existing(user, api_client, dataset_factory, image_factory):
     api_client.force_authenticate(user)
@@ -89,6 +246,229 @@ def test_dispatch_utm_analysis(api_client, preprocessed_dataset):
     assert analysis.preprocessing_batch == dataset.current_preprocessing_batch
 
 
+@pytest.mark.django_db
+def test_dispatch_utm_analysis_backend(api_client, preprocessed_dataset):
+    dataset: Dataset = preprocessed_dataset
+    api_client.force_authenticate(dataset.owner)
+
+    r = api_client.post(f'/api/v1/datasets/{dataset.id}/utm_analysis', {'backend': 'foo'})
+    assert r.status_code == 400
+
+    r = api_client.post(f'/api/v1/datasets/{dataset.id}/utm_analysis', {'backend': 'vbm'})
+    assert r.status_code == 204
+
+    dataset.refresh_from_db()
+    assert dataset.current_analysis_result.backend == AnalysisResult.Backend.VBM
+    r = api_client.get(f'/api/v1/analysis/{dataset.current_analysis_result.id}')
+    assert r.json()['backend'] == 'vbm'
+
+
+@pytest.fixture
+def analyzed_batch(preprocessed_dataset, image_factory, feature_image_factory):
+    batch: PreprocessingBatch = preprocessed_dataset.current_preprocessing_batch
+    for age in [30, 40, 50]:
+        image = image_factory(dataset=preprocessed_dataset, metadata={'age': age})
+        feature_image_factory(source_image=image, preprocessing_batch=batch)
+
+    return batch
+
+
+def _fingerprint(batch: PreprocessingBatch, backend: str) -> str:
+    feature_images = list(batch.primary_feature_images().select_related('source_image'))
+    columns, rows = design_matrix(
+        batch.dataset, [feature_image.source_image for feature_image in feature_images]
+    )
+    return analysis_fingerprint(backend, feature_images, columns, rows)
+
+
+@pytest.mark.django_db
+def test_analysis_fingerprint(analyzed_batch):
+    fingerprint = _fingerprint(analyzed_batch, 'vbm')
+    assert _fingerprint(analyzed_batch, 'vbm') == fingerprint
+
+    # Metadata, and the content of feature images, change the results
+    image = analyzed_batch.dataset.images.first()
+    image.metadata = {'age': 60}
+    image.save()
+    assert _fingerprint(analyzed_batch, 'vbm') != fingerprint
+
+    fingerprint = _fingerprint(analyzed_batch, 'vbm')
+    analyzed_batch.primary_feature_images().filter(source_image=image).update(checksum='0' * 64)
+    assert _fingerprint(analyzed_batch, 'vbm') != fingerprint
+
+
+@pytest.mark.django_db
+def test_analysis_fingerprint_mask(analyzed_batch, feature_mask_factory):
+    fingerprint = _fingerprint(analyzed_batch, 'vbm')
+    feature_mask_factory(preprocessing_batch=analyzed_batch, kind=FeatureMask.Kind.SUPPORT)
+    assert _fingerprint(analyzed_batch, 'vbm') != fingerprint
+
+    # Once the union mask is stored, analyses are restricted to it instead
+    fingerprint = _fingerprint(analyzed_batch, 'vbm')
+    feature_mask_factory(preprocessing_batch=analyzed_batch, kind=FeatureMask.Kind.UNION)
+    assert _fingerprint(analyzed_batch, 'vbm') != fingerprint
+
+
+@pytest.mark.django_db
+def test_run_utm_memoized(analyzed_batch):
+    previous = AnalysisResult.objects.create(
+        preprocessing_batch=analyzed_batch,
+        backend=AnalysisResult.Backend.VBM,
+        fingerprint=_fingerprint(analyzed_batch, 'vbm'),
+        status=AnalysisResult.Status.FINISHED,
+        zip_file='analysis.zip',
+        data={'age': {'vbm': {'correlation': 'correlation.nii.gz', 'pvalue': 'pvalue.nii.gz'}}},
+    )
+    analysis = AnalysisResult.objects.create(
+        preprocessing_batch=analyzed_batch, backend=AnalysisResult.Backend.VBM
+    )
+
+    # The identical analysis's results are reused, without running the backend
+    tasks.run_utm(analysis.id)
+    analysis.refresh_from_db()
+    assert analysis.status == AnalysisResult.Status.FINISHED
+    assert analysis.fingerprint == previous.fingerprint
+    assert analysis.zip_file.name == previous.zip_file.name
+    assert analysis.data == previous.data
+
+
+@pytest.mark.django_db
+def test_dispatch_utm_analysis_force(mocker, api_client, preprocessed_dataset):
+    run_utm = mocker.patch.object(tasks.run_utm, 'delay')
+    dataset: Dataset = preprocessed_dataset
+    api_client.force_authenticate(dataset.owner)
+
+    r = api_client.post(f'/api/v1/datasets/{dataset.id}/utm_analysis', {'force': True})
+    assert r.status_code == 204
+
+    dataset.refresh_from_db()
+    run_utm.assert_called_once_with(dataset.current_analysis_result.id, force=True)
+
+
+def test_numeric_variables():
+    rows = [
+        {'name': 'a', 'age': 40, 'weight': 70.5, 'sex': 'M', 'control': True, 'site': None},
+        {'name': 'b', 'age': '', 'weight': 80, 'sex': 'F', 'control': False},
+    ]
+    columns = ['name', 'age', 'weight', 'sex', 'control', 'site']
+    assert numeric_variables(columns, rows) == ['age', 'weight']
+
+
+def test_correlation_maps():
+    np = pytest.importorskip('numpy')
+    pytest.importorskip('scipy')
+
+    rng = np.random.default_rng(0)
+    values = rng.random((50, 1000))
+    values[:, 0] = 1
+    design = np.stack([values[:, 1] + rng.normal(scale=0.1, size=50), rng.normal(size=50)], axis=1)
+    design[:5, 1] = np.nan
+
+    correlation, pvalue = correlation_maps(iter(values), design, 1000)
+    present = ~np.isnan(design[:, 1])
+    assert correlation[0, 1] == pytest.approx(np.corrcoef(values[:, 1], design[:, 0])[0, 1])
+    assert correlation[1, 2] == pytest.approx(
+        np.corrcoef(values[present, 2], design[present, 1])[0, 1]
+    )
+    assert pvalue[0, 1] < 0.05
+
+    # Constant voxels aren't correlated with anything
+    assert (correlation[:, 0] == 0).all()
+    assert (pvalue[:, 0] == 1).all()
+
+
+def test_write_vbm_maps(tmp_path: pathlib.Path):
+    ants = pytest.importorskip('ants')
+    np = pytest.importorskip('numpy')
+
+    mask = np.zeros((4, 5, 6), dtype=np.float32)
+    mask[1:3, 1:4, 1:5] = 1
+    mask_img = ants.from_numpy(mask)
+    voxel_count = int(mask.sum())
+    correlation = np.full((1, voxel_count), 0.5)
+    pvalue = np.full((1, voxel_count), 0.01)
+    write_vbm_maps(str(tmp_path), ['age'], correlation, pvalue, mask_img)
+
+    # Voxels outside of the mask aren't tested, so aren't significant
+    vbm = tmp_path / 'Analysis' / 'Images' / 'age' / 'vbm'
+    pvalue_map = ants.image_read(str(vbm / 'pvalue.nii.gz')).numpy()
+    correlation_map = ants.image_read(str(vbm / 'correlation.nii.gz')).numpy()
+    assert (pvalue_map[mask == 0] == 1).all()
+    assert pvalue_map[mask > 0] == pytest.approx(0.01)
+    assert (correlation_map[mask == 0] == 0).all()
+    assert correlation_map[mask > 0] == pytest.approx(0.5)
+
+
+@pytest.mark.django_db
+def test_upload_analysis_images(tmp_path: pathlib.Path):
+    for variable in ['age', 'weight']:
+        vbm = tmp_path / 'Analysis' / 'Images' / variable / 'vbm'
+        vbm.mkdir(parents=True)
+        for name in ['correlation', 'pvalue']:
+            (vbm / f'{name}.nii.gz').write_bytes(b'image')
+
+    # Only the features a backend computes are required
+    assert upload_analysis_images(str(tmp_path)) == {}
+    data = upload_analysis_images(str(tmp_path), ['vbm'])
+    assert set(data) == {'age', 'weight'}
+    assert set(data['age']['vbm']) == {'correlation', 'pvalue'}
+
+
+# Speaks the protocol of rworker.R, running "scripts" which exit with their number of arguments
+FAKE_R_WORKER = """
+import os
+import sys
+
+responses = os.fdopen(int(sys.argv[1]), 'w', buffering=1)
+responses.write('READY\\n')
+for line in sys.stdin:
+    fields = line.rstrip('\\n').split('\\t')
+    if fields[0] == 'PING':
+        responses.write('PONG\\n')
+    elif fields[1] == 'crash':
+        os._exit(1)
+    else:
+        responses.write(f'DONE\\t{len(fields) - 2}\\n')
+"""
+
+
+@pytest.fixture
+def fake_r_worker(tmp_path: pathlib.Path):
+    script = tmp_path / 'worker.py'
+    script.write_text(FAKE_R_WORKER)
+    return {'packages': [], 'command': [sys.executable, str(script)]}
+
+
+def test_r_worker(fake_r_worker):
+    worker = RWorker(**fake_r_worker)
+    worker.start()
+    try:
+        assert worker.healthy()
+        assert worker.run('script.R', ['a', 'b']) == 2
+
+        worker.process.kill()
+        worker.process.wait()
+        assert not worker.healthy()
+    finally:
+        worker.stop()
+
+    with pytest.raises(RWorkerStartError):
+        RWorker(packages=[], command=[sys.executable, '-c', 'pass']).start()
+
+
+def test_r_worker_pool_restart(fake_r_worker):
+    pool = RWorkerPool(1, **fake_r_worker)
+    try:
+        assert pool.run('script.R', ['a']) == 1
+
+        # A worker which crashes is restarted for the next script
+        with pytest.raises(RWorkerError):
+            pool.run('crash', [])
+        assert pool.run('script.R', []) == 0
+    finally:
+        pool.close()
+
+
 @pytest.mark.django_db
 def test_dispatch_utm_analysis_existing(api_client, preprocessed_dataset):
     dataset: Dataset = preprocessed_dataset
@@ -1,12 +1,24 @@
+import base64
+import datetime
+import hashlib
 import pathlib
 from pathlib import Path
 from typing import List
 
+from django.core.exceptions import ValidationError
+
 # from django.core.files import File
-# from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.utils import timezone
 import pytest
+import requests
 
-from optimal_transport_morphometry.core import batch_parser, models
+from optimal_transport_morphometry.core import batch_parser, garbage, models, multipart
+from optimal_transport_morphometry.core.models.covariate import (
+    dataset_covariates,
+    design_matrix,
+    image_covariate_values,
+)
 
 # from optimal_transport_morphometry.core.models.dataset import Dataset
 
@@ -26,15 +38,200 @@ def test_load_batch_from_csv(batch):
 
 
 @pytest.mark.django_db
-def test_upload_batch_finalization_cleanup(batch):
+def test_load_batch_from_csv_typed_metadata(batch):
+    upload: models.PendingUpload = batch.pending_uploads.get(name='subject0001.nii')
+    assert upload.metadata['Age'] == 71
+    assert upload.metadata['CentiloidfSUVR'] == 5.729938278
+    assert upload.metadata['TotalGray'] == 487405.489639
+
+
+@pytest.mark.django_db
+def test_load_batch_from_csv_overflow(dataset):
+    batch = batch_parser.load_batch_from_csv(['name,Volume', 'a.nii,1e400'], dataset)
+
+    # Infinity can't be stored in JSON, so the value is kept as it was written
+    assert batch.pending_uploads.get().metadata == {'Volume': '1e400'}
+    assert dataset.covariates.get().type == models.Covariate.Type.CATEGORY
+
+
+@pytest.mark.django_db
+def test_load_batch_from_csv_covariates(batch):
+    covariates = {c.name: c for c in batch.dataset.covariates.all()}
+    assert covariates['Age'].type == models.Covariate.Type.INTEGER
+    assert covariates['CentiloidfSUVR'].type == models.Covariate.Type.FLOAT
+
+
+@pytest.mark.django_db
+def test_load_batch_from_csv_covariates_widen(dataset):
+    batch_parser.load_batch_from_csv(['name,Age,Site', 'a.nii,71,Boston'], dataset)
+    batch_parser.load_batch_from_csv(['name,Age,Site', 'b.nii,65.5,Paris'], dataset)
+
+    age, site = dataset.covariates.all()
+    assert age.type == models.Covariate.Type.FLOAT
+    assert site.type == models.Covariate.Type.CATEGORY
+    assert site.categories == ['Boston', 'Paris']
+
+    # Numeric covariates can't be narrowed to categories
+    with pytest.raises(ValidationError):
+        batch_parser.load_batch_from_csv(['name,Age', 'c.nii,old'], dataset)
+
+
+@pytest.mark.django_db
+def test_load_batch_from_csv_chunked(dataset, image_factory):
+    image_factory(dataset=dataset, name='b.nii')
+    csvfile = ['name,Age', 'a.nii,1', 'b.nii,2', 'c.nii,3', 'a.nii,4', 'd.nii,5']
+    batch = batch_parser.load_batch_from_csv(csvfile, dataset, chunk_size=2)
+
+    # Existing images and repeated names are skipped
+    assert sorted(batch.pending_uploads.values_list('name', flat=True)) == [
+        'a.nii',
+        'c.nii',
+        'd.nii',
+    ]
+    assert batch.pending_uploads.get(name='a.nii').metadata == {'Age': 1}
+    assert batch.errors == []
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('chunk_size', [1, 2, batch_parser.CHUNK_SIZE])
+def test_load_batch_from_csv_chunked_covariates(dataset, chunk_size):
+    csvfile = ['name,Age,Site', 'a.nii,71,1', 'b.nii,65.5,2', 'c.nii,80,Boston', 'd.nii,70,1']
+    batch = batch_parser.load_batch_from_csv(csvfile, dataset, chunk_size=chunk_size)
+
+    # New covariates are typed by every row, not only those in the first chunk
+    assert batch.pending_uploads.count() == 4
+    assert batch.errors == []
+    age, site = dataset.covariates.all()
+    assert age.type == models.Covariate.Type.FLOAT
+    assert site.type == models.Covariate.Type.CATEGORY
+    assert site.categories == ['1', '2', 'Boston']
+
+
+@pytest.mark.django_db
+def test_load_batch_from_csv_row_errors(dataset):
+    batch_parser.load_batch_from_csv(['name,Age', 'a.nii,71'], dataset)
+    csvfile = ['name,Age', 'b.nii,old', ',60', 'c.nii,65,extra', 'd.nii', 'e.nii,50']
+    batch = batch_parser.load_batch_from_csv(csvfile, dataset)
+
+    assert list(batch.pending_uploads.values_list('name', flat=True)) == ['e.nii']
+    assert batch.errors == [
+        {'line': 2, 'error': 'Column "Age" must be a number, not "old".'},
+        {'line': 3, 'error': 'Missing image name.'},
+        {'line': 4, 'error': 'Row has more fields than the header.'},
+        {'line': 5, 'error': 'Row has fewer fields than the header.'},
+    ]
+
+    # A batch is only created if at least one row is valid
+    with pytest.raises(ValidationError):
+        batch_parser.load_batch_from_csv(['Age', '71'], dataset)
+
+
+@pytest.mark.django_db
+def test_load_batch_from_csv_many_row_errors(dataset, mocker):
+    mocker.patch.object(batch_parser, 'MAX_RECORDED_ERRORS', 2)
+    csvfile = ['name,Age', ',1', ',2', ',3', ',4', 'a.nii,5']
+    batch = batch_parser.load_batch_from_csv(csvfile, dataset, chunk_size=2)
+
+    # Errors beyond the limit are only counted
+    assert batch.errors == [
+        {'line': 2, 'error': 'Missing image name.'},
+        {'line': 3, 'error': 'Missing image name.'},
+    ]
+    assert batch.unrecorded_errors == 2
+
+
+@pytest.mark.django_db
+def test_upload_batch_create(api_client, user, dataset_factory):
+    dataset: models.Dataset = dataset_factory(owner=user)
+    api_client.force_authenticate(user)
+
+    with open(testcsv, 'rb') as fd:
+        r = api_client.post(
+            f'/api/v1/datasets/{dataset.id}/upload_batch', {'csvfile': fd}, format='multipart'
+        )
+    assert r.status_code == 201
+    assert r.json()['errors'] == []
+    assert models.PendingUpload.objects.filter(batch_id=r.json()['id']).count() == 3
+
+    # All images are already pending, but not yet images, so a second batch is created
+    with open(testcsv, 'rb') as fd:
+        r = api_client.post(
+            f'/api/v1/datasets/{dataset.id}/upload_batch', {'csvfile': fd}, format='multipart'
+        )
+    assert r.status_code == 201
+
+    csvfile = SimpleUploadedFile('invalid.csv', b'name,Age\n,1\n')
+    r = api_client.post(
+        f'/api/v1/datasets/{dataset.id}/upload_batch', {'csvfile': csvfile}, format='multipart'
+    )
+    assert r.status_code == 400
+    assert r.json() == ['Line 2: Missing image name.']
+
+
+@pytest.mark.django_db
+def test_design_matrix(dataset, image_factory):
+    batch_parser.load_batch_from_csv(['name,Age,Site', 'a.nii,71,Boston', 'b.nii,,Paris'], dataset)
+    covariates = dataset_covariates(dataset)
+
+    images = []
+    for metadata in [{'Age': 71, 'Site': 'Boston', 'Notes': 'x'}, {'Site': 'Paris'}]:
+        image = image_factory.build(dataset=dataset)
+        values = image_covariate_values(image, metadata, covariates)
+        image.save()
+        models.CovariateValue.objects.bulk_create(values)
+        images.append(image)
+
+    assert images[0].metadata == {'Notes': 'x'}
+    columns, rows = design_matrix(dataset, images)
+    assert columns == ['Age', 'Site', 'Notes']
+    assert rows == {
+        images[0].id: {'Age': 71, 'Site': 'Boston', 'Notes': 'x'},
+        images[1].id: {'Site': 'Paris'},
+    }
+
+
+@pytest.mark.django_db
+def test_upload_batch_finalization_cleanup(batch, django_capture_on_commit_callbacks):
+    assert batch.remaining_uploads == 3
     for pending in batch.pending_uploads.all():
         batch.refresh_from_db()
-        pending.delete()
+        assert not batch.is_complete
+        with django_capture_on_commit_callbacks(execute=True):
+            pending.delete()
 
     with pytest.raises(models.UploadBatch.DoesNotExist):
         batch.refresh_from_db()
 
 
+@pytest.mark.django_db
+def test_upload_batch_bulk_delete(
+    dataset,
+    upload_batch_factory,
+    pending_upload_factory,
+    django_assert_max_num_queries,
+    django_capture_on_commit_callbacks,
+):
+    batches = [upload_batch_factory(dataset=dataset) for _ in range(2)]
+    for batch in batches:
+        for i in range(50):
+            pending_upload_factory(batch=batch, name=f'{i}.nii')
+
+    # Queries don't scale with the number of uploads deleted
+    kept = batches[1].pending_uploads.first()
+    with django_assert_max_num_queries(6):
+        with django_capture_on_commit_callbacks() as callbacks:
+            models.PendingUpload.objects.exclude(pk=kept.pk).delete()
+
+    for batch in batches:
+        batch.refresh_from_db()
+    assert [batch.remaining_uploads for batch in batches] == [0, 1]
+
+    # Only the completed batch is deleted once committed
+    for callback in callbacks:
+        callback()
+    assert list(models.UploadBatch.objects.all()) == [batches[1]]
+
+
 @pytest.mark.django_db
 def test_upload_batch_access(api_client, user, dataset_factory, upload_batch_factory):
     batch: models.UploadBatch = upload_batch_factory(dataset=dataset_factory(owner=user))
@@ -69,6 +266,45 @@ def test_upload_batch_pending_access(
     assert len(r.json()['results']) == len(uploads)
 
 
+@pytest.mark.django_db
+def test_upload_batch_pending_pages(
+    api_client, user, dataset_factory, upload_batch_factory, pending_upload_factory
+):
+    batch: models.UploadBatch = upload_batch_factory(dataset=dataset_factory(owner=user))
+    uploads = [pending_upload_factory(batch=batch, name=f'{i}.nii') for i in range(5)]
+
+    # Pages are ordered, so together list every pending upload exactly once
+    api_client.force_authenticate(user)
+    ids = []
+    for offset in range(0, len(uploads), 2):
+        r = api_client.get(
+            f'/api/v1/upload/batches/{batch.id}/pending', {'limit': 2, 'offset': offset}
+        )
+        ids.extend(upload['id'] for upload in r.json()['results'])
+    assert ids == [upload.id for upload in uploads]
+
+
+@pytest.mark.django_db
+def test_upload_batch_pending_filter_name(
+    api_client, user, dataset_factory, upload_batch_factory, pending_upload_factory
+):
+    batch: models.UploadBatch = upload_batch_factory(dataset=dataset_factory(owner=user))
+    pending_upload_factory(batch=batch, name='subject0001.nii')
+    pending_upload_factory(batch=batch, name='subject0002.nii')
+    pending_upload_factory(batch=batch, name='subject0010.nii')
+
+    api_client.force_authenticate(user)
+    r = api_client.get(f'/api/v1/upload/batches/{batch.id}/pending', {'name': 'SUBJECT000'})
+    assert r.status_code == 200
+    assert r.json()['count'] == 2
+
+    r = api_client.get(
+        f'/api/v1/upload/batches/{batch.id}/pending', {'name': 'subject0001', 'ranked': True}
+    )
+    assert r.status_code == 200
+    assert r.json()['results'][0]['name'] == 'subject0001.nii'
+
+
 @pytest.mark.django_db
 def test_upload_batch_pending_access_unauthorized(
     api_client, user, dataset_factory, upload_batch_factory, pending_upload_factory
@@ -132,3 +368,179 @@ def test_pending_upload_access_unauthorized(
 #     )
 #     print(r.json())
 #     assert r.status_code == 201
+
+
+@pytest.mark.django_db
+def test_upload_batch_multipart(
+    api_client, user, dataset_factory, upload_batch_factory, pending_upload_factory
+):
+    batch: models.UploadBatch = upload_batch_factory(dataset=dataset_factory(owner=user))
+    upload: models.PendingUpload = pending_upload_factory(batch=batch, name='a.nii.gz')
+    content = b'NIfTI' * 1000
+    md5 = base64.b64encode(hashlib.md5(content).digest()).decode()
+
+    api_client.force_authenticate(user)
+    r = api_client.post(
+        f'/api/v1/upload/batches/{batch.id}/multipart_initialize',
+        {'uploads': [{'pending_upload': upload.id, 'size': len(content)}]},
+    )
+    assert r.status_code == 200
+    (transfer,) = r.json()
+    assert transfer['object_key'].endswith('/a.nii.gz')
+    assert transfer['parts'] == [{'part_number': 1, 'size': len(content)}]
+    assert transfer['uploaded_parts'] == []
+
+    parts = [{'pending_upload': upload.id, 'part_number': 1, 'md5': md5}]
+    r = api_client.post(f'/api/v1/upload/batches/{batch.id}/multipart_presign', {'parts': parts})
+    assert r.status_code == 200
+    upload_url = r.json()[0]['upload_url']
+
+    # A corrupt part is rejected when completing, even if storage accepted it
+    corrupt = b'X' * len(content)
+    requests.put(upload_url, data=corrupt, headers={'Content-MD5': md5})
+    completion = {'pending_upload': upload.id, 'parts': [{'part_number': 1, 'md5': md5}]}
+    r = api_client.post(
+        f'/api/v1/upload/batches/{batch.id}/multipart_complete', {'uploads': [completion]}
+    )
+    assert r.status_code == 400
+    assert r.json() == {str(upload.id): 'Part 1 does not match its checksum.'}
+
+    # Initializing again resumes the upload, and the part can be retried
+    r = api_client.post(
+        f'/api/v1/upload/batches/{batch.id}/multipart_initialize',
+        {'uploads': [{'pending_upload': upload.id, 'size': len(content)}]},
+    )
+    assert r.json()[0]['upload_id'] == transfer['upload_id']
+    assert r.json()[0]['uploaded_parts'] == [
+        {'part_number': 1, 'etag': hashlib.md5(corrupt).hexdigest()}
+    ]
+    assert requests.put(upload_url, data=content, headers={'Content-MD5': md5}).ok
+
+    r = api_client.post(
+        f'/api/v1/upload/batches/{batch.id}/multipart_complete', {'uploads': [completion]}
+    )
+    assert r.status_code == 200
+    image = models.Image.objects.get(id=r.json()[0]['id'])
+    assert image.name == 'a.nii.gz'
+    assert image.blob.read() == content
+    assert image.size == len(content)
+    assert image.checksum == hashlib.md5(hashlib.md5(content).digest()).hexdigest() + '-1'
+    assert not models.PendingUpload.objects.filter(id=upload.id).exists()
+
+
+@pytest.mark.django_db
+def test_upload_batch_multipart_unauthorized(
+    api_client, user, user_factory, dataset_factory, upload_batch_factory, pending_upload_factory
+):
+    batch: models.UploadBatch = upload_batch_factory(
+        dataset=dataset_factory(owner=user, public=True)
+    )
+    upload: models.PendingUpload = pending_upload_factory(batch=batch)
+    data = {'uploads': [{'pending_upload': upload.id, 'size': 1}]}
+
+    r = api_client.post(f'/api/v1/upload/batches/{batch.id}/multipart_initialize', data)
+    assert r.status_code == 401
+
+    api_client.force_authenticate(user_factory())
+    r = api_client.post(f'/api/v1/upload/batches/{batch.id}/multipart_initialize', data)
+    assert r.status_code == 403
+
+    api_client.force_authenticate(user)
+    data['uploads'][0]['pending_upload'] = upload.id + 1
+    r = api_client.post(f'/api/v1/upload/batches/{batch.id}/multipart_initialize', data)
+    assert r.status_code == 404
+
+
+@pytest.mark.django_db
+def test_upload_batch_multipart_duplicate(
+    api_client, user, dataset_factory, upload_batch_factory, pending_upload_factory
+):
+    batch: models.UploadBatch = upload_batch_factory(dataset=dataset_factory(owner=user))
+    upload: models.PendingUpload = pending_upload_factory(batch=batch, name='a.nii.gz')
+    md5 = base64.b64encode(hashlib.md5(b'NIfTI').digest()).decode()
+
+    api_client.force_authenticate(user)
+    initialization = {'pending_upload': upload.id, 'size': 5}
+    r = api_client.post(
+        f'/api/v1/upload/batches/{batch.id}/multipart_initialize',
+        {'uploads': [initialization, initialization]},
+    )
+    assert r.status_code == 400
+    assert r.json() == {'uploads': ['Each pending upload may only be included once.']}
+
+    completion = {'pending_upload': upload.id, 'parts': [{'part_number': 1, 'md5': md5}]}
+    r = api_client.post(
+        f'/api/v1/upload/batches/{batch.id}/multipart_complete',
+        {'uploads': [completion, completion]},
+    )
+    assert r.status_code == 400
+    assert r.json() == {'uploads': ['Each pending upload may only be included once.']}
+
+
+@pytest.mark.django_db
+def test_upload_batch_multipart_retry(
+    api_client, user, dataset_factory, upload_batch_factory, pending_upload_factory, mocker
+):
+    batch: models.UploadBatch = upload_batch_factory(dataset=dataset_factory(owner=user))
+    upload: models.PendingUpload = pending_upload_factory(batch=batch, name='a.nii.gz')
+    content = b'NIfTI' * 1000
+    md5 = base64.b64encode(hashlib.md5(content).digest()).decode()
+
+    api_client.force_authenticate(user)
+    r = api_client.post(
+        f'/api/v1/upload/batches/{batch.id}/multipart_initialize',
+        {'uploads': [{'pending_upload': upload.id, 'size': len(content)}]},
+    )
+    parts = [{'pending_upload': upload.id, 'part_number': 1, 'md5': md5}]
+    r = api_client.post(f'/api/v1/upload/batches/{batch.id}/multipart_presign', {'parts': parts})
+    assert requests.put(r.json()[0]['upload_url'], data=content, headers={'Content-MD5': md5}).ok
+
+    # The upload is completed in storage, but the transaction which created its image fails
+    mocker.patch(
+        'optimal_transport_morphometry.core.rest.upload_batch.finalize_uploads',
+        side_effect=RuntimeError('Database unavailable'),
+    )
+    completion = {'pending_upload': upload.id, 'parts': [{'part_number': 1, 'md5': md5}]}
+    with pytest.raises(RuntimeError):
+        api_client.post(
+            f'/api/v1/upload/batches/{batch.id}/multipart_complete', {'uploads': [completion]}
+        )
+    assert models.PendingUpload.objects.filter(id=upload.id).exists()
+    mocker.stopall()
+
+    # A retry is checked against the completed object, rather than its parts
+    wrong_md5 = base64.b64encode(hashlib.md5(b'other').digest()).decode()
+    wrong = {'pending_upload': upload.id, 'parts': [{'part_number': 1, 'md5': wrong_md5}]}
+    r = api_client.post(
+        f'/api/v1/upload/batches/{batch.id}/multipart_complete', {'uploads': [wrong]}
+    )
+    assert r.status_code == 400
+    assert r.json() == {str(upload.id): 'Completed upload does not match its checksum.'}
+
+    r = api_client.post(
+        f'/api/v1/upload/batches/{batch.id}/multipart_complete', {'uploads': [completion]}
+    )
+    assert r.status_code == 200
+    image = models.Image.objects.get(id=r.json()[0]['id'])
+    assert image.blob.read() == content
+    assert image.checksum == hashlib.md5(hashlib.md5(content).digest()).hexdigest() + '-1'
+
+
+@pytest.mark.django_db
+def test_abort_abandoned_uploads(
+    user, dataset_factory, upload_batch_factory, pending_upload_factory
+):
+    batch: models.UploadBatch = upload_batch_factory(dataset=dataset_factory(owner=user))
+    upload: models.PendingUpload = pending_upload_factory(batch=batch, name='a.nii.gz')
+    upload.object_key = 'uploads/a.nii.gz'
+    upload.upload_id = multipart.create_upload(upload.object_key)
+    upload.save()
+    abandoned_id = multipart.create_upload('uploads/abandoned.nii.gz')
+
+    cutoff = timezone.now() + datetime.timedelta(seconds=1)
+    assert garbage.abort_abandoned_uploads(cutoff, dry_run=True) >= 1
+    assert multipart.uploaded_parts('uploads/abandoned.nii.gz', abandoned_id) == {}
+    garbage.abort_abandoned_uploads(cutoff)
+    with pytest.raises(multipart.UploadNotFoundError):
+        multipart.uploaded_parts('uploads/abandoned.nii.gz', abandoned_id)
+    assert multipart.uploaded_parts(upload.object_key, upload.upload_id) == {}
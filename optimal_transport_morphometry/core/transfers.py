@@ -0,0 +1,291 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import os
+import pathlib
+import shutil
+import tempfile
+from tempfile import NamedTemporaryFile, mkdtemp
+from typing import Iterable, Iterator, List, Optional
+
+from django.core.files import File
+
+from optimal_transport_morphometry.core.encoding import (
+    OutputEncoding,
+    nifti_suffix,
+    read_values,
+    write_image,
+    write_values,
+)
+from optimal_transport_morphometry.core.models import FeatureImage, FeatureMask, PreprocessedImage
+from optimal_transport_morphometry.core.sparse import mask_values, rehydrate, voxel_index
+from optimal_transport_morphometry.core.storage import get_boto_client, head_object
+
+PREFETCH_DIR = pathlib.Path(tempfile.gettempdir()) / 'OTM' / 'prefetch'
+
+# The number of outputs of a single task uploaded at once
+UPLOAD_CONCURRENCY = 4
+
+
+def download(field_file, path: str) -> None:
+    """Download a blob to a local file."""
+    with open(path, 'wb') as local_file, field_file.open() as blob:
+        for chunk in blob.chunks():
+            local_file.write(chunk)
+
+
+@contextmanager
+def local_copy(field_file, suffix: str) -> Iterator[str]:
+    """Download a blob to a temporary file, yielding its path."""
+    # ANTs determines the format (and compression) of a file from its extension
+    with NamedTemporaryFile(suffix=suffix) as tmp:
+        download(field_file, tmp.name)
+        yield tmp.name
+
+
+class Prefetcher:
+    """
+    Downloads the blob of the input a worker is likely to need next, while it computes.
+
+    A single blob is prefetched at a time. If the next input isn't the prefetched one, the
+    prefetched copy is discarded and the input is downloaded as usual.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(1)
+        self._key: Optional[str] = None
+        self._path: Optional[str] = None
+        self._future: Optional[Future] = None
+
+    def prefetch(self, field_file, suffix: str) -> None:
+        """Start downloading a blob in the background."""
+        if field_file.name == self._key:
+            return
+
+        self.discard()
+        PREFETCH_DIR.mkdir(parents=True, exist_ok=True)
+        fd, self._path = tempfile.mkstemp(suffix=suffix, dir=PREFETCH_DIR)
+        os.close(fd)
+        self._key = field_file.name
+        self._future = self._executor.submit(download, field_file, self._path)
+
+    def discard(self) -> None:
+        """Discard the prefetched blob, removing its file once any running download stops."""
+        if self._future is not None:
+            self._future.cancel()
+            self._future.add_done_callback(lambda future, path=self._path: _unlink(path))
+        self._key = self._path = self._future = None
+
+    @contextmanager
+    def local_copy(self, field_file, suffix: str) -> Iterator[str]:
+        """Yield the path of a local copy of a blob, using the prefetched copy if it's the same."""
+        future, path = self._future, self._path
+        if field_file.name != self._key or future is None or path is None:
+            self.discard()
+            with local_copy(field_file, suffix) as path:
+                yield path
+            return
+
+        self._key = self._path = self._future = None
+        try:
+            future.result()
+        except Exception:
+            # The prefetch failed (e.g. a transient storage error), so try again in the foreground
+            download(field_file, path)
+
+        try:
+            yield path
+        finally:
+            _unlink(path)
+
+
+def _unlink(path: str) -> None:
+    pathlib.Path(path).unlink(missing_ok=True)
+
+
+# Each worker process prefetches for itself
+PREFETCHER = Prefetcher()
+
+
+def load_mask(feature_mask: FeatureMask):
+    """Download a feature mask, as an ANTs image."""
+    import ants
+
+    with local_copy(feature_mask.blob, nifti_suffix(feature_mask.blob.name)) as path:
+        return ants.image_read(path)
+
+
+def load_values(feature_image: FeatureImage):
+    """Download the in-mask values of a sparse feature image."""
+    suffix = '.npy.gz' if feature_image.values.name.endswith('.gz') else '.npy'
+    with local_copy(feature_image.values, suffix) as path:
+        return read_values(path)
+
+
+def load_feature_image(feature_image: FeatureImage, mask_img=None):
+    """
+    Download a feature image, as a dense ANTs image.
+
+    Sparse feature images are rehydrated within their mask. Since every feature image of a tissue
+    and downsample factor shares a mask, it may be passed in when loading several of them.
+    """
+    import ants
+
+    if feature_image.blob:
+        with local_copy(feature_image.blob, nifti_suffix(feature_image.blob.name)) as path:
+            return ants.image_read(path)
+
+    if mask_img is None:
+        mask_img = load_mask(feature_image.mask())
+    return rehydrate(load_values(feature_image), mask_img)
+
+
+def download_feature_image(feature_image: FeatureImage, path: str, mask_img=None) -> None:
+    """Download a feature image to a local NIfTI file, rehydrating it if it's sparse."""
+    import ants
+
+    if feature_image.blob:
+        download(feature_image.blob, path)
+    else:
+        ants.image_write(load_feature_image(feature_image, mask_img), path)
+
+
+def load_feature_values(feature_image: FeatureImage, mask_img=None):
+    """Download the in-mask values of a feature image, whether it's stored sparsely or not."""
+    if feature_image.values:
+        return load_values(feature_image)
+
+    if mask_img is None:
+        mask_img = load_mask(feature_image.mask())
+    return mask_values(load_feature_image(feature_image), mask_img)
+
+
+def iter_feature_images(feature_images: Iterable[FeatureImage], mask_img=None):
+    """Yield feature images as dense images, downloading the next while each is processed."""
+    with ThreadPoolExecutor(1) as executor:
+        pending = None
+        for feature_image in feature_images:
+            upcoming = executor.submit(load_feature_image, feature_image, mask_img)
+            if pending is not None:
+                yield pending.result()
+            pending = upcoming
+        if pending is not None:
+            yield pending.result()
+
+
+class OutputUploader:
+    """
+    Uploads the outputs of a task in background threads, while computation continues.
+
+    Images are written to local files with the batch's encoding as they're added, so they may be
+    freed straight away. Leaving the context waits for every upload, raising the first error, so
+    rows referencing the uploaded objects are only saved once every object is stored. If the
+    context is left with an error, pending uploads are cancelled.
+    """
+
+    def __init__(self, encoding: OutputEncoding, concurrency: int = UPLOAD_CONCURRENCY):
+        self.encoding = encoding
+        self.outputs: List[PreprocessedImage] = []
+        self.masks: List[FeatureMask] = []
+        self._executor = ThreadPoolExecutor(concurrency)
+        self._futures: List[Future] = []
+        self._directory = mkdtemp()
+
+        # Clients are thread-safe once created, but creating them isn't, so every upload shares one
+        self._client = get_boto_client()
+
+    def __enter__(self) -> 'OutputUploader':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            for future in self._futures:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            shutil.rmtree(self._directory, ignore_errors=True)
+
+    def save_file(self, field_file, path: str, filename: str) -> None:
+        """Upload a local file to a field of an output, in the background. Doesn't save."""
+        self._futures.append(self._executor.submit(_upload, field_file, path, filename))
+
+    def save_image(self, model: PreprocessedImage, img, name: str, labels: bool = False) -> None:
+        """
+        Write an image to a preprocessed image's blob, in the background.
+
+        The name is given without an extension, which depends on the encoding. Label images (i.e.
+        segmentations) are written as bytes.
+
+        Its size and checksum are recorded once it's uploaded, but it isn't saved. Its row can be
+        saved from :attr:`outputs` once the uploads are finished.
+        """
+        path = write_image(
+            img, str(pathlib.Path(self._directory) / name), self.encoding, labels=labels
+        )
+        model.dimensions = list(img.shape)
+        model.voxel_size = list(img.spacing)
+
+        filename = pathlib.Path(path).name
+        self._futures.append(
+            self._executor.submit(_upload_image, model, path, filename, self._client)
+        )
+        self.outputs.append(model)
+
+    def save_values(self, model: FeatureImage, img, mask_img, name: str) -> None:
+        """Write the values of an image within a mask to a feature image, in the background."""
+        path = write_values(
+            mask_values(img, mask_img), str(pathlib.Path(self._directory) / name), self.encoding
+        )
+        model.dimensions = list(img.shape)
+        model.voxel_size = list(img.spacing)
+
+        filename = pathlib.Path(path).name
+        self._futures.append(self._executor.submit(_upload_temporary, model.values, path, filename))
+        # Feature images may be stored both densely and sparsely
+        if model not in self.outputs:
+            self.outputs.append(model)
+
+    def save_mask(self, mask: FeatureMask, mask_img, name: str) -> None:
+        """Write a feature mask and its voxel index, in the background. Doesn't save."""
+        path = write_image(
+            mask_img, str(pathlib.Path(self._directory) / name), self.encoding, labels=True
+        )
+        index = voxel_index(mask_img)
+        index_path = write_values(
+            index, str(pathlib.Path(self._directory) / f'{name}_index'), self.encoding
+        )
+        mask.voxel_count = len(index)
+
+        for field_file, local_path in [(mask.blob, path), (mask.voxel_index, index_path)]:
+            filename = pathlib.Path(local_path).name
+            self._futures.append(
+                self._executor.submit(_upload_temporary, field_file, local_path, filename)
+            )
+        self.masks.append(mask)
+
+    def wait(self) -> List[PreprocessedImage]:
+        """Wait for every upload to be stored, returning the outputs."""
+        for future in self._futures:
+            future.result()
+
+        return self.outputs
+
+
+def _upload(field_file, path: str, filename: str) -> None:
+    with open(path, 'rb') as local_file:
+        field_file.save(filename, File(local_file), save=False)
+
+
+def _upload_temporary(field_file, path: str, filename: str) -> None:
+    try:
+        _upload(field_file, path, filename)
+    finally:
+        _unlink(path)
+
+
+def _upload_image(model: PreprocessedImage, path: str, filename: str, client) -> None:
+    _upload_temporary(model.blob, path, filename)
+
+    # Confirms the object is stored, before the row referencing it is saved
+    model.size, model.checksum = head_object(model.blob.name, client)
@@ -0,0 +1,118 @@
+"""
+Voxel-based morphometry (VBM) statistics, computed with NumPy.
+
+The correlation of every voxel with every variable is computed in a single pass over subjects, a
+block of subjects at a time. Only sums are accumulated across blocks, so memory is bounded by
+the number of voxels and variables, not subjects.
+"""
+
+from typing import Iterable, Tuple
+
+# The number of subjects whose values are multiplied at once
+SUBJECT_BLOCK_SIZE = 32
+
+# The number of voxels each block of subjects is processed in, bounding the size of temporaries
+VOXEL_BLOCK_SIZE = 2**16
+
+
+class CorrelationAccumulator:
+    """
+    The Pearson correlations of every voxel with each variable, accumulated a block at a time.
+
+    Variables are the columns of a design matrix, with a row per subject, where missing values
+    are NaN. Each variable is only correlated over the subjects which have a value for it.
+    """
+
+    def __init__(self, design, voxel_count: int):
+        import numpy as np
+
+        design = np.asarray(design, dtype=np.float64)
+        self.present = ~np.isnan(design)
+        self.counts = self.present.sum(axis=0)
+
+        # Centering each variable makes its cross products with the values their covariance
+        with np.errstate(invalid='ignore'):
+            means = np.nansum(design, axis=0) / self.counts
+        self.centered = np.where(self.present, design - means, 0)
+        self.sum_yy = (self.centered**2).sum(axis=0)
+
+        shape = (design.shape[1], voxel_count)
+        self.sum_x = np.zeros(shape)
+        self.sum_xx = np.zeros(shape)
+        self.sum_xy = np.zeros(shape)
+
+        # The values of the first subject, subtracted from every subject for numerical stability
+        self.shift = None
+        self.subjects = 0
+
+    def add(self, values) -> None:
+        """Add the values of a block of subjects, as a (subjects, voxels) array, in order."""
+        import numpy as np
+
+        values = np.asarray(values, dtype=np.float64)
+        if self.shift is None:
+            self.shift = values[0].copy()
+
+        rows = slice(self.subjects, self.subjects + len(values))
+        present = self.present[rows].astype(np.float64)
+        centered = self.centered[rows]
+        for start in range(0, values.shape[1], VOXEL_BLOCK_SIZE):
+            voxels = slice(start, start + VOXEL_BLOCK_SIZE)
+            block = values[:, voxels] - self.shift[voxels]
+            self.sum_x[:, voxels] += present.T @ block
+            self.sum_xx[:, voxels] += present.T @ (block * block)
+            self.sum_xy[:, voxels] += centered.T @ block
+
+        self.subjects += len(values)
+
+    def result(self):
+        """
+        Return the correlation and two-sided p-value maps, as (variables, voxels) arrays.
+
+        Voxels without any variance, or variables with fewer than three subjects, have a
+        correlation of 0 and a p-value of 1.
+        """
+        import numpy as np
+        from scipy.special import stdtr
+
+        if self.subjects != len(self.present):
+            raise ValueError(f'Expected {len(self.present)} subjects, not {self.subjects}.')
+
+        counts = self.counts[:, np.newaxis]
+        sum_squares = np.maximum(self.sum_xx - self.sum_x**2 / np.maximum(counts, 1), 0)
+        denominator = np.sqrt(sum_squares * self.sum_yy[:, np.newaxis])
+
+        valid = (denominator > 0) & (counts > 2)
+        correlation = np.zeros_like(denominator)
+        np.divide(self.sum_xy, denominator, out=correlation, where=valid)
+        np.clip(correlation, -1, 1, out=correlation)
+
+        # Test that each correlation is non-zero, with a t-distribution of n - 2 degrees of freedom
+        df = np.broadcast_to(counts - 2, correlation.shape).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = correlation * np.sqrt(df / (1 - correlation**2))
+        pvalue = np.where(valid, 2 * stdtr(df, -np.abs(t)), 1)
+
+        return correlation, pvalue
+
+
+def correlation_maps(subjects: Iterable, design, voxel_count: int) -> Tuple:
+    """
+    Return the correlation and p-value maps of the values of each subject with a design matrix.
+
+    The values of each subject are a 1D array of its voxels, in the order of the design's rows.
+    Subjects are consumed lazily, so they may be downloaded as they're needed.
+    """
+    import numpy as np
+
+    accumulator = CorrelationAccumulator(design, voxel_count)
+    block = []
+    for values in subjects:
+        block.append(values)
+        if len(block) == SUBJECT_BLOCK_SIZE:
+            accumulator.add(np.stack(block))
+            block = []
+    if block:
+        accumulator.add(np.stack(block))
+
+    return accumulator.result()
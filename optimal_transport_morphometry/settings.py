@@ -2,6 +2,7 @@ from __future__ import annotations
 
 from pathlib import Path
 
+from celery.schedules import crontab
 from composed_configuration import (
     ComposedConfiguration,
     ConfigMixin,
@@ -10,6 +11,7 @@ from composed_configuration import (
     ProductionBaseConfiguration,
     TestingBaseConfiguration,
 )
+from configurations import values
 
 _pkg = 'optimal_transport_morphometry'
 
@@ -20,6 +22,13 @@ class OptimalTransportMorphometryMixin(ConfigMixin):
 
     BASE_DIR = Path(__file__).resolve(strict=True).parent.parent
 
+    # The number of superseded preprocessing batches kept for each dataset, besides the current one
+    PREPROCESSING_BATCH_RETENTION = values.PositiveIntegerValue(2)
+
+    # The number of long-lived R processes each worker process runs UTM analyses in, so R and its
+    # packages aren't loaded for every analysis. If 0, each analysis starts a new Rscript process.
+    UTM_R_WORKERS = values.PositiveIntegerValue(1)
+
     @staticmethod
     def mutate_configuration(configuration: ComposedConfiguration) -> None:
         # Install local apps first, to ensure any overridden resources are found first
@@ -45,6 +54,20 @@ class OptimalTransportMorphometryMixin(ConfigMixin):
             }
         )
 
+        # Periodic tasks, scheduled by a single beat process (the "beat" Procfile entry, and the
+        # "celery-beat" compose service), separately from any number of workers
+        configuration.CELERY_BEAT_SCHEDULE = {
+            'prune-preprocessing-batches': {
+                'task': f'{_pkg}.core.tasks.prune_preprocessing_batches',
+                'schedule': crontab(hour=3, minute=0),
+            },
+            # Catches objects whose rows were deleted without them, e.g. by admin or cascades
+            'collect-garbage': {
+                'task': f'{_pkg}.core.tasks.collect_garbage',
+                'schedule': crontab(hour=4, minute=0, day_of_week='sunday'),
+            },
+        }
+
         # Allow redirect to /logout endpoint to logout
         configuration.ACCOUNT_LOGOUT_ON_GET = True
 
@@ -67,6 +67,7 @@ setup(
         'worker': [
             'antspyx',
             'numpy',
+            'scipy',
         ],
     },
 )